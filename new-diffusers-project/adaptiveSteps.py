@@ -0,0 +1,108 @@
+import os
+
+# 적응형 스텝 수 (조기 종료)
+# - 스텝마다 스케줄러가 예측한 x0 (최종 이미지 latent 추정) 를 기록하고 이전 스텝 대비 상대 변화량을 계산
+# - 최소 스텝 이후 변화량이 threshold 미만인 스텝이 patience 번 이어지면 종료
+# - 종료 시 현재 latent 를 예측 x0 로 바꾸고 남은 스텝은 건너뜀 (pipe.interrupt)
+#   = 남은 시그마 구간을 한 번에 0 까지 가는 마지막 스텝과 같음 (스케줄을 자른 채 노이즈가 남은 latent 를 디코드하지 않음)
+# - x0 를 얻을 수 있는 스케줄러만 지원 (pred_original_sample 반환, DPM++/UniPC 의 x0 예측, Flux flow matching)
+#   지원하지 않는 스케줄러는 그대로 전체 스텝 실행
+
+# 상대 변화량 기준 / 연속 횟수 / 최소 실행 비율
+ADAPTIVE_THRESHOLD = float(os.getenv("ADAPTIVE_THRESHOLD", "0.015"))
+ADAPTIVE_PATIENCE = int(os.getenv("ADAPTIVE_PATIENCE", "2"))
+ADAPTIVE_MIN_STEPS = float(os.getenv("ADAPTIVE_MIN_STEPS", "0.5"))
+
+
+def _x0_from_model_outputs(scheduler):
+    # 멀티스텝 솔버가 data prediction(x0) 으로 변환해 보관하는 경우
+    config = scheduler.config
+    outputs = getattr(scheduler, "model_outputs", None)
+    if not outputs or outputs[-1] is None:
+        return None
+    if "++" in str(config.get("algorithm_type", "")) or config.get("predict_x0", False):
+        return outputs[-1]
+    return None
+
+
+def predicted_x0(scheduler, model_output, sample, output):
+    if isinstance(output, tuple):
+        x0 = output[1] if len(output) > 1 else None
+    else:
+        x0 = getattr(output, "pred_original_sample", None)
+        if x0 is None:
+            # LCM
+            x0 = getattr(output, "denoised", None)
+    if x0 is not None:
+        return x0
+    x0 = _x0_from_model_outputs(scheduler)
+    if x0 is not None:
+        return x0
+    if type(scheduler).__name__ == "FlowMatchEulerDiscreteScheduler" and scheduler.step_index is not None:
+        # x_t = (1 - sigma) * x0 + sigma * noise, 모델 출력 v = noise - x0
+        sigma = scheduler.sigmas[scheduler.step_index - 1]
+        return sample - sigma.to(sample.device, sample.dtype) * model_output
+    return None
+
+
+class AdaptiveSteps:
+    def __init__(self, scheduler, threshold=None, patience=None, min_steps=None):
+        # scheduler: 요청 전용 스케줄러 (step 을 감싸므로 공유 인스턴스를 넘기면 안 됨)
+        self.scheduler = scheduler
+        self.threshold = ADAPTIVE_THRESHOLD if threshold is None else threshold
+        self.patience = ADAPTIVE_PATIENCE if patience is None else patience
+        self.min_steps = ADAPTIVE_MIN_STEPS if min_steps is None else min_steps
+        self.x0 = None
+        self.previous = None
+        self.changes = []
+        self.calm = 0
+        self.executed = 0
+        self.stopped_at = None
+        self.supported = True
+
+        step = scheduler.step
+
+        def step_with_x0(model_output, timestep, sample, *args, **kwargs):
+            output = step(model_output, timestep, sample, *args, **kwargs)
+            if self.stopped_at is None:
+                self.x0 = predicted_x0(scheduler, model_output, sample, output)
+            return output
+
+        scheduler.step = step_with_x0
+
+    def kwargs(self):
+        # 파이프라인 호출 인자
+        return {"callback_on_step_end": self.callback, "callback_on_step_end_tensor_inputs": ["latents"]}
+
+    def callback(self, pipe, step_index, timestep, callback_kwargs):
+        if self.stopped_at is not None:
+            return {}
+        self.executed = step_index + 1
+        if self.x0 is None:
+            self.supported = False
+            return {}
+        x0 = self.x0.float()
+        if self.previous is not None:
+            change = ((x0 - self.previous).norm() / x0.norm().clamp_min(1e-8)).item()
+            self.changes.append(round(change, 5))
+            self.calm = self.calm + 1 if change < self.threshold else 0
+        self.previous = x0
+
+        total = len(self.scheduler.timesteps)
+        if (self.calm >= self.patience and self.executed >= total * self.min_steps
+                and self.executed < total):
+            self.stopped_at = self.executed
+            pipe._interrupt = True
+            return {"latents": self.x0.to(callback_kwargs["latents"].dtype)}
+        return {}
+
+    def result(self):
+        total = len(self.scheduler.timesteps)
+        return {
+            "supported": self.supported,
+            "steps": self.stopped_at or total,
+            "total_steps": total,
+            "stopped_early": self.stopped_at is not None,
+            "threshold": self.threshold,
+            "changes": self.changes,
+        }
@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+from fastapi import HTTPException
+
+# ComfyUI 큐 기반 입장 제어
+# - /queue 와 status 웹소켓 메시지로 ComfyUI 큐 상태 추적
+# - 워크플로우별 실행 시간을 이벤트/히스토리에서 학습 (EWMA)
+# - 제출 시 예상 대기 시간 반환, 최대 대기 시간 초과 시 거절(429) 또는 대기(defer)
+# - 추적 중인 프롬프트의 큐 위치를 클라이언트에 전달
+
+# 학습 전 기본 실행 시간 (초)
+DEFAULT_DURATION = 20.0
+# EWMA 가중치
+SMOOTHING = 0.3
+# /queue 재조회 주기 (초)
+REFRESH_INTERVAL = 2.0
+
+
+class AdmissionController:
+    def __init__(self, comfy, max_wait=300.0, mode="reject", defer_timeout=60.0):
+        self.comfy = comfy
+        self.max_wait = max_wait
+        self.mode = mode
+        self.defer_timeout = defer_timeout
+        # 워크플로우 이름 -> 평균 실행 시간
+        self.durations = {}
+        # prompt_id -> {"workflow", "client_id", "submitted", "started"}
+        self.tracked = {}
+        self.running_ids = []
+        self.pending_ids = []
+        self.queue_remaining = 0
+        self.rejected = 0
+        self.deferred = 0
+        # notify(client_id, payload) 코루틴
+        self.notify = None
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"큐 상태 조회 오류: {str(e)}")
+            try:
+                await asyncio.wait_for(self._changed.wait(), REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+
+    async def refresh(self):
+        queue = await self.comfy.get_queue()
+        # 항목 형식: [number, prompt_id, prompt, extra_data, outputs_to_execute]
+        self.running_ids = [item[1] for item in sorted(queue.get("queue_running", []))]
+        self.pending_ids = [item[1] for item in sorted(queue.get("queue_pending", []))]
+        self.queue_remaining = len(self.running_ids) + len(self.pending_ids)
+
+        # 큐에서 사라진 프롬프트 정리
+        active = set(self.running_ids) | set(self.pending_ids)
+        for prompt_id in list(self.tracked):
+            info = self.tracked[prompt_id]
+            if prompt_id not in active and time.monotonic() - info["submitted"] > REFRESH_INTERVAL * 2:
+                del self.tracked[prompt_id]
+        await self._push_positions()
+
+    def on_message(self, message):
+        # 공유 업스트림 웹소켓 리스너
+        message_type = message.get("type")
+        data = message.get("data") or {}
+        if message_type == "status":
+            exec_info = data.get("status", {}).get("exec_info", {})
+            if exec_info.get("queue_remaining") != self.queue_remaining:
+                self._changed.set()
+            return
+
+        info = self.tracked.get(data.get("prompt_id"))
+        if info is None:
+            return
+        if message_type == "execution_start":
+            info["started"] = time.monotonic()
+            self._changed.set()
+        elif message_type in ("execution_success", "execution_error") or (
+            message_type == "executing" and data.get("node") is None
+        ):
+            if info.get("started") and not info.get("learned"):
+                self._learn(info["workflow"], time.monotonic() - info["started"])
+                info["learned"] = True
+            self._changed.set()
+
+    def learn_from_history(self, prompt_id, entry):
+        # 이벤트를 놓친 경우 히스토리의 실행 시작/종료 타임스탬프(ms)로 학습
+        info = self.tracked.get(prompt_id)
+        if info is None or info.get("learned"):
+            return
+        timestamps = {}
+        for name, data in entry.get("status", {}).get("messages", []):
+            if isinstance(data, dict) and "timestamp" in data:
+                timestamps[name] = data["timestamp"]
+        end = timestamps.get("execution_success") or timestamps.get("execution_error")
+        if "execution_start" in timestamps and end:
+            self._learn(info["workflow"], (end - timestamps["execution_start"]) / 1000.0)
+            info["learned"] = True
+
+    def _learn(self, workflow, duration):
+        if duration <= 0:
+            return
+        previous = self.durations.get(workflow)
+        self.durations[workflow] = duration if previous is None else (1 - SMOOTHING) * previous + SMOOTHING * duration
+
+    def estimate_duration(self, workflow=None):
+        if workflow in self.durations:
+            return self.durations[workflow]
+        if self.durations:
+            return sum(self.durations.values()) / len(self.durations)
+        return DEFAULT_DURATION
+
+    def _remaining(self, prompt_id):
+        info = self.tracked.get(prompt_id)
+        duration = self.estimate_duration(info["workflow"] if info else None)
+        if info and info.get("started"):
+            return max(duration - (time.monotonic() - info["started"]), 0.0)
+        return duration
+
+    def estimate_wait(self, before=None):
+        # before 가 있으면 해당 프롬프트 앞의 작업만, 없으면 큐 전체
+        wait = 0.0
+        ids = self.running_ids + self.pending_ids
+        known = len(ids)
+        for prompt_id in ids:
+            if prompt_id == before:
+                return wait
+            wait += self._remaining(prompt_id)
+        # /queue 조회 이후 status 로만 알게 된 작업
+        extra = max(self.queue_remaining - known, 0)
+        return wait + extra * self.estimate_duration()
+
+    def position(self, prompt_id):
+        ids = self.running_ids + self.pending_ids
+        return ids.index(prompt_id) if prompt_id in ids else None
+
+    async def admit(self, workflow):
+        # 예상 대기 시간 반환, 최대 대기 시간 초과 시 거절 또는 대기
+        wait = self.estimate_wait()
+        if wait <= self.max_wait:
+            return wait
+
+        if self.mode == "defer":
+            self.deferred += 1
+            deadline = time.monotonic() + self.defer_timeout
+            while time.monotonic() < deadline:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), REFRESH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                wait = self.estimate_wait()
+                if wait <= self.max_wait:
+                    return wait
+
+        self.rejected += 1
+        retry_after = int(wait - self.max_wait) + 1
+        raise HTTPException(
+            status_code=429,
+            detail=f"ComfyUI 대기열이 가득 찼습니다. 예상 대기 시간 {int(wait)}초",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def track(self, prompt_id, workflow, client_id=None):
+        self.tracked[prompt_id] = {
+            "workflow": workflow,
+            "client_id": client_id,
+            "submitted": time.monotonic(),
+            "started": None,
+        }
+        # 새 작업은 큐 맨 뒤
+        if prompt_id not in self.pending_ids and prompt_id not in self.running_ids:
+            self.pending_ids.append(prompt_id)
+            self.queue_remaining += 1
+        self._changed.set()
+        return {
+            "position": self.position(prompt_id),
+            "estimated_wait": round(self.estimate_wait(before=prompt_id), 1),
+        }
+
+    async def _push_positions(self):
+        if self.notify is None:
+            return
+        for prompt_id, info in list(self.tracked.items()):
+            if not info["client_id"]:
+                continue
+            position = self.position(prompt_id)
+            if position is None or position == info.get("last_position"):
+                continue
+            info["last_position"] = position
+            await self.notify(info["client_id"], {
+                "type": "queue_status",
+                "prompt_id": prompt_id,
+                "position": position,
+                "estimated_wait": round(self.estimate_wait(before=prompt_id), 1),
+            })
+
+    def stats(self):
+        return {
+            "queue_remaining": self.queue_remaining,
+            "estimated_wait": round(self.estimate_wait(), 1),
+            "max_wait": self.max_wait,
+            "mode": self.mode,
+            "durations": {k: round(v, 2) for k, v in self.durations.items()},
+            "rejected": self.rejected,
+            "deferred": self.deferred,
+        }
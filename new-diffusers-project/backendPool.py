@@ -0,0 +1,185 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from admission import AdmissionController
+from comfyClient import ComfyClient, ws_url_for
+from comfyHub import ComfyEventHub
+
+# 여러 ComfyUI 백엔드 풀
+# - 주기적으로 /system_stats, /queue 상태 확인
+# - 예상 대기 시간(큐 길이) 최소 백엔드로 라우팅, 체크포인트가 이미 로드된 백엔드 우선
+# - 프롬프트별 고정 라우팅 (웹소켓 이벤트, 히스토리, 이미지 조회)
+# - 연속 실패 시 제외, 확인 성공 시 다시 포함
+
+PROBE_INTERVAL = 5.0
+FAILURE_THRESHOLD = 3
+# 제외 시간 (연속 제외 시 2배씩 증가, 최대 MAX_EJECT_SECONDS)
+EJECT_SECONDS = 10.0
+MAX_EJECT_SECONDS = 300.0
+# 모델이 이미 로드된 백엔드에 주는 가산점 (초 단위 대기 시간으로 환산)
+AFFINITY_BONUS = 15.0
+# prompt_id -> 백엔드 고정 기록 한도
+STICKY_LIMIT = 10000
+
+MODEL_INPUTS = ("ckpt_name", "unet_name", "clip_name", "clip_name1", "clip_name2", "vae_name", "lora_name")
+
+
+def models_of(workflow):
+    # 워크플로우가 사용하는 모델 파일 목록 (로더 노드 입력)
+    models = set()
+    for node in workflow.values():
+        for name in MODEL_INPUTS:
+            value = node.get("inputs", {}).get(name)
+            if isinstance(value, str):
+                models.add(value)
+    return models
+
+
+class Backend:
+    def __init__(self, name, url, admission_options=None, ws_pool_size=1):
+        self.name = name
+        self.url = url
+        self.client = ComfyClient(url)
+        self.hub = ComfyEventHub(ws_url_for(url), pool_size=ws_pool_size)
+        self.admission = AdmissionController(self.client, **(admission_options or {}))
+        self.hub.add_listener(self.admission.on_message)
+        self.healthy = True
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.loaded_models = set()
+        self.system_stats = None
+        self.last_probe = None
+        self.last_error = None
+
+    def score(self, models):
+        wait = self.admission.estimate_wait()
+        if models and models <= self.loaded_models:
+            wait -= AFFINITY_BONUS
+        return wait, self.admission.queue_remaining
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.healthy,
+            "connected": self.hub.connected,
+            "failures": self.failures,
+            "ejected_until": self.ejected_until if not self.healthy else None,
+            "loaded_models": sorted(self.loaded_models),
+            "last_error": self.last_error,
+            "queue": self.admission.stats(),
+        }
+
+
+class BackendPool:
+    def __init__(self, urls, admission_options=None, ws_pool_size=1):
+        self.backends = OrderedDict()
+        for index, url in enumerate(urls):
+            name = f"b{index}"
+            self.backends[name] = Backend(name, url.strip(), admission_options, ws_pool_size)
+        self._sticky = OrderedDict()
+        self._task = None
+
+    async def start(self):
+        for backend in self.backends.values():
+            await backend.client.start()
+            await backend.hub.start()
+            backend.admission.start()
+        self._task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for backend in self.backends.values():
+            await backend.admission.stop()
+            await backend.hub.stop()
+            await backend.client.close()
+
+    @property
+    def connected(self):
+        return any(b.healthy and b.hub.connected for b in self.backends.values())
+
+    async def wait_connected(self, timeout=5.0):
+        if self.connected:
+            return True
+        results = await asyncio.gather(*(b.hub.wait_connected(timeout) for b in self.backends.values()))
+        return any(results)
+
+    def set_notify(self, notify):
+        for backend in self.backends.values():
+            backend.admission.notify = notify
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self.probe(b) for b in self.backends.values()))
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    async def probe(self, backend):
+        try:
+            backend.system_stats = await backend.client.system_stats()
+            await backend.admission.refresh()
+        except Exception as e:
+            self.report_failure(backend, e)
+            return
+        backend.last_probe = time.time()
+        backend.failures = 0
+        backend.last_error = None
+        if not backend.healthy and time.monotonic() >= backend.ejected_until:
+            backend.healthy = True
+            print(f"ComfyUI 백엔드 복귀: {backend.name} ({backend.url})")
+
+    def report_failure(self, backend, error):
+        backend.failures += 1
+        backend.last_error = str(error)
+        if backend.healthy and backend.failures >= FAILURE_THRESHOLD:
+            backend.healthy = False
+            backend.ejections += 1
+            eject_for = min(EJECT_SECONDS * (2 ** (backend.ejections - 1)), MAX_EJECT_SECONDS)
+            backend.ejected_until = time.monotonic() + eject_for
+            print(f"ComfyUI 백엔드 제외: {backend.name} ({backend.url}), {eject_for}초")
+        elif backend.healthy is False:
+            backend.ejected_until = max(backend.ejected_until, time.monotonic() + EJECT_SECONDS)
+
+    def report_success(self, backend):
+        backend.failures = 0
+        if backend.healthy:
+            backend.ejections = 0
+
+    def choose(self, workflow=None):
+        candidates = [b for b in self.backends.values() if b.healthy and b.hub.connected]
+        if not candidates:
+            candidates = [b for b in self.backends.values() if b.healthy]
+        if not candidates:
+            raise HTTPException(status_code=503, detail="사용 가능한 ComfyUI 서버가 없습니다.")
+        models = models_of(workflow) if workflow else set()
+        return min(candidates, key=lambda b: b.score(models))
+
+    def bind(self, prompt_id, backend, workflow=None):
+        self._sticky[prompt_id] = backend.name
+        while len(self._sticky) > STICKY_LIMIT:
+            self._sticky.popitem(last=False)
+        if workflow:
+            # ComfyUI 는 마지막에 사용한 모델을 메모리에 유지
+            backend.loaded_models = models_of(workflow)
+
+    def for_prompt(self, prompt_id):
+        name = self._sticky.get(prompt_id)
+        return self.backends.get(name) if name else None
+
+    def get(self, name):
+        return self.backends.get(name) or self.default
+
+    @property
+    def default(self):
+        return next(iter(self.backends.values()))
+
+    def stats(self):
+        return {"backends": [b.to_dict() for b in self.backends.values()], "sticky_prompts": len(self._sticky)}
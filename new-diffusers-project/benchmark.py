@@ -0,0 +1,312 @@
+import argparse
+import contextlib
+import copy
+import json
+import math
+import os
+import statistics
+import time
+
+import torch
+
+# 추론 최적화 벤치마크
+# 사용 예: python benchmark.py cpu --models sd flux --runs 3
+#         python benchmark.py tome --ratios 0 0.3 0.5 --size 768
+#         python benchmark.py adaptive --thresholds 0.01 0.015 0.03 --prompts prompts.txt
+
+SD_MODEL = "runwayml/stable-diffusion-v1-5"
+FLUX_MODEL = "black-forest-labs/FLUX.1-schnell"
+PROMPT = "1 girl, from head to toe, medieval fantasy, gray background"
+
+# 적응형 스텝 평가용 기본 프롬프트 (--prompts 파일로 교체, 한 줄에 하나)
+ADAPTIVE_PROMPTS = [
+    PROMPT,
+    "a cozy wooden cabin in a snowy forest at night, warm light in the windows",
+    "portrait of an old fisherman, dramatic lighting, detailed wrinkles",
+    "a bowl of ramen on a wooden table, top view, studio photo",
+    "futuristic city skyline at sunset, flying cars, wide angle",
+    "watercolor painting of a fox sitting in a field of flowers",
+    "a red sports car on a mountain road, motion blur",
+    "isometric illustration of a small island with a lighthouse",
+]
+
+
+def load_pipeline(kind, model_id=None):
+    # 현재 서버들의 CPU 기본값(fp32, 기본 설정)으로 로드
+    if kind == "sd":
+        from diffusers import StableDiffusionPipeline
+        return StableDiffusionPipeline.from_pretrained(
+            model_id or SD_MODEL,
+            torch_dtype=torch.float32,
+            safety_checker=None,
+        )
+    if kind == "flux":
+        from diffusers import FluxPipeline
+        return FluxPipeline.from_pretrained(model_id or FLUX_MODEL, torch_dtype=torch.float32)
+    raise ValueError(f"알 수 없는 모델 종류: {kind}")
+
+
+def default_call_args(kind, args):
+    call_args = {
+        "width": args.size,
+        "height": args.size,
+        "num_inference_steps": args.steps or (20 if kind == "sd" else 4),
+    }
+    if kind == "flux":
+        call_args["guidance_scale"] = 0.0
+    return call_args
+
+
+def positive_int(value):
+    # --runs 0 이면 측정값이 없어 평균을 낼 수 없음
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"1 이상이어야 합니다: {value}")
+    return number
+
+
+def time_pipeline(pipe, runs, context=None, **kwargs):
+    # 첫 실행(컴파일/pre-pack 포함)은 따로 기록
+    context = context or contextlib.nullcontext
+    timings = []
+    image = None
+    first = None
+    for i in range(runs + 1):
+        start = time.perf_counter()
+        with torch.inference_mode(), context():
+            image = pipe(
+                PROMPT,
+                generator=torch.Generator(pipe.device.type if pipe.device.type == "cuda" else "cpu").manual_seed(0),
+                **kwargs
+            ).images[0]
+        elapsed = time.perf_counter() - start
+        if i == 0:
+            first = elapsed
+        else:
+            timings.append(elapsed)
+    steps = kwargs.get("num_inference_steps", 1)
+    return {
+        "first_run_s": round(first, 3),
+        "mean_s": round(statistics.mean(timings), 3),
+        "median_s": round(statistics.median(timings), 3),
+        "min_s": round(min(timings), 3),
+        "s_per_step": round(statistics.median(timings) / steps, 4),
+    }, image
+
+
+def print_table(rows):
+    header = ["model", "mode", "first_run_s", "median_s", "min_s", "s_per_step", "speedup", "psnr_db", "mae",
+              "avg_steps", "steps_saved_pct"]
+    print("\t".join(header))
+    for row in rows:
+        print("\t".join(str(row.get(h, "")) for h in header))
+
+
+def bench_cpu(args):
+    from cpuOptimize import optimize_pipeline, cpu_autocast
+
+    rows = []
+    for kind in args.models:
+        model_id = args.sd_model if kind == "sd" else args.flux_model
+        print(f"[{kind}] {model_id} 로드 중...")
+        pipe = load_pipeline(kind, model_id)
+        call_args = default_call_args(kind, args)
+
+        print(f"[{kind}] fp32 기본 설정 측정")
+        baseline, _ = time_pipeline(pipe, args.runs, **call_args)
+        rows.append({"model": kind, "mode": "fp32-default", **baseline, "speedup": 1.0})
+
+        print(f"[{kind}] CPU 프로파일 측정")
+        profile = optimize_pipeline(pipe, bf16=args.bf16, backend=args.backend)
+        optimized, _ = time_pipeline(pipe, args.runs, context=lambda: cpu_autocast(profile), **call_args)
+        rows.append({
+            "model": kind,
+            "mode": f"cpu-profile({profile.backend}{', bf16' if profile.bf16 else ''})",
+            **optimized,
+            "speedup": round(baseline["median_s"] / optimized["median_s"], 2),
+            "profile": profile.to_dict(),
+        })
+
+        del pipe
+    return rows
+
+
+def image_psnr(reference, image):
+    # 병합 없는 결과 대비 품질 (PSNR, 평균 절대 오차)
+    import numpy as np
+    a = np.asarray(reference, dtype=np.float64)
+    b = np.asarray(image, dtype=np.float64)
+    mse = float(((a - b) ** 2).mean())
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+    return round(psnr, 2), round(float(np.abs(a - b).mean()), 3)
+
+
+def bench_tome(args):
+    from tokenMerge import token_merging
+
+    device = args.device
+    print(f"[sd] {args.sd_model} 로드 중...")
+    pipe = load_pipeline("sd", args.sd_model).to(device)
+    call_args = default_call_args("sd", args)
+
+    rows = []
+    reference = None
+    baseline = None
+    for ratio in args.ratios:
+        print(f"[sd] ToMe ratio={ratio} 측정")
+        with token_merging(pipe.unet, ratio):
+            timing, image = time_pipeline(pipe, args.runs, **call_args)
+        if reference is None:
+            reference, baseline = image, timing
+        psnr, mae = image_psnr(reference, image)
+        rows.append({
+            "model": "sd",
+            "mode": f"tome-{ratio}@{args.size}",
+            **timing,
+            "speedup": round(baseline["median_s"] / timing["median_s"], 2),
+            "psnr_db": psnr,
+            "mae": mae,
+        })
+    return rows
+
+
+def run_adaptive(pipe, scheduler, prompt, call_args, threshold=None):
+    # threshold 가 None 이면 전체 스텝 (기준 이미지)
+    from adaptiveSteps import AdaptiveSteps
+    from schedulerRegistry import pipeline_with_scheduler
+
+    run_pipe = pipeline_with_scheduler(pipe, copy.deepcopy(scheduler))
+    adaptive = AdaptiveSteps(run_pipe.scheduler, threshold) if threshold is not None else None
+    start = time.perf_counter()
+    with torch.inference_mode():
+        image = run_pipe(
+            prompt,
+            generator=torch.Generator(pipe.device.type if pipe.device.type == "cuda" else "cpu").manual_seed(0),
+            **call_args,
+            **(adaptive.kwargs() if adaptive else {})
+        ).images[0]
+    return image, time.perf_counter() - start, adaptive.result() if adaptive else None
+
+
+def bench_adaptive(args):
+    # 프롬프트마다 전체 스텝 결과를 기준으로 threshold 별 절약한 스텝 수 / 시간 / 품질 차이
+    kind = args.model
+    model_id = args.sd_model if kind == "sd" else args.flux_model
+    print(f"[{kind}] {model_id} 로드 중...")
+    pipe = load_pipeline(kind, model_id).to(args.device)
+    scheduler = pipe.scheduler
+    if args.sampler:
+        from schedulerRegistry import SchedulerRegistry
+        scheduler = SchedulerRegistry(pipe).get(args.sampler)
+    call_args = default_call_args(kind, args)
+    if kind == "flux" and args.guidance is not None:
+        call_args["guidance_scale"] = args.guidance
+
+    prompts = ADAPTIVE_PROMPTS
+    if args.prompts:
+        with open(args.prompts, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    # 첫 실행(워밍업)은 측정에서 제외
+    run_adaptive(pipe, scheduler, prompts[0], call_args)
+
+    baseline_times = []
+    results = {threshold: [] for threshold in args.thresholds}
+    for index, prompt in enumerate(prompts):
+        print(f"[{kind}] ({index + 1}/{len(prompts)}) {prompt}")
+        reference, elapsed, _ = run_adaptive(pipe, scheduler, prompt, call_args)
+        baseline_times.append(elapsed)
+        for threshold in args.thresholds:
+            image, elapsed, result = run_adaptive(pipe, scheduler, prompt, call_args, threshold)
+            if not result["supported"]:
+                raise SystemExit(f"x0 예측을 얻을 수 없는 스케줄러입니다: {type(scheduler).__name__}")
+            psnr, mae = image_psnr(reference, image)
+            results[threshold].append({**result, "elapsed": elapsed, "psnr_db": psnr, "mae": mae})
+            if args.save_dir:
+                os.makedirs(args.save_dir, exist_ok=True)
+                reference.save(os.path.join(args.save_dir, f"{index:03}_full.png"))
+                image.save(os.path.join(args.save_dir, f"{index:03}_t{threshold}.png"))
+
+    total_steps = call_args["num_inference_steps"]
+    rows = [{
+        "model": kind,
+        "mode": f"full-{total_steps}",
+        "median_s": round(statistics.median(baseline_times), 3),
+        "min_s": round(min(baseline_times), 3),
+        "speedup": 1.0,
+        "avg_steps": total_steps,
+        "steps_saved_pct": 0.0,
+    }]
+    for threshold, items in results.items():
+        times = [item["elapsed"] for item in items]
+        steps = [item["steps"] / item["total_steps"] * total_steps for item in items]
+        # 조기 종료하지 않은 프롬프트는 기준과 같은 이미지 (PSNR 무한대) 이므로 품질 평균에서 제외
+        stopped = [item for item in items if item["stopped_early"]]
+        psnrs = [item["psnr_db"] for item in stopped if math.isfinite(item["psnr_db"])]
+        rows.append({
+            "model": kind,
+            "mode": f"adaptive-{threshold}",
+            "median_s": round(statistics.median(times), 3),
+            "min_s": round(min(times), 3),
+            "speedup": round(statistics.mean(baseline_times) / statistics.mean(times), 2),
+            "psnr_db": round(statistics.mean(psnrs), 2) if psnrs else "",
+            "min_psnr_db": round(min(psnrs), 2) if psnrs else None,
+            "mae": round(statistics.mean(item["mae"] for item in items), 3),
+            "avg_steps": round(statistics.mean(steps), 2),
+            "steps_saved_pct": round((1 - statistics.mean(steps) / total_steps) * 100, 1),
+            "stopped_early": f"{len(stopped)}/{len(items)}",
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="diffusers 추론 벤치마크")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    cpu = sub.add_parser("cpu", help="fp32 기본값 vs CPU 프로파일 비교")
+    cpu.add_argument("--models", nargs="+", default=["sd", "flux"], choices=["sd", "flux"])
+    cpu.add_argument("--sd-model", default=SD_MODEL)
+    cpu.add_argument("--flux-model", default=FLUX_MODEL)
+    cpu.add_argument("--size", type=int, default=512)
+    cpu.add_argument("--steps", type=int, default=None)
+    cpu.add_argument("--runs", type=positive_int, default=3)
+    cpu.add_argument("--backend", default=None, choices=["auto", "ipex", "inductor", "eager"])
+    cpu.add_argument("--bf16", type=lambda v: v == "1", default=None, help="1/0, 기본값은 하드웨어 자동 감지")
+    cpu.add_argument("--out", default=None, help="결과 JSON 저장 경로")
+
+    tome = sub.add_parser("tome", help="토큰 병합 비율별 속도/품질 비교")
+    tome.add_argument("--sd-model", default=SD_MODEL)
+    tome.add_argument("--device", default="cpu")
+    tome.add_argument("--ratios", nargs="+", type=float, default=[0.0, 0.3, 0.5])
+    tome.add_argument("--size", type=int, default=512)
+    tome.add_argument("--steps", type=int, default=None)
+    tome.add_argument("--runs", type=positive_int, default=3)
+    tome.add_argument("--out", default=None, help="결과 JSON 저장 경로")
+
+    adaptive = sub.add_parser("adaptive", help="적응형 스텝(조기 종료) 기준별 절약 스텝/품질 비교")
+    adaptive.add_argument("--model", default="sd", choices=["sd", "flux"])
+    adaptive.add_argument("--sd-model", default=SD_MODEL)
+    adaptive.add_argument("--flux-model", default=FLUX_MODEL)
+    adaptive.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    adaptive.add_argument("--sampler", default=None, help="A1111 샘플러 이름 (없으면 파이프라인 기본 스케줄러)")
+    adaptive.add_argument("--thresholds", nargs="+", type=float, default=[0.01, 0.015, 0.03])
+    adaptive.add_argument("--prompts", default=None, help="프롬프트 파일 (한 줄에 하나)")
+    adaptive.add_argument("--size", type=int, default=512)
+    adaptive.add_argument("--steps", type=int, default=None)
+    adaptive.add_argument("--guidance", type=float, default=None, help="Flux guidance_scale")
+    adaptive.add_argument("--save-dir", default=None, help="기준/조기 종료 이미지 저장 폴더")
+    adaptive.add_argument("--out", default=None, help="결과 JSON 저장 경로")
+
+    args = parser.parse_args()
+    commands = {"cpu": bench_cpu, "tome": bench_tome, "adaptive": bench_adaptive}
+    rows = commands[args.command](args)
+
+    print_table(rows)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2, ensure_ascii=False)
+        print(f"결과 저장: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+import websockets
+from fastapi import HTTPException
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+
+# ComfyUI 비동기 클라이언트
+# - keep-alive 커넥션 풀을 공유하는 httpx.AsyncClient
+# - 완료 감지는 ComfyUI 웹소켓 executing/executed 이벤트, 실패 시 백오프 폴링
+
+
+def ws_url_for(base_url):
+    if base_url.startswith("https://"):
+        return "wss://" + base_url[len("https://"):] + "/ws"
+    return "ws://" + base_url.split("://", 1)[-1] + "/ws"
+
+
+class ComfyClient:
+    def __init__(self, base_url, max_connections=100, timeout=30.0):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = ws_url_for(self.base_url)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._http = None
+
+    async def start(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections // 4 or 1,
+                ),
+            )
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    @property
+    def http(self):
+        if self._http is None:
+            raise RuntimeError("ComfyClient.start() 가 호출되지 않았습니다.")
+        return self._http
+
+    async def queue_prompt(self, prompt, client_id=None):
+        client_id = client_id or str(uuid.uuid4())
+        try:
+            res = await self.http.post("/prompt", json={"prompt": prompt, "client_id": client_id})
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"ComfyUI 서버 오류: {str(e)}")
+        if res.status_code != 200:
+            raise HTTPException(status_code=500, detail=f"ComfyUI 서버 오류: {res.text}")
+        result = res.json()
+        if not result.get("prompt_id"):
+            raise HTTPException(status_code=500, detail="ComfyUI 서버에서 prompt_id를 받지 못했습니다.")
+        return result
+
+    async def get_history(self, prompt_id):
+        try:
+            res = await self.http.get(f"/history/{prompt_id}")
+            res.raise_for_status()
+            return res.json()
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"히스토리 데이터 가져오기 오류: {str(e)}")
+
+    async def get_queue(self):
+        res = await self.http.get("/queue")
+        res.raise_for_status()
+        return res.json()
+
+    async def system_stats(self):
+        res = await self.http.get("/system_stats")
+        res.raise_for_status()
+        return res.json()
+
+    async def open_view(self, filename, subfolder, folder_type):
+        # /view 스트리밍 응답 열기 (호출자가 aclose 해야 함)
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        try:
+            res = await self.http.send(self.http.build_request("GET", "/view", params=params), stream=True)
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"이미지 가져오기 오류: {str(e)}")
+        if res.status_code != 200:
+            await res.aclose()
+            raise HTTPException(
+                status_code=404 if res.status_code == 404 else 502,
+                detail=f"이미지 가져오기 오류: {res.status_code}",
+            )
+        return res
+
+    async def stream_view(self, filename, subfolder, folder_type, sink, chunk_size=64 * 1024):
+        # /view 응답을 메모리에 모으지 않고 청크 단위로 sink 에 전달, media_type 반환
+        res = await self.open_view(filename, subfolder, folder_type)
+        try:
+            async for chunk in res.aiter_bytes(chunk_size):
+                await sink(chunk)
+            return res.headers.get("content-type", "image/png")
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"이미지 가져오기 오류: {str(e)}")
+        finally:
+            await res.aclose()
+
+    async def connect_ws(self, client_id):
+        # 프롬프트 전송 전에 먼저 연결해야 이벤트를 놓치지 않음
+        try:
+            return await websockets.connect(f"{self.ws_url}?clientId={client_id}", max_size=None)
+        except (OSError, InvalidHandshake, asyncio.TimeoutError) as e:
+            print(f"ComfyUI 웹소켓 연결 실패, 폴링으로 대체: {str(e)}")
+            return None
+
+    async def _wait_ws(self, ws, prompt_id):
+        async for out in ws:
+            # 바이너리(미리보기)는 무시
+            if not isinstance(out, str):
+                continue
+            message = json.loads(out)
+            data = message.get("data", {})
+            if data.get("prompt_id") != prompt_id:
+                continue
+            if message["type"] == "execution_error":
+                raise HTTPException(status_code=500, detail=f"ComfyUI 처리 오류: {data.get('exception_message', data)}")
+            if message["type"] == "execution_success":
+                return
+            if message["type"] == "executing" and data.get("node") is None:
+                return
+
+    async def _poll_history(self, prompt_id, deadline):
+        # 웹소켓을 쓸 수 없을 때만 사용하는 지수 백오프 폴링
+        loop = asyncio.get_running_loop()
+        delay = 0.1
+        while True:
+            history = await self.get_history(prompt_id)
+            if prompt_id in history:
+                return history
+            if loop.time() + delay > deadline:
+                raise HTTPException(status_code=504, detail="이미지 생성 실패 또는 시간초과")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+    async def run_prompt(self, prompt, client_id=None, timeout=60.0):
+        # 프롬프트를 큐에 넣고 완료될 때까지 대기한 뒤 (prompt_id, history 항목) 반환
+        client_id = client_id or str(uuid.uuid4())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        ws = await self.connect_ws(client_id)
+        try:
+            result = await self.queue_prompt(prompt, client_id)
+            prompt_id = result["prompt_id"]
+
+            if ws is not None:
+                try:
+                    await asyncio.wait_for(self._wait_ws(ws, prompt_id), timeout)
+                except asyncio.TimeoutError:
+                    raise HTTPException(status_code=504, detail="이미지 생성 실패 또는 시간초과")
+                except (ConnectionClosed, OSError) as e:
+                    print(f"ComfyUI 웹소켓 끊김, 폴링으로 대체: {str(e)}")
+
+            history = await self._poll_history(prompt_id, deadline)
+        finally:
+            if ws is not None:
+                await ws.close()
+
+        entry = history[prompt_id]
+        if entry.get("status", {}).get("status_str") == "error":
+            raise HTTPException(status_code=500, detail=f"ComfyUI 처리 오류: {entry['status']}")
+        return prompt_id, entry
+
+
+def output_images(entry):
+    # 히스토리 항목에서 출력 이미지 목록 추출
+    images = []
+    for node_id, node_output in entry.get("outputs", {}).items():
+        for image in node_output.get("images", []):
+            images.append(image)
+    return images
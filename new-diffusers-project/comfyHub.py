@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import json
+import uuid
+from collections import OrderedDict
+
+import websockets
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+
+# 모든 브라우저 클라이언트가 공유하는 ComfyUI 업스트림 웹소켓
+# - 프롬프트는 업스트림 client_id 로 제출하고, 이벤트는 prompt_id 기준으로 구독자에게 분배
+# - 연결이 끊기면 자동 재연결 (구독은 유지)
+
+# 구독 전에 도착한 이벤트 보관 한도
+PENDING_PROMPTS = 256
+PENDING_MESSAGES = 64
+
+
+class UpstreamConnection:
+    def __init__(self, hub, ws_url):
+        self.hub = hub
+        self.ws_url = ws_url
+        self.client_id = f"proxy_{uuid.uuid4()}"
+        self.ws = None
+        self.connected = asyncio.Event()
+        # 바이너리 미리보기에는 prompt_id 가 없어서 현재 실행 중인 프롬프트로 라우팅
+        self.current_prompt_id = None
+        self.current_node = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                async with websockets.connect(f"{self.ws_url}?clientId={self.client_id}", max_size=None) as ws:
+                    self.ws = ws
+                    self.connected.set()
+                    delay = 0.5
+                    print(f"ComfyUI 업스트림 연결: {self.client_id}")
+                    async for out in ws:
+                        self._handle(out)
+            except asyncio.CancelledError:
+                raise
+            except (ConnectionClosed, InvalidHandshake, OSError, asyncio.TimeoutError) as e:
+                print(f"ComfyUI 업스트림 연결 끊김 ({str(e)}), {delay}초 후 재연결")
+            except Exception as e:
+                print(f"ComfyUI 업스트림 오류: {str(e)}")
+            finally:
+                self.ws = None
+                self.connected.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10.0)
+
+    def _handle(self, out):
+        if isinstance(out, str):
+            message = json.loads(out)
+            data = message.get("data") or {}
+            if message.get("type") == "executing":
+                self.current_prompt_id = data.get("prompt_id")
+                self.current_node = data.get("node")
+                if data.get("node") is None:
+                    self.current_prompt_id = None
+            prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+            self.hub._dispatch(prompt_id, message)
+        else:
+            if self.current_prompt_id is None:
+                return
+            self.hub._dispatch(self.current_prompt_id, {
+                "type": "binary",
+                "data": {"prompt_id": self.current_prompt_id, "node": self.current_node},
+                "bytes": out,
+            })
+
+
+class ComfyEventHub:
+    def __init__(self, ws_url, pool_size=1):
+        self.ws_url = ws_url
+        self.connections = [UpstreamConnection(self, ws_url) for _ in range(pool_size)]
+        self._round_robin = itertools.cycle(self.connections)
+        self._subscribers = {}
+        self._pending = OrderedDict()
+        # 전체 텍스트 메시지 리스너 (status 등 prompt_id 가 없는 메시지 포함)
+        self._listeners = []
+
+    async def start(self):
+        for conn in self.connections:
+            conn.start()
+
+    async def stop(self):
+        for conn in self.connections:
+            await conn.stop()
+
+    @property
+    def connected(self):
+        return any(conn.connected.is_set() for conn in self.connections)
+
+    async def wait_connected(self, timeout=5.0):
+        if self.connected:
+            return True
+        waiters = [asyncio.create_task(conn.connected.wait()) for conn in self.connections]
+        done, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        return bool(done)
+
+    def submit_client_id(self):
+        # 연결된 업스트림 중 하나의 client_id (이 id로 제출해야 이벤트를 받을 수 있음)
+        for _ in range(len(self.connections)):
+            conn = next(self._round_robin)
+            if conn.connected.is_set():
+                return conn.client_id
+        return next(self._round_robin).client_id
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def subscribe(self, prompt_id):
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(prompt_id, []).append(queue)
+        # 구독 전에 도착한 이벤트 재생
+        for message in self._pending.pop(prompt_id, []):
+            queue.put_nowait(message)
+        return queue
+
+    def unsubscribe(self, prompt_id, queue):
+        queues = self._subscribers.get(prompt_id)
+        if not queues:
+            return
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            del self._subscribers[prompt_id]
+
+    def _dispatch(self, prompt_id, message):
+        if message.get("type") != "binary":
+            for callback in self._listeners:
+                try:
+                    callback(message)
+                except Exception as e:
+                    print(f"리스너 오류: {str(e)}")
+        if prompt_id is None:
+            return
+
+        queues = self._subscribers.get(prompt_id)
+        if queues:
+            for queue in queues:
+                queue.put_nowait(message)
+            return
+
+        # 아직 구독자가 없으면 잠시 보관
+        pending = self._pending.setdefault(prompt_id, [])
+        self._pending.move_to_end(prompt_id)
+        if message.get("type") == "binary":
+            # 바이너리 프레임은 노드별 마지막 것만 보관 (PENDING_MESSAGES 한도는 JSON 이벤트에만 적용)
+            node = message["data"]["node"]
+            pending[:] = [m for m in pending if m.get("type") != "binary" or m["data"]["node"] != node]
+            pending.append(message)
+        elif sum(1 for m in pending if m.get("type") != "binary") < PENDING_MESSAGES:
+            pending.append(message)
+        while len(self._pending) > PENDING_PROMPTS:
+            self._pending.popitem(last=False)
@@ -1,17 +1,32 @@
-from fastapi import FastAPI, HTTPException, Response, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
+import hmac
 import uuid
 import json
 import urllib.request
 import urllib.parse
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Dict, Any, Optional, List
 import os
 import random
 import asyncio
+from collections import OrderedDict, deque
+from io import BytesIO
 
-import websocket as ws_client
-from websockets.exceptions import ConnectionClosed
+from workflowTemplates import TemplateStore, WorkflowError
+from imageCache import ImageCache, serve as serve_cached
+from backendPool import BackendPool
+from previewChannel import PreviewChannel
+from generationIndex import GenerationIndex
+from workflowOptimizer import CacheStats, normalize_text, optimize, order_for_cache, prune
+from tracing import NOOP, NodeTimeline, Tracer, render_html
+from singleFlight import SingleFlight, request_key
+from fairQueue import FAIR_WINDOW, FairQueue
+from outputDelivery import (
+    DELIVERY_MODES, OUTPUT_DELIVERY, DeliveryStats, output_media_type, output_path, save_output, websocket_nodes, websocket_outputs
+)
 
 
 app = FastAPI()
@@ -25,156 +40,655 @@ app.add_middleware(
 )
 
 COMFY_SERVER = "http://127.0.0.1:8188"
-COMFY_WS = "ws://127.0.0.1:8188/ws"
+# 여러 ComfyUI 서버 사용 시 쉼표로 구분 (예: http://10.0.0.2:8188,http://10.0.0.3:8188)
+COMFY_SERVERS = os.getenv("COMFY_SERVERS", COMFY_SERVER).split(",")
+
+# 출력 이미지 로컬 디스크 캐시 (크기 제한 LRU)
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".image_cache")
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "1024"))
+
+# 완료된 생성 결과 색인 (SQLite)
+GENERATION_DB = os.getenv("GENERATION_DB", "generations.db")
+
+# 워크플로우 정리 (도달 불가 노드 제거, 입력 정규화, 중복 노드 병합, 배치 제출 순서 정렬)
+WORKFLOW_OPTIMIZE = os.getenv("WORKFLOW_OPTIMIZE", "1") != "0"
+
+# 지원 노드만 있는 워크플로우(KSampler/CheckpointLoaderSimple 등)를 ComfyUI 없이 프록시 프로세스에서 diffusers 로 실행
+# torch/diffusers 가 필요하므로 NATIVE_EXECUTOR=1 일 때만 로드
+NATIVE_EXECUTOR = os.getenv("NATIVE_EXECUTOR", "0") == "1"
+NATIVE_BACKEND = "native"
+# 직접 실행 동시 수 (GraphExecutor 는 한 번에 한 그래프만 실행, 나머지는 실행 스레드를 잡지 않고 공정 큐에서 대기)
+NATIVE_CONCURRENCY = int(os.getenv("NATIVE_CONCURRENCY", "1"))
+
+# 요청 추적 (샘플링 비율, 메모리 보관 개수, JSONL 저장 경로)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", "200"))
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+# 관리 API (/api/admin/*) 토큰, X-Admin-Token 헤더로 전달 (설정하지 않으면 관리 API 사용 불가)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# 같은 요청 합치기: 완료 이벤트를 놓쳤을 때 합류 대상으로 유지하는 최대 시간 (초)
+DEDUPE_HOLD_TIMEOUT = float(os.getenv("DEDUPE_HOLD_TIMEOUT", "600"))
+
+# 진행 이벤트가 이 시간(초) 동안 없으면 히스토리/큐를 조회해 완료 여부 확인 (업스트림 재연결 중 완료 이벤트 유실 대비)
+MONITOR_EVENT_TIMEOUT = float(os.getenv("MONITOR_EVENT_TIMEOUT", "30"))
+
+# 배치 요청 한도 / 같은 프롬프트를 한 그래프(batch_size)로 묶는 최대 개수 / 결과 대기 시간
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "64"))
+MAX_GRAPH_BATCH = int(os.getenv("MAX_GRAPH_BATCH", "8"))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", "600"))
+# 상태를 조회할 수 있는 최근 배치 수
+MAX_BATCHES = 256
+
+# 샘플링 미리보기 기본 설정 (클라이언트가 preview_settings 메시지로 변경 가능, PREVIEW_SIZE=0 은 원본 크기)
+PREVIEW_MAX_FPS = float(os.getenv("PREVIEW_MAX_FPS", "4"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "0"))
+PREVIEW_MAX_PENDING = int(os.getenv("PREVIEW_MAX_PENDING", "4"))
+
+# ComfyUI 백엔드 풀 (백엔드별 HTTP 커넥션 풀, 공유 업스트림 웹소켓, 큐 기반 입장 제어)
+# ADMISSION_MODE=reject|defer
+pool = BackendPool(
+    COMFY_SERVERS,
+    admission_options={
+        "max_wait": float(os.getenv("MAX_QUEUE_WAIT", "300")),
+        "mode": os.getenv("ADMISSION_MODE", "reject"),
+        "defer_timeout": float(os.getenv("ADMISSION_DEFER_TIMEOUT", "60")),
+    },
+    ws_pool_size=int(os.getenv("COMFY_WS_POOL", "1")),
+)
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_BUFFER, TRACE_FILE or None)
+
+# 웹소켓으로 받은 최종 이미지 집계 (OUTPUT_DELIVERY=websocket)
+deliveries = DeliveryStats()
+
+native = None
+if NATIVE_EXECUTOR:
+    from graphExecutor import GraphExecutor
+    native = GraphExecutor()
+
+# ComfyUI 노드 출력 캐시 적중률 (execution_cached 이벤트)
+cache_stats = CacheStats()
+for _backend in pool.backends.values():
+    _backend.hub.add_listener(cache_stats.on_message)
+
+# 같은 그래프(시드 포함)가 대기/실행 중이면 새로 제출하지 않고 그 프롬프트에 합류
+# 시드를 지정하지 않은 요청은 무작위 시드가 들어가므로 합쳐지지 않음
+dedupe = SingleFlight(DEDUPE_HOLD_TIMEOUT)
+# batch_id -> 배치 상태 (최근 MAX_BATCHES 개)
+batches = OrderedDict()
+# prompt_id -> 합류 키 (실행이 끝나면 해제)
+dedupe_keys = {}
+# 제출 기록 중에 끝난 프롬프트 확인용
+finished_prompts = deque(maxlen=256)
+
+def release_dedupe(message):
+    message_type = message.get("type")
+    data = message.get("data") or {}
+    if message_type in ("execution_error", "execution_interrupted") or (
+        message_type == "executing" and data.get("node") is None
+    ):
+        finished_prompts.append(data.get("prompt_id"))
+        key = dedupe_keys.pop(data.get("prompt_id"), None)
+        if key is not None:
+            dedupe.release(key)
+
+for _backend in pool.backends.values():
+    _backend.hub.add_listener(release_dedupe)
+
+# 클라이언트별 공정 큐 (ComfyUI 에는 백엔드당 FAIR_WINDOW 개까지만 올리고 나머지는 프록시에서 가중치 비율대로 차례를 기다림)
+fairness = FairQueue(FAIR_WINDOW * len(pool.backends))
+for _backend in pool.backends.values():
+    _backend.hub.add_listener(fairness.on_message)
+# 직접 실행도 같은 등급 가중치로 차례를 정함 (동시 실행 NATIVE_CONCURRENCY 개)
+native_fairness = FairQueue(NATIVE_CONCURRENCY)
+
+
+# 관리 API 인증 (브라우저 클라이언트가 자기 등급을 올리거나 트레이스로 다른 사용자 요청을 보지 못하도록)
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="관리 API가 비활성화되어 있습니다. (ADMIN_TOKEN 미설정)")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="관리자 토큰이 올바르지 않습니다.")
+
+
+# /api 요청별 트레이스 (X-Trace: 1 헤더면 항상 기록, 응답 헤더 X-Trace-Id)
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    path = request.url.path
+    if not path.startswith("/api/") or path.startswith("/api/admin/"):
+        return await call_next(request)
+    root = tracer.start(f"{request.method} {path}", force=request.headers.get("x-trace") == "1")
+    with tracer.use(root):
+        try:
+            response = await call_next(request)
+        except Exception as e:
+            root.end(error=e)
+            raise
+    root.set(status_code=response.status_code)
+    if root.sampled:
+        response.headers["X-Trace-Id"] = root.trace.trace_id
+    root.end(error=f"HTTP {response.status_code}" if response.status_code >= 500 else None)
+    return response
+
+
+@app.on_event("startup")
+async def startup():
+    pool.set_notify(notify_client)
+    await pool.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await pool.stop()
+    generations.close()
+
 
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
-        self.comfy_connections: Dict[str, ws_client.WebSocket] = {}
+        self.previews: Dict[str, PreviewChannel] = {}
+        # 연결별 전송 중인 메시지 수 (느린 클라이언트 감지)
+        self.sending: Dict[str, int] = {}
 
     async def connect(self, websocket: WebSocket, client_id: str):
         await websocket.accept()
         self.active_connections[client_id] = websocket
+        channel = PreviewChannel(self, client_id, PREVIEW_MAX_FPS, PREVIEW_SIZE, PREVIEW_MAX_PENDING)
+        channel.start()
+        self.previews[client_id] = channel
 
-        # 웹소켓 연결
-        try: 
-            comfy_ws = ws_client.create_connection(f"{COMFY_WS}?clientId={client_id}")
-            self.comfy_connections[client_id] = comfy_ws
-            return True
-        except Exception as e:
-            print("CompyUI 웹 소켓 연결 오류:", {str(e)})
-            return False
+        # 업스트림 웹소켓은 모든 클라이언트가 공유
+        return await pool.wait_connected()
 
     def disconnect(self, client_id: str):
         if client_id in self.active_connections:
             del self.active_connections[client_id]
-        
-        if client_id in self.comfy_connections:
-            try:
-                self.comfy_connections[client_id].close()
-            except:
-                pass
-            del self.comfy_connections[client_id]
+        channel = self.previews.pop(client_id, None)
+        if channel is not None:
+            asyncio.ensure_future(channel.close())
+
+    def pending(self, client_id: str):
+        return self.sending.get(client_id, 0)
 
     async def send_message(self, client_id: str, message: str):
         if client_id in self.active_connections:
+            self.sending[client_id] = self.sending.get(client_id, 0) + 1
             try:
                 await self.active_connections[client_id].send_text(message)
             except Exception as e:
                 print(f"메시지 전송 오류: {str(e)}")
                 self.disconnect(client_id)
+            finally:
+                self._sent(client_id)
     
     async def send_bytes(self, client_id: str, data: bytes):
         if client_id in self.active_connections:
+            self.sending[client_id] = self.sending.get(client_id, 0) + 1
             try:
                 await self.active_connections[client_id].send_bytes(data)
             except Exception as e:
                 print(f"바이너리 데이터 전송 오류: {str(e)}")
                 self.disconnect(client_id)
-    
-    def get_comfy_ws(self, client_id: str):
-        return self.comfy_connections.get(client_id)
+            finally:
+                self._sent(client_id)
+
+    def _sent(self, client_id: str):
+        count = self.sending.get(client_id, 1) - 1
+        if count > 0:
+            self.sending[client_id] = count
+        else:
+            self.sending.pop(client_id, None)
+
+    def offer_preview(self, client_id: str, data: bytes, meta: Dict[str, Any]):
+        channel = self.previews.get(client_id)
+        if channel is not None:
+            channel.offer(data, meta)
+
+    def discard_previews(self, client_id: str, prompt_id: str):
+        channel = self.previews.get(client_id)
+        if channel is not None:
+            channel.discard(prompt_id)
+
+    def preview_stats(self):
+        return {
+            "clients": len(self.previews),
+            "sent": sum(c.sent for c in self.previews.values()),
+            "dropped": sum(c.dropped for c in self.previews.values()),
+        }
 
 manager = ConnectionManager()
 
+
+async def notify_client(client_id: str, payload: Dict[str, Any]):
+    await manager.send_message(client_id, json.dumps(payload))
+
 class PromptRequest(BaseModel):
     # prompt: Dict[str, Any]
     prompt_text: str  # 텍스트 프롬프트
     workflow_name: str = "default" 
     client_id: Optional[str] = None
     seed: Optional[int] = None  # 옵션: 시드값
+    negative_prompt: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    batch_size: Optional[int] = None
+    # 필요한 출력 노드 (노드 id 또는 class_type, 예: ["SaveImage"]), 나머지 출력만 쓰는 노드는 실행하지 않음
+    outputs: Optional[List[str]] = None
+
+
+class BatchItem(BaseModel):
+    prompt_text: str
+    seed: Optional[int] = None
+    negative_prompt: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    workflow_name: str = "default"
+    client_id: Optional[str] = None
+    # True 면 시드를 지정한 항목은 묶지 않고 각각 제출 (시드 그대로 재현 가능)
+    exact_seeds: bool = False
+    # True 면 모든 결과가 나올 때까지 기다렸다가 한 번에 응답
+    wait: bool = False
+    outputs: Optional[List[str]] = None
 
 
 workflow_dir = "workflowJSON"
 os.makedirs(workflow_dir, exist_ok=True)
 
+# 워크플로우는 시작 시 한 번 로드, 파일이 바뀌면 자동 재로드
+templates = TemplateStore(workflow_dir)
+
 
 def load_workflow(workflow_name="default"):
-    workflow_path = os.path.join(workflow_dir, f"{workflow_name}.json")
+    try:
+        return templates.get(workflow_name)
+    except KeyError:
+        if workflow_name in templates.errors:
+            raise HTTPException(status_code=500, detail=f"워크플로우 로드 오류: {templates.errors[workflow_name]}")
+        raise HTTPException(status_code=404, detail=f"워크플로우 '{workflow_name}'를 찾을 수 없습니다.")
+
 
+# 요청 파라미터를 슬롯에 적용한 워크플로우 생성 (시드가 없으면 랜덤)
+def build_workflow(workflow_name, prompt_text, seed=None, negative_prompt=None, width=None, height=None, batch_size=None,
+                   outputs=None):
+    template = load_workflow(workflow_name)
+    if seed is None:
+        seed = random.randint(1, 9999999999)
+    with tracer.span("workflow.build", workflow=workflow_name):
+        try:
+            workflow = template.render(
+                prompt=prompt_text,
+                negative=negative_prompt,
+                seed=seed,
+                width=width,
+                height=height,
+                batch=batch_size,
+            )
+            # 요청한 출력에 필요한 노드만 남기고, 캐시 키가 요청마다 달라지지 않도록 정리
+            if WORKFLOW_OPTIMIZE:
+                workflow = optimize(workflow, outputs)
+            elif outputs:
+                workflow = prune(workflow, outputs)
+        except (WorkflowError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return workflow, seed
+
+
+# CompyUI에 이미지 생성 요청 (이벤트는 공유 업스트림 client_id 로 수신)
+async def queue_prompt(backend, prompt):
+    with tracer.span("comfy.queue_prompt", backend=backend.name) as span:
+        result = await backend.client.queue_prompt(prompt, backend.hub.submit_client_id())
+        span.set(prompt_id=result["prompt_id"])
+        return result
+
+# 이미지 캐시 키 (filename, subfolder, type, backend[, prompt_id])
+def image_key(filename, subfolder, folder_type, backend_name, prompt_id=None):
+    key = (filename, subfolder, folder_type, backend_name)
+    return key + (prompt_id,) if prompt_id else key
+
+# 이미지 가져오기 (캐시 키 앞 4개 = (filename, subfolder, type, backend))
+# 프록시가 저장한 출력 이미지(웹소켓 전달, 직접 실행 결과)는 ComfyUI 에 없으므로 출력 디렉터리에서 읽음
+async def fetch_image(key, sink):
+    filename, subfolder, folder_type, backend_name = key[:4]
+    path = output_path(filename) if folder_type == "output" and not subfolder else None
+    if path is not None:
+        with open(path, "rb") as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, 64 * 1024)
+                if not chunk:
+                    break
+                await sink(chunk)
+        return output_media_type(filename)
+    if backend_name == NATIVE_BACKEND:
+        raise HTTPException(status_code=404, detail="이미지를 찾을 수 없습니다.")
+    with tracer.span("comfy.view", backend=backend_name, filename=filename):
+        return await pool.get(backend_name).client.stream_view(filename, subfolder, folder_type, sink)
+
+# ComfyUI 히스토리 데이터 가져오기 (프롬프트를 처리한 백엔드, 모르면 전체 조회)
+async def fetch_comfy_history(prompt_id):
+    backend = pool.for_prompt(prompt_id)
+    if backend is not None:
+        with tracer.span("comfy.history", backend=backend.name, prompt_id=prompt_id):
+            return await backend.client.get_history(prompt_id)
+    for backend in pool.backends.values():
+        try:
+            with tracer.span("comfy.history", backend=backend.name, prompt_id=prompt_id):
+                history = await backend.client.get_history(prompt_id)
+        except HTTPException:
+            continue
+        if prompt_id in history:
+            pool.bind(prompt_id, backend)
+            return history
+    return {}
+
+# 히스토리 데이터 가져오기 (색인에 있으면 색인에서, 없으면 ComfyUI 조회 후 완료된 항목은 색인에 기록)
+async def fetch_history(prompt_id):
+    with tracer.span("history.index", prompt_id=prompt_id) as span:
+        entry = await asyncio.to_thread(generations.history, prompt_id)
+        span.set(found=entry is not None)
+    if entry is not None:
+        return {prompt_id: entry}
+    history = await fetch_comfy_history(prompt_id)
+    entry = history.get(prompt_id)
+    if entry and entry.get("status", {}).get("completed"):
+        backend = pool.for_prompt(prompt_id) or pool.default
+        await asyncio.to_thread(generations.record_completed, prompt_id, entry, output_files(entry), None, backend.name)
+    return history
+
+# 완료된 프롬프트를 색인에 기록하고 히스토리 항목 반환
+# outputs 는 executed 이벤트로 받은 노드별 출력, 없으면 ComfyUI 히스토리 조회
+# record=False 는 다른 요청이 제출한 프롬프트에 합류한 경우 (기록은 제출한 쪽에서)
+# lookup=False 면 출력이 없어도 히스토리를 조회하지 않음 (이미지를 웹소켓으로 받은 경우)
+async def complete_generation(prompt_id, backend, outputs, error=None, record=True, lookup=True):
+    entry = {"outputs": outputs}
+    if not outputs and error is None and lookup:
+        history = await fetch_comfy_history(prompt_id)
+        if prompt_id in history:
+            entry = history[prompt_id]
+            if record:
+                backend.admission.learn_from_history(prompt_id, entry)
+    if record:
+        await asyncio.to_thread(generations.record_completed, prompt_id, entry, output_files(entry), error, backend.name)
+    return entry
+
+def output_files(entry):
+    return [
+        {"node": node_id, "filename": image["filename"], "subfolder": image["subfolder"], "type": image["type"]}
+        for node_id, output in entry.get("outputs", {}).items()
+        for image in output.get("images", [])
+    ]
+
+# 백엔드 선택 및 대기열 확인 후 제출, 예상 대기 시간/큐 위치 포함 결과 반환
+# meta: 색인에 기록할 요청 정보 (prompt_text, negative_prompt, seed, batch_size)
+async def submit_prompt(workflow, workflow_name, client_id=None, meta=None):
+    # 공정 큐에서 차례를 기다린 뒤 제출 (비용 = 워크플로우 예상 실행 시간)
+    cost = pool.default.admission.estimate_duration(workflow_name)
+    with tracer.span("fair_queue.wait", client_id=client_id) as span:
+        ticket = await fairness.acquire(client_id, cost)
+        span.set(cost=round(cost, 2))
     try:
-        if os.path.exists(workflow_path):
-            with open(workflow_path, 'r', encoding="utf-8") as f:
-                return json.load(f)
+        backend = pool.choose(workflow)
+        with tracer.span("admission.admit", backend=backend.name) as span:
+            span.set(estimated_wait=await backend.admission.admit(workflow_name))
+        try:
+            result = await queue_prompt(backend, workflow)
+        except HTTPException as e:
+            if e.status_code == 502:
+                pool.report_failure(backend, e.detail)
+            raise
+    except BaseException:
+        fairness.cancel(ticket)
+        raise
+    fairness.bind(ticket, result["prompt_id"])
+    if result["prompt_id"] in finished_prompts:
+        # 제출 응답 전에 실행이 끝남 (전체 캐시 적중 등)
+        fairness.finish(result["prompt_id"])
+    pool.report_success(backend)
+    pool.bind(result["prompt_id"], backend, workflow)
+    queue_info = backend.admission.track(result["prompt_id"], workflow_name, client_id)
+    await asyncio.to_thread(
+        generations.record_submitted, result["prompt_id"], backend.name, workflow_name, client_id, **(meta or {})
+    )
+    return {**result, **queue_info, "backend": backend.name}
+
+# 같은 그래프가 대기/실행 중이면 그 prompt_id 반환, 반환: (결과, 합류 여부)
+async def submit_deduped(workflow, workflow_name, client_id=None, meta=None):
+    key = request_key("comfy", workflow_name, workflow)
+
+    async def submit():
+        result = await submit_prompt(workflow, workflow_name, client_id, meta)
+        if result["prompt_id"] in finished_prompts:
+            # 제출 기록 중에 이미 실행이 끝남
+            dedupe.release(key)
         else:
-            raise HTTPException(status_code=404, detail=f"워크플로우 '{workflow_name}'를 찾을 수 없습니다.")
-    except Exception as e:
-        print(f"워크플로우 로드 오류: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"워크플로우 로드 오류: {str(e)}")
+            dedupe_keys[result["prompt_id"]] = key
+        return result
 
+    result, merged = await dedupe.run(key, submit, hold=True)
+    if merged and result["prompt_id"] not in dedupe_keys:
+        # 합류한 프롬프트가 그 사이에 끝났으면 (완료 이벤트를 받을 수 없으므로) 새로 제출
+        return await submit_prompt(workflow, workflow_name, client_id, meta), False
+    return result, merged
 
-# CompyUI에 이미지 생성 요청
-def queue_prompt(prompt, client_id=None):
-    if not client_id:
-        client_id = str(uuid.uuid4())
-    
-    p = {
-        "prompt": prompt,
-        "client_id": client_id
-    }
-    
-    data = json.dumps(p).encode("utf-8")
-    req = urllib.request.Request(f"{COMFY_SERVER}/prompt", data=data, method="POST")
+# 결과 이미지 프록시 URL
+def image_url(image, prompt_id, backend_name):
+    query = urllib.parse.urlencode({
+        "filename": image["filename"],
+        "subfolder": image["subfolder"],
+        "type": image["type"],
+        "prompt_id": prompt_id,
+        "backend": backend_name,
+    })
+    return f"/api/image?{query}"
 
-    try:
-        with urllib.request.urlopen(req) as res:
-            return json.loads(res.read())
-    except Exception as e:
-        # 에러 발생
-        raise HTTPException(status_code=500, detail=f"ComfyUI 서버 오류: {str(e)}")
+# 히스토리 출력에서 노드별 결과 이미지 목록 (클라이언트 요청 전에 캐시 채우기)
+def result_images(prompt_id, backend, entry):
+    outputs = {}
+    for node_id, output in entry.get("outputs", {}).items():
+        for image in output.get("images", []):
+            if image["type"] == "output":
+                image_cache.prefetch(image_key(image["filename"], image["subfolder"], image["type"], backend.name, prompt_id))
+            outputs.setdefault(node_id, []).append({
+                "filename": image["filename"],
+                "subfolder": image["subfolder"],
+                "type": image["type"],
+                "url": image_url(image, prompt_id, backend.name)
+            })
+    return outputs
+
+# 프록시 프로세스에서 직접 실행 (큐/파일 저장/view 요청 없이 메모리의 이미지를 캐시에 바로 넣음)
+def native_supports(workflow):
+    return native is not None and native.supports(workflow)
+
+def encode_png(image):
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+async def run_native(workflow, workflow_name, client_id=None, meta=None, prompt_id=None):
+    prompt_id = prompt_id or f"native-{uuid.uuid4()}"
+    loop = asyncio.get_running_loop()
+
+    def emit(message_type, data):
+        # 실행 스레드 -> 이벤트 루프
+        if client_id and message_type == "progress":
+            asyncio.run_coroutine_threadsafe(notify_client(client_id, {
+                "type": "progress",
+                "prompt_id": prompt_id,
+                "node": data["node"],
+                "progress": int((data["value"] / data["max"]) * 100),
+                "node_info": {"step": data["value"], "steps": data["max"]}
+            }), loop)
 
-# 이미지 가져오기
-def fetch_image(filename, subfolder, folder_type):
+    with tracer.span("fair_queue.wait", client_id=client_id, backend=NATIVE_BACKEND):
+        ticket = await native_fairness.acquire(client_id, pool.default.admission.estimate_duration(workflow_name))
+    native_fairness.bind(ticket, prompt_id)
     try:
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(f"{COMFY_SERVER}/view?{url_values}") as response:
-            return response.read()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"이미지 가져오기 오류: {str(e)}")
-        
-# 히스토리 데이터 가져오기
-def fetch_history(prompt_id):
+        await asyncio.to_thread(generations.record_submitted, prompt_id, NATIVE_BACKEND, workflow_name, client_id, **(meta or {}))
+        await asyncio.to_thread(generations.record_started, prompt_id)
+        try:
+            with tracer.span("native.execute", prompt_id=prompt_id) as span:
+                result = await asyncio.to_thread(native.execute, workflow, emit)
+                span.set(cached_nodes=result["cached"])
+        except Exception as e:
+            entry = {"outputs": {}, "status": {"status_str": "error", "completed": False, "messages": []}}
+            await asyncio.to_thread(generations.record_completed, prompt_id, entry, [], str(e), NATIVE_BACKEND)
+            raise
+    finally:
+        native_fairness.finish(prompt_id)
+
+    outputs = {}
+    images = []
+    for node_id, node_images in result["outputs"].items():
+        for index, image in enumerate(node_images):
+            info = {"filename": f"{prompt_id}_{node_id}_{index:05}.png", "subfolder": "", "type": "output"}
+            data = await asyncio.to_thread(encode_png, image)
+            await asyncio.to_thread(save_output, info["filename"], data)
+            await image_cache.put_bytes_async((info["filename"], "", "output", NATIVE_BACKEND), data, "image/png")
+            outputs.setdefault(node_id, {"images": []})["images"].append(info)
+            images.append({**info, "url": image_url(info, prompt_id, NATIVE_BACKEND)})
+
+    entry = {"outputs": outputs, "status": {"status_str": "success", "completed": True, "messages": []}}
+    await asyncio.to_thread(generations.record_completed, prompt_id, entry, output_files(entry), None, NATIVE_BACKEND)
+    return {"prompt_id": prompt_id, "backend": NATIVE_BACKEND, "images": images, "cached_nodes": result["cached"]}
+
+# 같은 그래프를 실행 중이면 그 결과를 함께 받음, 반환: (결과, 합류 여부)
+async def run_native_deduped(workflow, workflow_name, client_id=None, meta=None, prompt_id=None):
+    key = request_key(NATIVE_BACKEND, workflow_name, workflow)
+    return await dedupe.run(key, lambda: run_native(workflow, workflow_name, client_id, meta, prompt_id))
+
+# 웹소켓 클라이언트용 (ComfyUI 경로와 같은 메시지 순서)
+async def run_native_for_client(client_id, workflow, workflow_name, seed, meta, trace=NOOP):
+    prompt_id = f"native-{uuid.uuid4()}"
     try:
-        with urllib.request.urlopen(f"{COMFY_SERVER}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+        await manager.send_message(client_id, json.dumps({
+            "type": "prompt_queued",
+            "prompt_id": prompt_id,
+            "backend": NATIVE_BACKEND,
+            "position": 0,
+            "estimated_wait": 0
+        }))
+        # 합류한 경우 이미지는 먼저 실행한 요청의 결과
+        result, merged = await run_native_deduped(workflow, workflow_name, client_id, meta, prompt_id)
+        await manager.send_message(client_id, json.dumps({"type": "execution_complete", "prompt_id": prompt_id}))
+        await manager.send_message(client_id, json.dumps({
+            "type": "result",
+            "prompt_id": prompt_id,
+            "seed": seed,
+            "images": result["images"],
+            "merged": merged
+        }))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"히스토리 데이터 가져오기 오류: {str(e)}")
+        print(f"직접 실행 오류: {str(e)}")
+        trace.end(error=e)
+        await manager.send_message(client_id, json.dumps({
+            "type": "error",
+            "prompt_id": prompt_id,
+            "message": f"직접 실행 오류: {str(e)}"
+        }))
+    finally:
+        trace.end()
 
 # 엔드포인트
 # 이미지 생성
 @app.post('/api/generate-image')
 async def generate_image(request: PromptRequest):
     try:
-        # 워크플로우 로드
-        workflow = load_workflow(request.workflow_name)
-        
-        # 프롬프트 텍스트 적용
-        workflow["12"]["inputs"]["text"] = request.prompt_text
-        
-        # 시드 설정 (제공된 경우)
-        if request.seed is not None:
-            workflow["37"]["inputs"]["noise_seed"] = request.seed
-        else:
-            # 랜덤 시드 생성
-            workflow["37"]["inputs"]["noise_seed"] = random.randint(1, 9999999999)
+        # 워크플로우 로드 및 프롬프트/시드 적용
+        workflow, seed = build_workflow(
+            request.workflow_name,
+            request.prompt_text,
+            seed=request.seed,
+            negative_prompt=request.negative_prompt,
+            width=request.width,
+            height=request.height,
+            batch_size=request.batch_size,
+            outputs=request.outputs,
+        )
         
         print(f"워크플로우 로드: {request.workflow_name}, 프롬프트: {request.prompt_text}")
+        meta = {
+            "prompt_text": request.prompt_text,
+            "negative_prompt": request.negative_prompt,
+            "seed": seed,
+            "batch_size": request.batch_size,
+        }
+
+        # 지원 노드만 있으면 직접 실행 후 결과 이미지까지 반환
+        if native_supports(workflow):
+            result, merged = await run_native_deduped(workflow, request.workflow_name, request.client_id, meta)
+            return {**result, "seed": seed, "merged": merged}
         
-        # ComfyUI에 요청 보내기
-        client_id = request.client_id or f"api_{uuid.uuid4()}"
-        result = queue_prompt(workflow, client_id)
-        return result
+        # ComfyUI에 요청 보내기 (같은 그래프가 대기/실행 중이면 그 prompt_id)
+        result, merged = await submit_deduped(workflow, request.workflow_name, request.client_id, meta)
+        return {**result, "seed": seed, "merged": merged}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"이미지 생성 오류: {str(e)}")
 
+# 워크플로우 목록 및 슬롯 정보
+@app.get('/api/workflows')
+async def list_workflows():
+    return {
+        "workflows": [templates.get(name).describe() for name in templates.names()],
+        "errors": templates.errors,
+    }
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MB * 1024 * 1024, fetch_image)
+generations = GenerationIndex(GENERATION_DB)
+
+
 # 이미지 미리보기
+# output 이미지는 디스크 캐시에서 ETag/Range 로 제공, temp/input 은 덮어쓰일 수 있어 그대로 스트리밍
 @app.get('/api/image')
-async def get_image_preview(filename: str, subfolder: str = "", folder_type: str = "output"):
+async def get_image_preview(
+    request: Request,
+    filename: str,
+    subfolder: str = "",
+    folder_type: str = "output",
+    image_type: Optional[str] = Query(None, alias="type"),
+    thumb: Optional[int] = None,
+    prompt_id: Optional[str] = None,
+    backend: Optional[str] = None,
+):
+    folder_type = image_type or folder_type
+    if backend == NATIVE_BACKEND:
+        # 직접 실행 결과는 출력 디렉터리에 저장 (캐시에서 밀려나면 출력 디렉터리에서 다시 읽음)
+        key = (filename, subfolder, folder_type, NATIVE_BACKEND)
+        entry = await image_cache.thumbnail(key, thumb) if thumb else await image_cache.fetch(key)
+        return serve_cached(entry, request, "public, max-age=31536000, immutable")
+
+    # 프롬프트를 처리한 백엔드에서 조회
+    # ComfyUI 는 카운터가 초기화되면 같은 파일 이름을 다시 쓰므로 캐시 키에 prompt_id 포함
+    # prompt_id 가 없는 URL 은 내용이 바뀔 수 있어 매번 ETag 로 재검증
+    source = (pool.for_prompt(prompt_id) if prompt_id else None) or pool.get(backend)
+    key = image_key(filename, subfolder, folder_type, source.name, prompt_id)
+    cache_control = "public, max-age=31536000, immutable" if prompt_id else "no-cache"
     try:
-        print("이미지 요청:", filename, subfolder, folder_type)
-        image_data = fetch_image(filename, subfolder, folder_type)
-        return Response(content=image_data, media_type="image/png")
+        if folder_type != "output":
+            res = await source.client.open_view(filename, subfolder, folder_type)
+            return StreamingResponse(
+                res.aiter_bytes(),
+                media_type=res.headers.get("content-type", "image/png"),
+                headers={"Cache-Control": "no-cache"},
+                background=BackgroundTask(res.aclose),
+            )
+
+        with tracer.span("image_cache.fetch", filename=filename, thumb=thumb, cached=key in image_cache.entries):
+            if thumb:
+                entry = await image_cache.thumbnail(key, thumb)
+            else:
+                entry = await image_cache.fetch(key)
+        return serve_cached(entry, request, cache_control)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"이미지 호출 오류: {str(e)}")
         raise HTTPException(status_code=500, detail=f"이미지 호출 오류: {str(e)}")
@@ -184,7 +698,7 @@ async def get_image_preview(filename: str, subfolder: str = "", folder_type: str
 async def get_prompt_history(prompt_id: str):
     try:
         
-        history_data = fetch_history(prompt_id)
+        history_data = await fetch_history(prompt_id)
         print("히스토리 데이터", history_data)
         return history_data
     except Exception as e:
@@ -202,6 +716,7 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             "message": "ComfyUI 서버에 연결할 수 없습니다."
         }))
         await websocket.close(1011, "ComfyUI 서버 연결 실패")
+        manager.disconnect(client_id)
         return
     
     # 연결 성공 메시지 전송
@@ -220,32 +735,34 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             
             # 메시지 유형에 따라 처리
             if request_data.get("type") == "prompt":
-                # 워크플로우 로드
-                workflow = load_workflow(request_data.get("workflow_name", "default"))
-                
-                # 프롬프트 텍스트 적용
-                workflow["12"]["inputs"]["text"] = request_data.get("prompt_text", "")
-                
-                # 시드 설정
-                seed = request_data.get("seed")
-                if seed is not None:
-                    workflow["37"]["inputs"]["noise_seed"] = seed
-                else:
-                    # 랜덤 시드 생성
-                    workflow["37"]["inputs"]["noise_seed"] = random.randint(1, 9999999999)
-                
-                # ComfyUI에 요청 보내기
-                result = queue_prompt(workflow, client_id)
-                prompt_id = result["prompt_id"]
-                
-                # 프롬프트 ID 전송
-                await manager.send_message(client_id, json.dumps({
-                    "type": "prompt_queued",
-                    "prompt_id": prompt_id
-                }))
-                
-                # ComfyUI 웹소켓에서 상태 모니터링
-                asyncio.create_task(monitor_prompt_progress(client_id, prompt_id))
+                # 요청 추적 (샘플링, trace: true 면 항상 기록)
+                root = tracer.start(
+                    "ws prompt",
+                    force=bool(request_data.get("trace")),
+                    client_id=client_id,
+                    workflow=request_data.get("workflow_name", "default"),
+                )
+                with tracer.use(root):
+                    try:
+                        await handle_prompt_message(client_id, request_data, root)
+                    except Exception as e:
+                        root.end(error=e)
+                        raise
+
+            elif request_data.get("type") == "batch":
+                # 배치 제출 (항목별 진행률/결과는 batch_* 메시지로 전송, 그래프 생성 중에도 다른 메시지 처리)
+                asyncio.create_task(handle_batch_message(client_id, request_data))
+
+            elif request_data.get("type") == "preview_settings":
+                # 미리보기 설정 (enabled, max_fps, size)
+                channel = manager.previews.get(client_id)
+                if channel is not None:
+                    settings = channel.configure(
+                        enabled=request_data.get("enabled"),
+                        max_fps=request_data.get("max_fps"),
+                        size=request_data.get("size"),
+                    )
+                    await manager.send_message(client_id, json.dumps({"type": "preview_settings", **settings}))
                 
     except WebSocketDisconnect:
         # 연결 해제
@@ -262,23 +779,208 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             pass
         manager.disconnect(client_id)
 
-async def monitor_prompt_progress(client_id: str, prompt_id: str):
-    comfy_ws = manager.get_comfy_ws(client_id)
-    if not comfy_ws:
+# 웹소켓 prompt 메시지 처리 (trace 는 완료 시점에 monitor/직접 실행 쪽에서 종료)
+async def handle_prompt_message(client_id: str, request_data: Dict[str, Any], trace):
+    # 워크플로우 로드 및 프롬프트/시드 적용
+    workflow, seed = build_workflow(
+        request_data.get("workflow_name", "default"),
+        request_data.get("prompt_text", ""),
+        seed=request_data.get("seed"),
+        negative_prompt=request_data.get("negative_prompt"),
+        width=request_data.get("width"),
+        height=request_data.get("height"),
+        batch_size=request_data.get("batch_size"),
+        outputs=request_data.get("outputs"),
+    )
+    # 최종 이미지 전달 방식 (disk: SaveImage 저장 후 /view 조회, websocket: 바이너리 채널로 바로 수신)
+    delivery = request_data.get("delivery") or OUTPUT_DELIVERY
+    if delivery not in DELIVERY_MODES:
+        raise HTTPException(status_code=400, detail=f"알 수 없는 전달 방식: {delivery} (가능: {', '.join(DELIVERY_MODES)})")
+    meta = {
+        "prompt_text": request_data.get("prompt_text", ""),
+        "negative_prompt": request_data.get("negative_prompt"),
+        "seed": seed,
+        "batch_size": request_data.get("batch_size"),
+    }
+
+    if native_supports(workflow):
+        asyncio.create_task(run_native_for_client(
+            client_id, workflow, request_data.get("workflow_name", "default"), seed, meta, trace
+        ))
+        return
+    if delivery == "websocket":
+        workflow = websocket_outputs(workflow)
+    
+    # 공정 큐에서 차례를 기다리는 동안에도 이 연결의 다른 메시지를 처리하도록 제출은 별도 태스크에서
+    asyncio.create_task(submit_for_client(client_id, workflow, request_data.get("workflow_name", "default"), seed, meta, trace))
+
+# 웹소켓 batch 메시지 처리 (잘못된 요청은 연결을 끊지 않고 batch_error 로 응답)
+async def handle_batch_message(client_id: str, request_data: Dict[str, Any]):
+    root = tracer.start("ws batch", force=bool(request_data.get("trace")), client_id=client_id)
+    try:
+        with tracer.use(root):
+            batch = BatchRequest(**{**request_data, "client_id": client_id, "wait": False})
+            queued, _ = await start_batch(batch)
+    except ValidationError as e:
+        root.end(error=e)
+        await manager.send_message(client_id, json.dumps({"type": "batch_error", "message": str(e)}))
+        return
+    except HTTPException as e:
+        root.end(error=e.detail)
+        await manager.send_message(client_id, json.dumps({"type": "batch_error", "message": e.detail}))
+        return
+    except Exception as e:
+        print(f"배치 제출 오류: {str(e)}")
+        root.end(error=e)
+        await manager.send_message(client_id, json.dumps({"type": "batch_error", "message": str(e)}))
+        return
+    root.end()
+    await manager.send_message(client_id, json.dumps({"type": "batch_queued", **queued}))
+
+async def submit_for_client(client_id, workflow, workflow_name, seed, meta, trace=NOOP):
+    # ComfyUI에 요청 보내기 (대기열이 가득 차면 거절 메시지 전송, 같은 그래프가 대기/실행 중이면 합류)
+    try:
+        result, merged = await submit_deduped(workflow, workflow_name, client_id, meta)
+    except HTTPException as e:
+        trace.end(error=e.detail)
+        if e.status_code == 429:
+            await manager.send_message(client_id, json.dumps({
+                "type": "rejected",
+                "message": e.detail,
+                "retry_after": int(e.headers["Retry-After"])
+            }))
+        else:
+            await manager.send_message(client_id, json.dumps({"type": "error", "message": e.detail}))
+        return
+    except Exception as e:
+        print(f"프롬프트 제출 오류: {str(e)}")
+        trace.end(error=e)
+        await manager.send_message(client_id, json.dumps({"type": "error", "message": str(e)}))
         return
+    prompt_id = result["prompt_id"]
+    # 합류한 프롬프트의 완료 이벤트를 놓치지 않도록 바로 구독
+    events = pool.for_prompt(prompt_id).hub.subscribe(prompt_id)
+    
+    # 프롬프트 ID 전송
+    await manager.send_message(client_id, json.dumps({
+        "type": "prompt_queued",
+        "prompt_id": prompt_id,
+        "position": result["position"],
+        "estimated_wait": result["estimated_wait"],
+        "merged": merged
+    }))
+    
+    # ComfyUI 웹소켓에서 상태 모니터링
+    node_types = {node_id: node["class_type"] for node_id, node in workflow.items()}
+    asyncio.create_task(monitor_prompt_progress(client_id, prompt_id, seed, trace, node_types, events, merged))
+
+# 이벤트 대기 시간 초과 시 ComfyUI 에서 프롬프트 상태 확인, 끝났으면 완료/오류 이벤트를 만들어 반환
+# missing: 히스토리와 큐 모두에 없었던 연속 횟수 (두 번이면 유실로 처리)
+async def recover_prompt_event(backend, prompt_id, missing):
+    try:
+        history = await fetch_comfy_history(prompt_id)
+    except HTTPException as e:
+        # ComfyUI 에 연결할 수 없으면 다음 시간 초과 때 다시 확인
+        print(f"프롬프트 상태 조회 오류: {prompt_id}, {e.detail}")
+        return None, missing
+    entry = history.get(prompt_id)
+    message = None
+    if entry is not None:
+        status = entry.get("status", {})
+        if status.get("status_str") == "error":
+            error = next(
+                (data for name, data in status.get("messages", []) if name == "execution_error"), {}
+            )
+            message = {"type": "execution_error", "data": {
+                "prompt_id": prompt_id, "exception_message": error.get("exception_message", "")
+            }}
+        elif status.get("completed"):
+            message = {"type": "executing", "data": {"prompt_id": prompt_id, "node": None}}
+    elif backend.admission.position(prompt_id) is None:
+        missing += 1
+        if missing >= 2:
+            message = {"type": "execution_error", "data": {
+                "prompt_id": prompt_id, "exception_message": "ComfyUI 에서 프롬프트를 찾을 수 없습니다."
+            }}
+    else:
+        missing = 0
+    if message is not None:
+        print(f"완료 이벤트 유실, 상태 조회로 복구: {prompt_id} ({message['type']})")
+        # 완료 이벤트로 해제하는 합류/공정 큐 자리도 반환
+        release_dedupe(message)
+        fairness.on_message(message)
+    return message, missing
+
+async def monitor_prompt_progress(client_id: str, prompt_id: str, seed: Optional[int] = None, trace=NOOP,
+                                  node_types=None, events=None, merged=False):
+    # 프롬프트를 처리하는 백엔드의 공유 업스트림에서 이 프롬프트의 이벤트만 구독
+    # merged: 다른 요청이 제출한 프롬프트에 합류 (색인/대기 시간 학습은 제출한 쪽에서)
+    backend = pool.for_prompt(prompt_id)
+    if events is None:
+        events = backend.hub.subscribe(prompt_id)
+    # 대기열/노드 실행 스팬
+    timeline = NodeTimeline(trace, prompt_id, node_types)
+    # 웹소켓 출력 노드의 이미지는 최종 결과 (히스토리/view 조회 없이 바로 전달, 캐시 저장은 백그라운드)
+    delivery_nodes = websocket_nodes(node_types)
+    delivered = deliveries.capture(prompt_id, image_cache, backend.name) if delivery_nodes else None
+    delivery_nodes.add('save_image_websocket_node')
     
     try:
         # 초기 진행률 설정
         progress = 0
         current_node = ""
+        # executed 이벤트로 받은 노드별 출력 (완료 시 히스토리 조회 생략)
+        outputs = {}
+        
+        missing = 0
         
         # ComfyUI 웹소켓 메시지 수신
         while True:
             try:
-                out = comfy_ws.recv()
+                try:
+                    message = await asyncio.wait_for(events.get(), MONITOR_EVENT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    message, missing = await recover_prompt_event(backend, prompt_id, missing)
+                    if message is None:
+                        continue
                 
-                if isinstance(out, str):
-                    message = json.loads(out)
+                if message['type'] != 'binary':
+                    timeline.on_message(message)
+                    # 샘플링 스텝 진행률
+                    if message['type'] == 'progress':
+                        data = message['data']
+                        if data.get('max'):
+                            progress = int((data['value'] / data['max']) * 100)
+                        await manager.send_message(client_id, json.dumps({
+                            "type": "progress",
+                            "prompt_id": prompt_id,
+                            "node": data.get('node') or current_node,
+                            "progress": progress,
+                            "node_info": {"step": data['value'], "steps": data['max']}
+                        }))
+                        continue
+
+                    if message['type'] == 'execution_start':
+                        if not merged:
+                            await asyncio.to_thread(generations.record_started, prompt_id)
+                        continue
+
+                    if message['type'] == 'executed':
+                        data = message['data']
+                        if data.get('output'):
+                            outputs[data['node']] = data['output']
+                        continue
+
+                    # 실행 오류
+                    if message['type'] == 'execution_error':
+                        error_message = f"ComfyUI 처리 오류: {message['data'].get('exception_message', '')}"
+                        await complete_generation(prompt_id, backend, outputs, error=error_message, record=not merged)
+                        await manager.send_message(client_id, json.dumps({
+                            "type": "error",
+                            "prompt_id": prompt_id,
+                            "message": error_message
+                        }))
+                        break
                     
                     # 실행 상태 메시지 처리
                     if message['type'] == 'executing':
@@ -306,7 +1008,8 @@ async def monitor_prompt_progress(client_id: str, prompt_id: str):
                                     "node_info": node_info
                                 }))
                             else:
-                                # 실행 완료
+                                # 실행 완료 (남은 미리보기는 버림)
+                                manager.discard_previews(client_id, prompt_id)
                                 await manager.send_message(client_id, json.dumps({
                                     "type": "execution_complete",
                                     "prompt_id": prompt_id
@@ -314,30 +1017,19 @@ async def monitor_prompt_progress(client_id: str, prompt_id: str):
                                 
                                 # 이미지 결과 조회 및 전송
                                 try:
-                                    history = fetch_history(prompt_id)
+                                    if delivered is not None:
+                                        await delivered.wait()
+                                        outputs.update(delivered.outputs())
+                                    entry = await complete_generation(
+                                        prompt_id, backend, outputs, record=not merged, lookup=delivered is None
+                                    )
                                     
-                                    # 이미지 URL 및 시드값 추출
+                                    # 이미지 URL 추출 (시드값은 제출 시 적용한 값)
                                     image_urls = []
-                                    seed_value = None
+                                    seed_value = seed
                                     
-                                    if prompt_id in history:
-                                        prompt_history = history[prompt_id]
-                                        
-                                        # 시드값 찾기
-                                        if "prompt" in prompt_history and "37" in prompt_history["prompt"]:
-                                            seed_value = prompt_history["prompt"]["37"]["inputs"]["noise_seed"]
-                                        
-                                        # 이미지 찾기
-                                        if "outputs" in prompt_history:
-                                            for node_id, output in prompt_history["outputs"].items():
-                                                if "images" in output:
-                                                    for image in output["images"]:
-                                                        image_urls.append({
-                                                            "filename": image["filename"],
-                                                            "subfolder": image["subfolder"],
-                                                            "type": image["type"],
-                                                            "url": f"/api/image?filename={image['filename']}&subfolder={image['subfolder']}&type={image['type']}"
-                                                        })
+                                    for images in result_images(prompt_id, backend, entry).values():
+                                        image_urls.extend(images)
                                     
                                     # 결과 전송
                                     await manager.send_message(client_id, json.dumps({
@@ -358,19 +1050,28 @@ async def monitor_prompt_progress(client_id: str, prompt_id: str):
                                 break
                 else:
                     # 바이너리 데이터(미리보기 이미지) 처리
-                    if current_node == 'save_image_websocket_node':
-                        # 이미지 데이터를 클라이언트에 전송
-                        await manager.send_bytes(client_id, out)
+                    if current_node in delivery_nodes:
+                        # 최종 이미지는 버리거나 축소하지 않고 항상 전송
+                        manager.discard_previews(client_id, prompt_id)
+                        await manager.send_bytes(client_id, message['bytes'])
+                        captured = delivered.add(current_node, message['bytes']) if delivered is not None else None
                         
-                        # 이미지 미리보기 정보 전송
+                        # 이미지 미리보기 정보 전송 (final: 결과 이미지, index: 노드 내 배치 순서)
                         await manager.send_message(client_id, json.dumps({
                             "type": "preview",
                             "prompt_id": prompt_id,
-                            "node": current_node
+                            "node": current_node,
+                            "final": captured is not None,
+                            "index": captured[0]["index"] if captured else None
                         }))
+                    else:
+                        # 샘플링 중간 미리보기는 클라이언트별 채널로 (최신 프레임만, 최대 fps)
+                        manager.offer_preview(client_id, message['bytes'], {
+                            "type": "sampler_preview",
+                            "prompt_id": prompt_id,
+                            "node": current_node
+                        })
             
-            except ConnectionClosed:
-                break
             except Exception as e:
                 print(f"메시지 처리 오류: {str(e)}")
                 # 오류 전송
@@ -386,16 +1087,285 @@ async def monitor_prompt_progress(client_id: str, prompt_id: str):
             "type": "error",
             "message": f"모니터링 오류: {str(e)}"
         }))
+    finally:
+        backend.hub.unsubscribe(prompt_id, events)
+        timeline.close()
+        trace.end()
 
 
-@app.get('/api/status')
-async def check_status():
+# 배치 생성
+# 같은 프롬프트/옵션의 항목은 batch_size 로 한 그래프에 묶고, 그래프는 공정 큐에서 차례대로 제출
+def plan_batch(template, request: BatchRequest):
+    groups = {}
+    jobs = []
+    for index, item in enumerate(request.items):
+        if "batch" not in template.slots or (request.exact_seeds and item.seed is not None):
+            jobs.append({"items": [index], "item": item, "seed": item.seed})
+            continue
+        key = (normalize_text(item.prompt_text), item.negative_prompt, item.width, item.height)
+        job = groups.get(key)
+        if job is None or len(job["items"]) >= MAX_GRAPH_BATCH:
+            job = {"items": [], "item": item, "seed": item.seed}
+            groups[key] = job
+            jobs.append(job)
+        job["items"].append(index)
+    return jobs
+
+
+def build_batch_job(request: BatchRequest, job):
+    item = job["item"]
+    job["workflow"], job["seed"] = build_workflow(
+        request.workflow_name,
+        item.prompt_text,
+        seed=job["seed"],
+        negative_prompt=item.negative_prompt,
+        width=item.width,
+        height=item.height,
+        batch_size=len(job["items"]) if len(job["items"]) > 1 else None,
+        outputs=request.outputs,
+    )
+    job["node_types"] = {node_id: node["class_type"] for node_id, node in job["workflow"].items()}
+
+
+async def submit_batch_job(request: BatchRequest, job):
+    item = job["item"]
+    return await submit_prompt(job.pop("workflow"), request.workflow_name, request.client_id, {
+        "prompt_text": item.prompt_text,
+        "negative_prompt": item.negative_prompt,
+        "seed": job["seed"],
+        "batch_size": len(job["items"]),
+    })
+
+
+async def start_batch(request: BatchRequest):
+    # 그래프 생성까지만 하고 바로 반환, 제출은 백그라운드에서 공정 큐 차례대로 (항목 상태 waiting -> queued)
+    if not request.items:
+        raise HTTPException(status_code=400, detail="배치 항목이 없습니다.")
+    if len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"배치 항목은 최대 {MAX_BATCH_ITEMS}개입니다.")
+
+    batch_id = str(uuid.uuid4())
+    template = load_workflow(request.workflow_name)
+    jobs = plan_batch(template, request)
+    for job in jobs:
+        build_batch_job(request, job)
+
+    if WORKFLOW_OPTIMIZE:
+        # ComfyUI 캐시는 직전 프롬프트의 노드 출력만 유지하므로 상위 노드를 많이 공유하는 순서로 제출
+        jobs = [jobs[i] for i in order_for_cache([job["workflow"] for job in jobs])]
+
+    # 항목별 상태 (묶인 항목은 같은 시드, 배치 내 순서로 구분)
+    items = [None] * len(request.items)
+    for job in jobs:
+        for batch_index, index in enumerate(job["items"]):
+            items[index] = {
+                "index": index,
+                "prompt_text": request.items[index].prompt_text,
+                "seed": job["seed"],
+                "batch_index": batch_index,
+                "batch_size": len(job["items"]),
+                "status": "waiting",
+            }
+    state = {"batch_id": batch_id, "items": items, "remaining": len(jobs)}
+    batches[batch_id] = state
+    while len(batches) > MAX_BATCHES:
+        batches.popitem(last=False)
+
+    print(f"배치 제출: {batch_id}, 항목 {len(items)}개, 그래프 {len(jobs)}개")
+    runner = asyncio.create_task(run_batch_jobs(request, state, jobs))
+    queued = {
+        "batch_id": batch_id,
+        "jobs": [{"items": job["items"], "seed": job["seed"]} for job in jobs],
+        "items": items,
+    }
+    return queued, [runner]
+
+
+async def run_batch_jobs(request: BatchRequest, state, jobs):
+    # 한 번에 한 그래프씩 공정 큐에 넣음 (배치도 다른 클라이언트와 같은 차례 규칙, 클라이언트 대기열을 넘치게 하지 않음)
+    client_id = request.client_id
+    items = state["items"]
+    watchers = []
+    for job in jobs:
+        try:
+            result = await submit_batch_job(request, job)
+        except Exception as e:
+            status = "rejected" if getattr(e, "status_code", None) == 429 else "error"
+            for index in job["items"]:
+                items[index].update(status=status, error=getattr(e, "detail", str(e)))
+            await finish_batch_job(state, client_id, job)
+            continue
+        job.update(result)
+        for index in job["items"]:
+            items[index].update(status="queued", prompt_id=result["prompt_id"], backend=result["backend"])
+        if client_id:
+            await notify_client(client_id, {
+                "type": "batch_job_queued",
+                "batch_id": state["batch_id"],
+                **{k: job[k] for k in ("prompt_id", "backend", "items", "position", "estimated_wait", "seed")},
+            })
+        watchers.append(asyncio.create_task(watch_batch_job(state, client_id, job)))
+    await asyncio.gather(*watchers)
+
+
+async def watch_batch_job(state, client_id, job):
+    batch_id = state["batch_id"]
+    items = state["items"]
+    prompt_id = job["prompt_id"]
+    backend = pool.for_prompt(prompt_id)
+    events = backend.hub.subscribe(prompt_id)
+    timeline = NodeTimeline(tracer.current(), prompt_id, job.pop("node_types", None))
+    error = None
+    executed = {}
     try:
-        # ComfyUI 서버 연결 확인
-        with urllib.request.urlopen(f"{COMFY_SERVER}/system_stats") as response:
-            return {"status": "connected", "message": "ComfyUI 서버가 실행 중입니다."}
+        while True:
+            message = await events.get()
+            data = message.get("data") or {}
+            if message["type"] != "binary":
+                timeline.on_message(message)
+            if message["type"] == "execution_start":
+                await asyncio.to_thread(generations.record_started, prompt_id)
+            elif message["type"] == "executed" and data.get("output"):
+                executed[data["node"]] = data["output"]
+            elif message["type"] == "progress" and data.get("max"):
+                if client_id:
+                    await notify_client(client_id, {
+                        "type": "batch_progress",
+                        "batch_id": batch_id,
+                        "prompt_id": prompt_id,
+                        "items": job["items"],
+                        "node": data.get("node"),
+                        "progress": int((data["value"] / data["max"]) * 100),
+                    })
+            elif message["type"] == "execution_error":
+                error = f"ComfyUI 처리 오류: {data.get('exception_message', '')}"
+                break
+            elif message["type"] == "executing" and data.get("node") is None:
+                break
+
+        entry = await complete_generation(prompt_id, backend, executed, error)
+        outputs = result_images(prompt_id, backend, entry) if error is None else {}
     except Exception as e:
-        return {"status": "disconnected", "message": f"ComfyUI 서버에 연결할 수 없습니다: {str(e)}"}
+        print(f"배치 결과 처리 오류: {str(e)}")
+        error = f"배치 결과 처리 오류: {str(e)}"
+        outputs = {}
+    finally:
+        backend.hub.unsubscribe(prompt_id, events)
+        timeline.close(error=error)
+
+    # 묶인 그래프의 각 출력 노드는 batch_size 개의 이미지를 순서대로 반환
+    for batch_index, index in enumerate(job["items"]):
+        item = items[index]
+        if error is None:
+            item["status"] = "done"
+            item["images"] = [images[batch_index] for images in outputs.values() if len(images) > batch_index]
+        else:
+            item["status"] = "error"
+            item["error"] = error
+    await finish_batch_job(state, client_id, job)
+
+
+async def finish_batch_job(state, client_id, job):
+    batch_id = state["batch_id"]
+    items = state["items"]
+    state["remaining"] -= 1
+    if client_id:
+        for index in job["items"]:
+            await notify_client(client_id, {"type": "batch_item_result", "batch_id": batch_id, **items[index]})
+        if state["remaining"] == 0:
+            await notify_client(client_id, {"type": "batch_complete", "batch_id": batch_id, "items": items})
+
+
+# 배치 항목 상태 (제출은 백그라운드이므로 wait=False 로 받은 batch_id 로 prompt_id/결과 조회)
+@app.get('/api/generate-batch/{batch_id}')
+async def get_batch(batch_id: str):
+    state = batches.get(batch_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"배치 '{batch_id}'를 찾을 수 없습니다.")
+    return {"batch_id": batch_id, "remaining": state["remaining"], "items": state["items"]}
+
+
+@app.post('/api/generate-batch')
+async def generate_batch(request: BatchRequest):
+    try:
+        queued, watchers = await start_batch(request)
+        if not request.wait:
+            return queued
+        # 모든 결과를 모아서 응답
+        try:
+            await asyncio.wait_for(asyncio.gather(*watchers), BATCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="배치 생성 시간 초과")
+        return {"batch_id": queued["batch_id"], "items": queued["items"]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"배치 생성 오류: {str(e)}")
+
+
+# 생성 기록 (갤러리) - 최신순, next_cursor 로 다음 페이지
+def generation_view(item):
+    backend_name = item.get("backend") or pool.default.name
+    item["images"] = [
+        {**image, "url": image_url(image, item["prompt_id"], backend_name)}
+        for image in item["outputs"] if image["type"] == "output"
+    ]
+    return item
+
+
+@app.get('/api/generations')
+async def list_generations(
+    client_id: Optional[str] = None,
+    q: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    status: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = 50,
+):
+    page = await asyncio.to_thread(generations.query, client_id, q, since, until, status, cursor, limit)
+    page["items"] = [generation_view(item) for item in page["items"]]
+    return page
+
+
+@app.get('/api/generations/{prompt_id}')
+async def get_generation(prompt_id: str):
+    item = await asyncio.to_thread(generations.get, prompt_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail=f"생성 기록 '{prompt_id}'를 찾을 수 없습니다.")
+    return generation_view(item)
+
+
+# 트레이스 조회 (최근 순), format=html 이면 워터폴 뷰
+@app.get('/api/admin/traces', dependencies=[Depends(require_admin)])
+async def list_traces(limit: int = 50, name: Optional[str] = None, min_duration_ms: Optional[float] = None,
+                      errors: bool = False):
+    return {"traces": tracer.traces(limit, name, min_duration_ms, errors), **tracer.stats()}
+
+
+@app.get('/api/admin/traces/{trace_id}', dependencies=[Depends(require_admin)])
+async def get_trace(trace_id: str, format: str = "json"):
+    trace = tracer.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"트레이스 '{trace_id}'를 찾을 수 없습니다.")
+    if format == "html":
+        return HTMLResponse(render_html(trace))
+    return trace.to_dict()
+
+
+# 클라이언트 등급 (공정 큐 가중치) 변경
+@app.put('/api/admin/clients/{client_id}/tier', dependencies=[Depends(require_admin)])
+async def set_client_tier(client_id: str, tier: str):
+    native_fairness.set_tier(client_id, tier)
+    return fairness.set_tier(client_id, tier)
+
+
+@app.get('/api/status')
+async def check_status():
+    # ComfyUI 백엔드 상태 (주기적 확인 결과)
+    if pool.connected:
+        return {"status": "connected", "message": "ComfyUI 서버가 실행 중입니다.", "previews": manager.preview_stats(), "generations": generations.stats(), "node_cache": cache_stats.stats(), "native": {**native.stats(), "queue": native_fairness.stats()} if native else None, "tracing": tracer.stats(), "dedupe": dedupe.stats(), "fairness": fairness.stats(), "delivery": deliveries.stats(), **pool.stats()}
+    return {"status": "disconnected", "message": "ComfyUI 서버에 연결할 수 없습니다.", **pool.stats()}
     
 if __name__ == "__main__":
     import uvicorn
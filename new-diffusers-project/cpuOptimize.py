@@ -0,0 +1,206 @@
+import os
+import contextlib
+import torch
+
+# GPU 없는 엣지 노드용 CPU 추론 프로파일
+# - bfloat16 autocast (하드웨어 지원 시)
+# - UNet/VAE channels_last
+# - IPEX 최적화 또는 inductor freezing(oneDNN 융합 + 가중치 pre-pack)
+# - 스레드 수 / 코어 고정
+
+
+class CPUProfile:
+    def __init__(self):
+        self.enabled = False
+        self.bf16 = False
+        self.channels_last = False
+        self.backend = "eager"
+        self.intra_threads = torch.get_num_threads()
+        self.inter_threads = torch.get_num_interop_threads()
+        self.cores = None
+
+    def to_dict(self):
+        return {
+            "enabled": self.enabled,
+            "bf16": self.bf16,
+            "channels_last": self.channels_last,
+            "backend": self.backend,
+            "intra_threads": self.intra_threads,
+            "inter_threads": self.inter_threads,
+            "cores": self.cores,
+        }
+
+
+def profile_enabled(device):
+    # CPU에서는 기본 활성화, CPU_PROFILE=0 으로 끌 수 있음
+    return device == "cpu" and os.getenv("CPU_PROFILE", "1") != "0"
+
+
+def bf16_supported():
+    # AVX512-BF16 / AMX 지원 여부 확인
+    if os.getenv("CPU_BF16") is not None:
+        return os.getenv("CPU_BF16") == "1"
+    try:
+        if hasattr(torch.cpu, "_is_avx512_bf16_supported") and torch.cpu._is_avx512_bf16_supported():
+            return True
+        if hasattr(torch.cpu, "_is_amx_tile_supported") and torch.cpu._is_amx_tile_supported():
+            return True
+    except Exception:
+        pass
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except Exception:
+        return False
+
+
+def _parse_cores(spec):
+    # "0-7,16-23" 형식 파싱
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def _physical_cores():
+    try:
+        import psutil
+        count = psutil.cpu_count(logical=False)
+        if count:
+            return count
+    except ImportError:
+        pass
+    # 하이퍼스레딩 가정
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+def configure_threads(profile, intra=None, inter=None, cores=None):
+    intra = intra or int(os.getenv("CPU_THREADS", "0")) or None
+    inter = inter or int(os.getenv("CPU_INTEROP_THREADS", "0")) or None
+    cores = cores or os.getenv("CPU_CORES")
+
+    # 코어 고정 (Linux 전용)
+    if cores and hasattr(os, "sched_setaffinity"):
+        core_list = _parse_cores(cores) if isinstance(cores, str) else list(cores)
+        try:
+            os.sched_setaffinity(0, core_list)
+            profile.cores = core_list
+        except OSError as e:
+            print(f"코어 고정 실패: {e}")
+
+    if intra is None:
+        intra = len(profile.cores) if profile.cores else _physical_cores()
+    if inter is None:
+        # 디퓨전 루프는 순차 실행이라 inter-op 병렬이 거의 필요 없음
+        inter = 1
+
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError:
+        # 이미 병렬 작업이 시작된 뒤에는 변경 불가
+        pass
+
+    profile.intra_threads = torch.get_num_threads()
+    profile.inter_threads = torch.get_num_interop_threads()
+
+
+def _optimize_module(module, profile):
+    if module is None:
+        return module
+    module.eval()
+    module.requires_grad_(False)
+
+    if profile.backend == "ipex":
+        import intel_extension_for_pytorch as ipex
+        return ipex.optimize(
+            module,
+            dtype=torch.bfloat16 if profile.bf16 else torch.float32,
+            inplace=True,
+            weights_prepack=True,
+        )
+    if profile.backend == "inductor":
+        # freezing 이 켜져 있으면 첫 호출 시 상수 폴딩 + oneDNN 가중치 pre-pack 수행
+        module.forward = torch.compile(module.forward, backend="inductor")
+    return module
+
+
+def _select_backend(backend):
+    if backend != "auto":
+        return backend
+    try:
+        import intel_extension_for_pytorch  # noqa: F401
+        return "ipex"
+    except ImportError:
+        pass
+    if hasattr(torch, "compile"):
+        return "inductor"
+    return "eager"
+
+
+def optimize_pipeline(pipe, bf16=None, channels_last=True, backend=None, skip=()):
+    # skip: 그대로 둘 컴포넌트 이름 (공유 가중치처럼 pre-pack 사본을 만들면 안 되는 경우)
+    profile = CPUProfile()
+    profile.enabled = True
+    configure_threads(profile)
+
+    profile.bf16 = bf16_supported() if bf16 is None else bf16
+    profile.backend = _select_backend(backend or os.getenv("CPU_BACKEND", "auto"))
+
+    if profile.backend == "inductor":
+        import torch._inductor.config as inductor_config
+        inductor_config.freezing = True
+        inductor_config.cpp_wrapper = os.getenv("CPU_CPP_WRAPPER", "0") == "1"
+
+    # 컨볼루션이 많은 UNet/VAE에만 channels_last 적용
+    if channels_last:
+        for name in ("unet", "vae"):
+            module = getattr(pipe, name, None)
+            if module is not None and name not in skip:
+                module.to(memory_format=torch.channels_last)
+                profile.channels_last = True
+
+    for name in ("unet", "transformer", "text_encoder", "text_encoder_2"):
+        module = getattr(pipe, name, None)
+        if module is not None and name not in skip:
+            setattr(pipe, name, _optimize_module(module, profile))
+
+    # VAE 디코더는 decode 경로만 최적화
+    vae = getattr(pipe, "vae", None)
+    if vae is not None:
+        vae.eval()
+        vae.requires_grad_(False)
+        if profile.backend == "ipex":
+            import intel_extension_for_pytorch as ipex
+            vae.decoder = ipex.optimize(
+                vae.decoder,
+                dtype=torch.bfloat16 if profile.bf16 else torch.float32,
+                inplace=True,
+                weights_prepack=True,
+            )
+
+    print(f"CPU 프로파일 적용: {profile.to_dict()}")
+    return profile
+
+
+def cpu_autocast(profile):
+    if profile is None or not profile.enabled or not profile.bf16:
+        return contextlib.nullcontext()
+    return torch.autocast("cpu", dtype=torch.bfloat16)
+
+
+def warmup(pipe, profile, **kwargs):
+    # 시작 시 1회 실행해서 컴파일/가중치 pre-pack 비용을 미리 지불
+    if profile is None or not profile.enabled or os.getenv("CPU_WARMUP", "1") == "0":
+        return
+    print("CPU 워밍업 실행 중...")
+    kwargs.setdefault("num_inference_steps", 1)
+    with torch.inference_mode(), cpu_autocast(profile):
+        pipe("warmup", **kwargs)
+    print("CPU 워밍업 완료")
@@ -0,0 +1,307 @@
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+# 클라이언트별 공정 큐 (ComfyUI FIFO 앞단의 스케줄링)
+# - client_id 마다 대기열을 두고 deficit round robin 으로 ComfyUI 에 넘길 프롬프트를 고름
+#   라운드 로빈으로 클라이언트를 방문할 때 quantum * 가중치 만큼 적립, 적립액이 맨 앞 프롬프트 비용(예상 실행 시간) 이상이면 제출
+#   -> 오래 걸리는 워크플로우를 자주 보내는 클라이언트도 가중치 비율 이상의 GPU 시간을 가져가지 못함
+# - ComfyUI 에 올려 두는 프롬프트는 전체 window 개, 클라이언트당 max_outstanding 개까지
+#   나머지는 프록시에서 기다렸다가 ComfyUI 가 비는 만큼만 제출 (실행 완료 이벤트에서 다음 프롬프트 선택)
+# - 가중치는 등급(tier) 별 설정, 클라이언트 등급은 FAIR_CLIENT_TIERS 또는 관리 API 로 지정
+# - client_id 가 없는 요청은 하나의 익명 클라이언트로 묶음
+
+
+def parse_pairs(text):
+    # "free:1,pro:4" -> {"free": "1", "pro": "4"}
+    pairs = {}
+    for item in (text or "").split(","):
+        if ":" in item:
+            key, value = item.rsplit(":", 1)
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+# 등급별 가중치 / 클라이언트 등급 / 기본 등급
+FAIR_TIERS = {tier: float(weight) for tier, weight in parse_pairs(os.getenv("FAIR_TIERS", "free:1,pro:4,internal:8")).items()}
+FAIR_CLIENT_TIERS = parse_pairs(os.getenv("FAIR_CLIENT_TIERS", ""))
+FAIR_DEFAULT_TIER = os.getenv("FAIR_DEFAULT_TIER", "free")
+# 클라이언트당 ComfyUI 에 올려 둘 최대 프롬프트 수 / 백엔드당 전체 프롬프트 수
+FAIR_MAX_OUTSTANDING = int(os.getenv("FAIR_MAX_OUTSTANDING", "2"))
+FAIR_WINDOW = int(os.getenv("FAIR_WINDOW", "2"))
+# 가중치 1 당 방문마다 적립하는 실행 시간 (초)
+FAIR_QUANTUM = float(os.getenv("FAIR_QUANTUM", "10"))
+# 클라이언트별 프록시 대기열 길이 (넘으면 429)
+FAIR_MAX_QUEUED = int(os.getenv("FAIR_MAX_QUEUED", "16"))
+# 완료 이벤트를 받지 못한 프롬프트의 자리 자동 반환 (초)
+FAIR_OUTSTANDING_TIMEOUT = float(os.getenv("FAIR_OUTSTANDING_TIMEOUT", "900"))
+
+ANONYMOUS = "anonymous"
+# 공정성 지표 구간 (초) / 클라이언트별 대기 시간 표본 수
+STATS_WINDOW = 300.0
+WAIT_SAMPLES = 512
+# 대기열/실행 중인 프롬프트가 없는 클라이언트 정리 (초)
+IDLE_TIMEOUT = 3600.0
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+
+def jain_index(values):
+    # (Σx)^2 / (n Σx^2), 모두 같으면 1, 한 명이 독점하면 1/n
+    values = [value for value in values if value > 0]
+    if not values:
+        return None
+    return sum(values) ** 2 / (len(values) * sum(value * value for value in values))
+
+
+class FairQueue:
+    def __init__(self, window, tiers=None, client_tiers=None, default_tier=FAIR_DEFAULT_TIER,
+                 max_outstanding=FAIR_MAX_OUTSTANDING, quantum=FAIR_QUANTUM, max_queued=FAIR_MAX_QUEUED,
+                 outstanding_timeout=FAIR_OUTSTANDING_TIMEOUT):
+        self.window = window
+        self.tiers = dict(FAIR_TIERS if tiers is None else tiers)
+        self.client_tiers = dict(FAIR_CLIENT_TIERS if client_tiers is None else client_tiers)
+        self.default_tier = default_tier if default_tier in self.tiers else next(iter(self.tiers), default_tier)
+        self.max_outstanding = max_outstanding
+        self.quantum = quantum
+        self.max_queued = max_queued
+        self.outstanding_timeout = outstanding_timeout
+        self.clients = {}
+        # 대기열이 있는 클라이언트 (라운드 로빈 순서, 맨 앞이 방문 중)
+        self.active = deque()
+        self.outstanding = set()
+        self.by_prompt = {}
+        # 최근 제출 기록 (시각, 클라이언트, 비용, 대기열이 남아 있었는지)
+        self.recent = deque()
+        self.granted = 0
+        self.rejected = 0
+        self.expired = 0
+        self._pruned = time.monotonic()
+        self._keys = itertools.count()
+
+    def tier(self, name):
+        tier = self.client_tiers.get(name, self.default_tier)
+        return tier if tier in self.tiers else self.default_tier
+
+    def set_tier(self, client_id, tier):
+        if tier not in self.tiers:
+            raise HTTPException(status_code=400, detail=f"알 수 없는 등급: {tier} (가능: {', '.join(self.tiers)})")
+        name = client_id or ANONYMOUS
+        self.client_tiers[name] = tier
+        client = self.clients.get(name)
+        if client is not None:
+            client["weight"] = self.tiers[tier]
+        return {"client_id": name, "tier": tier, "weight": self.tiers[tier]}
+
+    def _client(self, client_id):
+        name = client_id or ANONYMOUS
+        client = self.clients.get(name)
+        if client is None:
+            client = {
+                "name": name,
+                "weight": self.tiers.get(self.tier(name), 1.0),
+                "queue": deque(),
+                "deficit": 0.0,
+                "outstanding": 0,
+                "granted": 0,
+                "served": 0.0,
+                "waits": deque(maxlen=WAIT_SAMPLES),
+                "seen": time.monotonic(),
+            }
+            self.clients[name] = client
+        client["seen"] = time.monotonic()
+        return client
+
+    async def acquire(self, client_id, cost):
+        # 제출 차례가 될 때까지 대기, 반환한 ticket 으로 bind / cancel
+        self._prune()
+        client = self._client(client_id)
+        if len(client["queue"]) >= self.max_queued:
+            self.rejected += 1
+            retry_after = int(sum(ticket["cost"] for ticket in client["queue"]) / max(self.window, 1)) + 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"대기 중인 요청이 너무 많습니다. (클라이언트당 최대 {self.max_queued}개)",
+                headers={"Retry-After": str(retry_after)},
+            )
+        ticket = self._ticket(client, cost)
+        ticket["future"] = asyncio.get_running_loop().create_future()
+        client["queue"].append(ticket)
+        if client["name"] not in self.active:
+            self.active.append(client["name"])
+        self._dispatch()
+        try:
+            await ticket["future"]
+        except asyncio.CancelledError:
+            # 기다리던 요청이 끊김 (자리를 받았으면 반환, 아니면 대기열에서 제거)
+            if ticket["granted"] is not None:
+                self.cancel(ticket)
+            else:
+                client["queue"].remove(ticket)
+                self._dispatch()
+            raise
+        return ticket
+
+    def _ticket(self, client, cost):
+        return {
+            "key": next(self._keys),
+            "client": client["name"],
+            "cost": cost,
+            "enqueued": time.monotonic(),
+            "granted": None,
+            "prompt_id": None,
+        }
+
+    def bind(self, ticket, prompt_id):
+        ticket["prompt_id"] = prompt_id
+        self.by_prompt[prompt_id] = ticket
+
+    def cancel(self, ticket):
+        # 제출 실패 (자리와 사용량 반환)
+        client = self.clients.get(ticket["client"])
+        if client is not None and ticket["granted"] is not None:
+            client["served"] -= ticket["cost"]
+        self._release(ticket)
+
+    def finish(self, prompt_id):
+        ticket = self.by_prompt.pop(prompt_id, None)
+        if ticket is not None:
+            self._release(ticket)
+
+    def on_message(self, message):
+        # 실행 완료/오류/중단 시 자리 반환
+        message_type = message.get("type")
+        data = message.get("data") or {}
+        if message_type in ("execution_error", "execution_interrupted") or (
+            message_type == "executing" and data.get("node") is None
+        ):
+            self.finish(data.get("prompt_id"))
+
+    def _grant(self, client, ticket):
+        now = time.monotonic()
+        ticket["granted"] = now
+        self.outstanding.add(ticket["key"])
+        client["outstanding"] += 1
+        client["granted"] += 1
+        client["served"] += ticket["cost"]
+        client["waits"].append(now - ticket["enqueued"])
+        self.granted += 1
+        self.recent.append((now, client["name"], ticket["cost"], bool(client["queue"])))
+        future = ticket.get("future")
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _release(self, ticket):
+        if ticket["key"] not in self.outstanding:
+            return
+        self.outstanding.discard(ticket["key"])
+        if ticket["prompt_id"] is not None:
+            self.by_prompt.pop(ticket["prompt_id"], None)
+        client = self.clients.get(ticket["client"])
+        if client is not None:
+            client["outstanding"] -= 1
+        self._dispatch()
+
+    def _expire(self):
+        # 완료 이벤트 유실 대비
+        deadline = time.monotonic() - self.outstanding_timeout
+        for prompt_id, ticket in list(self.by_prompt.items()):
+            if ticket["granted"] < deadline:
+                self.expired += 1
+                self.finish(prompt_id)
+
+    def _dispatch(self):
+        # deficit round robin, ComfyUI 에 올린 프롬프트가 window 개 미만인 동안 반복
+        blocked = 0
+        while self.active and len(self.outstanding) < self.window and blocked < len(self.active):
+            client = self.clients[self.active[0]]
+            queue = client["queue"]
+            if not queue:
+                # 대기열이 비면 적립액도 버림 (쉬다 온 클라이언트가 몰아서 쓰지 않도록)
+                self.active.popleft()
+                client["deficit"] = 0.0
+                continue
+            if client["outstanding"] >= self.max_outstanding:
+                self.active.rotate(-1)
+                blocked += 1
+                continue
+            blocked = 0
+            ticket = queue[0]
+            if client["deficit"] < ticket["cost"]:
+                # 새 방문: 적립 후에도 모자라면 다음 라운드에서 다시 적립
+                client["deficit"] += self.quantum * client["weight"]
+                if client["deficit"] < ticket["cost"]:
+                    self.active.rotate(-1)
+                    continue
+            client["deficit"] -= ticket["cost"]
+            queue.popleft()
+            self._grant(client, ticket)
+            if not queue:
+                self.active.popleft()
+                client["deficit"] = 0.0
+            elif client["deficit"] < queue[0]["cost"]:
+                # 이번 방문의 적립액을 다 씀
+                self.active.rotate(-1)
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        self._expire()
+        for name, client in list(self.clients.items()):
+            if not client["queue"] and not client["outstanding"] and now - client["seen"] > IDLE_TIMEOUT:
+                del self.clients[name]
+
+    def fairness(self):
+        # 최근 구간에서 대기열이 남아 있던(계속 요청한) 클라이언트끼리 가중치 대비 사용량의 Jain 지수
+        cutoff = time.monotonic() - STATS_WINDOW
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        served = {}
+        for _, name, cost, backlogged in self.recent:
+            if backlogged:
+                served[name] = served.get(name, 0.0) + cost
+        return jain_index([
+            cost / (self.clients[name]["weight"] if name in self.clients else 1.0)
+            for name, cost in served.items()
+        ])
+
+    def stats(self):
+        waits = [wait for client in self.clients.values() for wait in client["waits"]]
+        fairness = self.fairness()
+        return {
+            "window": self.window,
+            "outstanding": len(self.outstanding),
+            "queued": sum(len(client["queue"]) for client in self.clients.values()),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "fairness_index": round(fairness, 3) if fairness is not None else None,
+            "wait_p50": round(percentile(waits, 0.5), 2) if waits else None,
+            "wait_p99": round(percentile(waits, 0.99), 2) if waits else None,
+            "tiers": self.tiers,
+            "clients": {
+                name: {
+                    "tier": self.tier(name),
+                    "weight": client["weight"],
+                    "queued": len(client["queue"]),
+                    "outstanding": client["outstanding"],
+                    "granted": client["granted"],
+                    "served_seconds": round(client["served"], 1),
+                    "wait_p50": round(percentile(client["waits"], 0.5), 2) if client["waits"] else None,
+                    "wait_p99": round(percentile(client["waits"], 0.99), 2) if client["waits"] else None,
+                    "wait_max": round(max(client["waits"]), 2) if client["waits"] else None,
+                }
+                for name, client in self.clients.items()
+            },
+        }
@@ -0,0 +1,194 @@
+import json
+import sqlite3
+import threading
+import time
+
+# 완료된 생성 결과 로컬 색인 (SQLite)
+# - ComfyUI 히스토리는 메모리에만 있어서 재시작하면 사라짐
+# - 제출 시 요청 정보, 완료 시 실행 시간/출력 파일 기록
+# - client_id, 프롬프트 텍스트, 시간 범위 조회 및 갤러리 페이지 조회 (rowid 커서)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    prompt_id TEXT PRIMARY KEY,
+    client_id TEXT,
+    backend TEXT,
+    workflow TEXT,
+    prompt_text TEXT,
+    negative_prompt TEXT,
+    seed INTEGER,
+    batch_size INTEGER,
+    status TEXT NOT NULL,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    completed_at REAL,
+    duration REAL,
+    error TEXT,
+    outputs TEXT,
+    history TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_generations_client ON generations (client_id, submitted_at);
+CREATE INDEX IF NOT EXISTS idx_generations_submitted ON generations (submitted_at);
+CREATE INDEX IF NOT EXISTS idx_generations_status ON generations (status, submitted_at);
+"""
+
+# FTS5 가 없는 SQLite 빌드에서는 LIKE 검색 사용
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(prompt_text, content='generations', content_rowid='rowid');
+"""
+
+COLUMNS = (
+    "prompt_id", "client_id", "backend", "workflow", "prompt_text", "negative_prompt", "seed", "batch_size",
+    "status", "submitted_at", "started_at", "completed_at", "duration", "error", "outputs",
+)
+
+MAX_PAGE_SIZE = 200
+
+
+class GenerationIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        try:
+            self._db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record_submitted(self, prompt_id, backend=None, workflow=None, client_id=None,
+                         prompt_text=None, negative_prompt=None, seed=None, batch_size=None):
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO generations (prompt_id, client_id, backend, workflow, prompt_text, negative_prompt,"
+                " seed, batch_size, status, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)",
+                (prompt_id, client_id, backend, workflow, prompt_text, negative_prompt, seed, batch_size, time.time()),
+            )
+            if self.fts and prompt_text and cursor.rowcount == 1:
+                self._db.execute(
+                    "INSERT INTO generations_fts (rowid, prompt_text) VALUES (?, ?)",
+                    (cursor.lastrowid, prompt_text),
+                )
+            self._db.commit()
+
+    def record_started(self, prompt_id, started_at=None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE generations SET status = 'running', started_at = COALESCE(started_at, ?) WHERE prompt_id = ?",
+                (started_at or time.time(), prompt_id),
+            )
+            self._db.commit()
+
+    def record_completed(self, prompt_id, history, outputs, error=None, backend=None):
+        # history: ComfyUI 히스토리 항목 형식 ({"outputs": ..., "status": ...})
+        # outputs: [{"node", "filename", "subfolder", "type"}, ...]
+        completed_at = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT submitted_at, started_at FROM generations WHERE prompt_id = ?", (prompt_id,)
+            ).fetchone()
+            if row is None:
+                # 이 프록시가 제출하지 않은 프롬프트 (ComfyUI 에서 직접 조회한 경우)
+                self._db.execute(
+                    "INSERT INTO generations (prompt_id, backend, status, submitted_at) VALUES (?, ?, 'queued', ?)",
+                    (prompt_id, backend, completed_at),
+                )
+                started_at = None
+            else:
+                started_at = row["started_at"]
+            self._db.execute(
+                "UPDATE generations SET status = ?, completed_at = ?, duration = ?, error = ?, outputs = ?, history = ?"
+                " WHERE prompt_id = ?",
+                (
+                    "error" if error else "success",
+                    completed_at,
+                    completed_at - started_at if started_at else None,
+                    error,
+                    json.dumps(outputs),
+                    json.dumps(history),
+                    prompt_id,
+                ),
+            )
+            self._db.commit()
+
+    def history(self, prompt_id):
+        # 완료된 항목의 ComfyUI 히스토리 형식 데이터 (없으면 None)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT history FROM generations WHERE prompt_id = ? AND history IS NOT NULL", (prompt_id,)
+            ).fetchone()
+        return json.loads(row["history"]) if row else None
+
+    def get(self, prompt_id):
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT rowid, {', '.join(COLUMNS)} FROM generations WHERE prompt_id = ?", (prompt_id,)
+            ).fetchone()
+        return _row_to_dict(row) if row else None
+
+    def query(self, client_id=None, text=None, since=None, until=None, status=None, cursor=None, limit=50):
+        # 최신순, cursor 는 이전 페이지 마지막 항목의 rowid
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        where = []
+        params = []
+        if client_id:
+            where.append("g.client_id = ?")
+            params.append(client_id)
+        if status:
+            where.append("g.status = ?")
+            params.append(status)
+        if since is not None:
+            where.append("g.submitted_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("g.submitted_at < ?")
+            params.append(until)
+        if cursor is not None:
+            where.append("g.rowid < ?")
+            params.append(cursor)
+        if text:
+            if self.fts:
+                where.append("g.rowid IN (SELECT rowid FROM generations_fts WHERE generations_fts MATCH ?)")
+                params.append(_fts_query(text))
+            else:
+                where.append("g.prompt_text LIKE ?")
+                params.append(f"%{text}%")
+
+        sql = f"SELECT g.rowid, {', '.join('g.' + c for c in COLUMNS)} FROM generations g"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY g.rowid DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        items = [_row_to_dict(row) for row in rows[:limit]]
+        next_cursor = items[-1]["id"] if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def stats(self):
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) AS n FROM generations GROUP BY status").fetchall()
+        return {"path": self.path, "fts": self.fts, "counts": {row["status"]: row["n"] for row in rows}}
+
+
+def _fts_query(text):
+    # 사용자 입력은 단어별 구문으로 감싸서 FTS 문법 오류 방지
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"' for term in terms) or '""'
+
+
+def _row_to_dict(row):
+    item = dict(row)
+    item["id"] = item.pop("rowid")
+    item["outputs"] = json.loads(item["outputs"]) if item.get("outputs") else []
+    return item
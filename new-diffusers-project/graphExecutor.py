@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+from cpuOptimize import cpu_autocast, optimize_pipeline, profile_enabled
+from schedulerRegistry import SAMPLERS, SchedulerRegistry, pipeline_with_scheduler
+from workflowOptimizer import OUTPUT_NODES, prune, signatures, topological_order
+from workflowTemplates import is_link
+
+# ComfyUI API 형식 워크플로우를 diffusers 로 직접 실행 (ComfyUI 프로세스 없이)
+# - 지원 노드: CheckpointLoaderSimple, CLIPTextEncode, EmptyLatentImage, KSampler, VAEDecode, SaveImage, PreviewImage
+# - 위상 정렬 순서로 실행, 노드 출력은 입력 시그니처 기준으로 메모이즈 (프롬프트가 같으면 인코딩 재사용)
+# - 지원하지 않는 노드/체크포인트/설정이 있으면 UnsupportedGraph -> 호출 측에서 원격 ComfyUI 로 보냄
+# - 결과 이미지는 파일로 저장하지 않고 PIL 이미지로 반환
+# 시드가 같아도 ComfyUI 와 노이즈 생성 방식이 달라 같은 이미지가 나오지는 않음
+
+# ComfyUI 체크포인트 폴더 (있으면 단일 파일로 로드)
+CHECKPOINT_DIR = os.getenv("COMFY_CHECKPOINT_DIR", "")
+# 체크포인트 파일 이름 -> diffusers 모델 id (폴더에 파일이 없을 때)
+CHECKPOINT_MODELS = {
+    "v1-5-pruned-emaonly.safetensors": "runwayml/stable-diffusion-v1-5",
+    "v1-5-pruned-emaonly.ckpt": "runwayml/stable-diffusion-v1-5",
+    "v1-5-pruned.safetensors": "runwayml/stable-diffusion-v1-5",
+}
+CHECKPOINT_MODELS.update(json.loads(os.getenv("CHECKPOINT_MODELS", "{}")))
+# 메모이즈할 노드 출력 수 (체크포인트는 별도로 유지)
+MEMO_SIZE = int(os.getenv("NATIVE_MEMO_SIZE", "32"))
+
+# ComfyUI sampler_name -> schedulerRegistry 샘플러 이름 (scheduler=karras 면 " Karras" 버전)
+COMFY_SAMPLERS = {
+    "euler": "Euler",
+    "euler_ancestral": "Euler a",
+    "lms": "LMS",
+    "heun": "Heun",
+    "dpm_2": "DPM2",
+    "dpm_2_ancestral": "DPM2 a",
+    "dpmpp_2m": "DPM++ 2M",
+    "dpmpp_2m_sde": "DPM++ 2M SDE",
+    "dpmpp_sde": "DPM++ SDE",
+    "deis": "DEIS",
+    "uni_pc": "UniPC",
+    "ddim": "DDIM",
+    "lcm": "LCM",
+}
+COMFY_SCHEDULERS = {"normal", "simple", "karras", "sgm_uniform"}
+
+
+class UnsupportedGraph(Exception):
+    pass
+
+
+def sampler_for(sampler_name, scheduler):
+    name = COMFY_SAMPLERS.get(sampler_name)
+    if name is None or scheduler not in COMFY_SCHEDULERS:
+        raise UnsupportedGraph(f"지원하지 않는 샘플러: {sampler_name}/{scheduler}")
+    if scheduler == "karras":
+        name = f"{name} Karras"
+    if name not in SAMPLERS:
+        raise UnsupportedGraph(f"지원하지 않는 샘플러: {sampler_name}/{scheduler}")
+    return name
+
+
+class Checkpoint:
+    # CheckpointLoaderSimple 의 MODEL/CLIP/VAE 출력 (모두 같은 파이프라인을 가리킴)
+    def __init__(self, name, pipe, device):
+        self.name = name
+        self.pipe = pipe
+        self.device = device
+        self.schedulers = SchedulerRegistry(pipe)
+        self.cpu_profile = optimize_pipeline(pipe) if profile_enabled(device) else None
+
+
+def load_checkpoint(executor, node_id, emit, ckpt_name):
+    checkpoint = executor.checkpoint(ckpt_name)
+    return (checkpoint, checkpoint, checkpoint)
+
+
+def clip_text_encode(executor, node_id, emit, text, clip):
+    with torch.inference_mode():
+        embeds, _ = clip.pipe.encode_prompt(text, clip.device, 1, False)
+    return ({"embeds": embeds},)
+
+
+def empty_latent_image(executor, node_id, emit, width, height, batch_size=1):
+    return ({"samples": torch.zeros([batch_size, 4, height // 8, width // 8])},)
+
+
+def ksampler(executor, node_id, emit, model, seed, steps, cfg, sampler_name, scheduler,
+             positive, negative, latent_image, denoise=1.0):
+    batch_size, _, height, width = latent_image["samples"].shape
+    view = pipeline_with_scheduler(model.pipe, model.schedulers.get(sampler_for(sampler_name, scheduler)))
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        emit("progress", {"value": step + 1, "max": steps, "node": node_id})
+        return callback_kwargs
+
+    with torch.inference_mode(), cpu_autocast(model.cpu_profile):
+        result = view(
+            prompt_embeds=positive["embeds"],
+            negative_prompt_embeds=negative["embeds"],
+            guidance_scale=cfg,
+            num_inference_steps=steps,
+            height=height * 8,
+            width=width * 8,
+            num_images_per_prompt=batch_size,
+            generator=generator,
+            output_type="latent",
+            callback_on_step_end=on_step_end,
+        )
+    return ({"samples": result.images},)
+
+
+def vae_decode(executor, node_id, emit, samples, vae):
+    pipe = vae.pipe
+    with torch.inference_mode():
+        latents = samples["samples"].to(pipe.vae.device, pipe.vae.dtype) / pipe.vae.config.scaling_factor
+        decoded = pipe.vae.decode(latents, return_dict=False)[0]
+    return (pipe.image_processor.postprocess(decoded, output_type="pil"),)
+
+
+def save_image(executor, node_id, emit, images, filename_prefix="ComfyUI"):
+    return ({"images": images},)
+
+
+def preview_image(executor, node_id, emit, images):
+    return ({"images": images},)
+
+
+NODES = {
+    "CheckpointLoaderSimple": load_checkpoint,
+    "CLIPTextEncode": clip_text_encode,
+    "EmptyLatentImage": empty_latent_image,
+    "KSampler": ksampler,
+    "VAEDecode": vae_decode,
+    "SaveImage": save_image,
+    "PreviewImage": preview_image,
+}
+
+
+class GraphExecutor:
+    def __init__(self, device=None):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.checkpoints = {}
+        self.memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # 파이프라인 하나를 여러 요청이 동시에 쓰지 않도록 한 번에 한 그래프만 실행
+        self._lock = threading.Lock()
+
+    def register(self, ckpt_name, pipe):
+        # 이미 로드된 파이프라인을 체크포인트 이름으로 공유
+        self.checkpoints[ckpt_name] = Checkpoint(ckpt_name, pipe, self.device)
+
+    def _checkpoint_source(self, ckpt_name):
+        if ckpt_name in self.checkpoints:
+            return None
+        path = os.path.join(CHECKPOINT_DIR, ckpt_name) if CHECKPOINT_DIR else None
+        if path and os.path.exists(path):
+            return path
+        if ckpt_name in CHECKPOINT_MODELS:
+            return CHECKPOINT_MODELS[ckpt_name]
+        raise UnsupportedGraph(f"체크포인트 '{ckpt_name}' 를 찾을 수 없습니다.")
+
+    def checkpoint(self, ckpt_name):
+        if ckpt_name not in self.checkpoints:
+            source = self._checkpoint_source(ckpt_name)
+            print(f"체크포인트 로드: {ckpt_name} ({source})")
+            if os.path.isfile(source):
+                pipe = StableDiffusionPipeline.from_single_file(source, torch_dtype=self.dtype)
+            else:
+                pipe = StableDiffusionPipeline.from_pretrained(source, torch_dtype=self.dtype, safety_checker=None)
+            self.register(ckpt_name, pipe.to(self.device))
+        return self.checkpoints[ckpt_name]
+
+    def check(self, graph):
+        # 실행 전에 지원 여부 확인 (UnsupportedGraph)
+        try:
+            prune(graph)
+        except ValueError as e:
+            # 출력 노드가 없는 그래프
+            raise UnsupportedGraph(str(e))
+        for node_id, node in graph.items():
+            class_type = node["class_type"]
+            inputs = node["inputs"]
+            if class_type not in NODES:
+                raise UnsupportedGraph(f"지원하지 않는 노드: {class_type} (#{node_id})")
+            if class_type == "CheckpointLoaderSimple":
+                self._checkpoint_source(inputs["ckpt_name"])
+            elif class_type == "KSampler":
+                sampler_for(inputs["sampler_name"], inputs["scheduler"])
+                latent = inputs["latent_image"]
+                # img2img (denoise < 1 또는 빈 latent 가 아닌 입력) 는 미지원
+                if inputs.get("denoise", 1) != 1 or not is_link(latent) or graph[latent[0]]["class_type"] != "EmptyLatentImage":
+                    raise UnsupportedGraph(f"KSampler #{node_id}: 빈 latent 에서 시작하는 txt2img 만 지원합니다.")
+
+    def supports(self, graph):
+        try:
+            self.check(graph)
+        except (UnsupportedGraph, KeyError):
+            return False
+        return True
+
+    def execute(self, graph, emit=None):
+        # 반환: {"outputs": {node_id: [PIL.Image, ...]}, "cached": [node_id, ...]}
+        emit = emit or (lambda message_type, data: None)
+        graph = prune(graph)
+        self.check(graph)
+        sigs = signatures(graph)
+        results = {}
+        outputs = {}
+        cached = []
+        with self._lock:
+            for node_id in topological_order(graph):
+                node = graph[node_id]
+                class_type = node["class_type"]
+                sig = sigs[node_id]
+                if class_type not in OUTPUT_NODES and sig in self.memo:
+                    self.memo.move_to_end(sig)
+                    results[node_id] = self.memo[sig]
+                    cached.append(node_id)
+                    self.hits += 1
+                    continue
+
+                inputs = {
+                    name: results[value[0]][value[1]] if is_link(value) else value
+                    for name, value in node["inputs"].items()
+                }
+                emit("executing", {"node": node_id})
+                results[node_id] = NODES[class_type](self, node_id, emit, **inputs)
+                self.misses += 1
+
+                if class_type in OUTPUT_NODES:
+                    outputs[node_id] = results[node_id][0]["images"]
+                else:
+                    self.memo[sig] = results[node_id]
+                    while len(self.memo) > MEMO_SIZE:
+                        self.memo.popitem(last=False)
+        emit("executing", {"node": None})
+        return {"outputs": outputs, "cached": cached}
+
+    def stats(self):
+        return {
+            "device": self.device,
+            "checkpoints": list(self.checkpoints),
+            "memo_entries": len(self.memo),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
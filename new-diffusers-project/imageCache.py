@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from io import BytesIO
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+# ComfyUI 출력 이미지 로컬 디스크 LRU 캐시
+# - 키: (filename, subfolder, type [, 변형])
+# - 크기 제한을 넘으면 오래 사용하지 않은 항목부터 삭제
+# - 강한 ETag(sha256), If-None-Match/304, Range 응답 지원
+# - 썸네일 변형은 원본에서 생성해서 함께 캐시
+
+CHUNK_SIZE = 64 * 1024
+# 허용 썸네일 크기 (요청 값은 가장 가까운 큰 크기로 올림)
+THUMBNAIL_SIZES = (64, 128, 256, 512, 1024)
+
+
+class CacheEntry:
+    def __init__(self, key, path, size, etag, media_type):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.media_type = media_type
+
+    def to_meta(self):
+        return {"key": list(self.key), "size": self.size, "etag": self.etag, "media_type": self.media_type}
+
+
+class ImageCache:
+    def __init__(self, directory, max_bytes, fetcher):
+        # fetcher(key, sink): 원본 바이트를 스트리밍하며 await sink(chunk) 호출, media_type 반환
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._inflight = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(list(key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        # 재시작 시 기존 캐시 복구 (최근 접근 순)
+        metas = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+            elif entry.name.endswith(".json"):
+                metas.append((entry.stat().st_mtime, entry.path))
+        for _, meta_path in sorted(metas):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                data_path = meta_path[:-len(".json")]
+                if not os.path.exists(data_path):
+                    os.remove(meta_path)
+                    continue
+                key = tuple(meta["key"])
+                self.entries[key] = CacheEntry(key, data_path, meta["size"], meta["etag"], meta["media_type"])
+                self.total_bytes += meta["size"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"캐시 메타데이터 오류 ({meta_path}): {str(e)}")
+        self._evict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if not os.path.exists(entry.path):
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    async def fetch(self, key):
+        # 캐시에 있으면 바로 반환, 없으면 원본을 디스크로 스트리밍 (같은 키 동시 요청은 한 번만)
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def prefetch(self, key):
+        # 결과 이벤트 수신 시 미리 캐시 채우기
+        if key in self.entries or key in self._inflight:
+            return
+        task = asyncio.ensure_future(self.fetch(key))
+        task.add_done_callback(_log_prefetch_error)
+
+    async def _download(self, key):
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        hasher = hashlib.sha256()
+        size = 0
+        f = open(tmp_path, "wb")
+        try:
+            async def sink(chunk):
+                nonlocal size
+                hasher.update(chunk)
+                size += len(chunk)
+                await asyncio.to_thread(f.write, chunk)
+
+            media_type = await self.fetcher(key, sink)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        f.close()
+        return self._commit(key, tmp_path, size, hasher.hexdigest(), media_type)
+
+    def put_bytes(self, key, data, media_type):
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        digest = _write_file(tmp_path, data)
+        return self._commit(key, tmp_path, len(data), digest, media_type)
+
+    async def put_bytes_async(self, key, data, media_type):
+        # 파일 쓰기/해시는 스레드에서, entries/total_bytes 변경(_commit)은 이벤트 루프에서
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        digest = await asyncio.to_thread(_write_file, tmp_path, data)
+        return self._commit(key, tmp_path, len(data), digest, media_type)
+
+    def _commit(self, key, tmp_path, size, digest, media_type):
+        path = self._path(key)
+        os.replace(tmp_path, path)
+        if key in self.entries:
+            self.total_bytes -= self.entries[key].size
+        entry = CacheEntry(key, path, size, f'"{digest}"', media_type)
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump(entry.to_meta(), f)
+        self.entries[key] = entry
+        self.total_bytes += size
+        self._evict()
+        return entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.size
+        for path in (entry.path, entry.path + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+
+    async def thumbnail(self, key, size):
+        size = next((s for s in THUMBNAIL_SIZES if s >= size), THUMBNAIL_SIZES[-1])
+        variant_key = tuple(key) + (f"thumb{size}",)
+        entry = self.get(variant_key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        original = await self.fetch(key)
+        data = await asyncio.to_thread(_make_thumbnail, original.path, size)
+        return self.put_bytes(variant_key, data, "image/webp")
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _log_prefetch_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"이미지 미리 가져오기 오류: {str(task.exception())}")
+
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _make_thumbnail(path, size):
+    from PIL import Image
+    with Image.open(path) as image:
+        image.thumbnail((size, size))
+        buffered = BytesIO()
+        # 배경 제거(RMBG) 결과의 알파 채널 유지를 위해 WebP 사용
+        image.save(buffered, format="WEBP", quality=85)
+        return buffered.getvalue()
+
+
+def _parse_range(header, size):
+    # 단일 범위만 지원: bytes=start-end, bytes=start-, bytes=-suffix
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    if start == "":
+        length = int(end)
+        if length <= 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+def _iter_file(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve(entry, request: Request, cache_control):
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or entry.etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        byte_range = _parse_range(request.headers.get("range"), entry.size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{entry.size}"})
+
+    # If-Range 가 현재 ETag 와 다르면 전체 응답
+    if_range = request.headers.get("if-range")
+    if byte_range and if_range and if_range.strip() != entry.etag:
+        byte_range = None
+
+    if byte_range is None:
+        headers["Content-Length"] = str(entry.size)
+        return StreamingResponse(_iter_file(entry.path, 0, entry.size - 1), media_type=entry.media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{entry.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_iter_file(entry.path, start, end), status_code=206, media_type=entry.media_type, headers=headers)
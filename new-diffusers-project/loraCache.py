@@ -0,0 +1,207 @@
+import asyncio
+import contextlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+# 요청별 LoRA 어댑터 (체크포인트/서버를 바꾸지 않고 스타일 변경)
+# - LORA_DIR 의 <이름>.safetensors 를 요청의 loras: [{"name", "weight"}] 로 지정
+# - 3단계 캐시
+#   1) 어댑터 텐서: 메모리 LRU (LORA_CACHE_MB), 디스크 읽기는 입장 전에 스레드에서
+#   2) 파이프라인에 올린(peft) 어댑터: 최대 LORA_MAX_LOADED 개 유지, 넘치면 오래된 것부터 삭제
+#   3) 활성 조합: UNet/transformer 가중치에 fuse 해 두고 조합이 바뀔 때만 unfuse -> set_adapters -> fuse
+# - 같은 조합의 요청끼리만 동시에 실행 (메모리 스케줄러가 같은 조합을 묶어서 전환 횟수를 줄임)
+# - fp16 에서 unfuse 를 반복하면 반올림 오차가 조금씩 쌓이므로 LORA_FUSE=0 이면 fuse 없이 어댑터 레이어로 실행
+
+LORA_DIR = os.getenv("LORA_DIR", "loras")
+LORA_CACHE_MB = int(os.getenv("LORA_CACHE_MB", "2048"))
+LORA_MAX_LOADED = int(os.getenv("LORA_MAX_LOADED", "8"))
+LORA_FUSE = os.getenv("LORA_FUSE", "1") != "0"
+# 요청당 최대 어댑터 수
+LORA_MAX_PER_REQUEST = 4
+
+MB = 1024 * 1024
+
+_NAME = re.compile(r"[\w\-. ]+")
+
+
+class LoraSpec(BaseModel):
+    name: str
+    weight: float = 1.0
+
+
+class LoraManager:
+    def __init__(self, pipe, directory=LORA_DIR, cache_mb=LORA_CACHE_MB, max_loaded=LORA_MAX_LOADED,
+                 fuse=LORA_FUSE, unsupported=None):
+        # unsupported: LoRA 를 쓸 수 없는 이유 (CPU 가중치 pre-pack 등), 있으면 LoRA 요청은 400
+        self.pipe = pipe
+        self.directory = directory
+        self.cache_bytes = cache_mb * MB
+        self.max_loaded = max_loaded
+        self.fuse = fuse
+        self.unsupported = unsupported
+        self.tensors = OrderedDict()
+        self.cached_bytes = 0
+        self.loaded = OrderedDict()
+        self.active = ()
+        self.fused = False
+        self.disabled = False
+        self.users = 0
+        self.waiting = 0
+        self.hits = 0
+        self.misses = 0
+        self.switches = 0
+        self.switch_ms = 0.0
+        self.last_switch_ms = None
+        self._cache_lock = threading.Lock()
+        self._changed = asyncio.Condition()
+
+    def key(self, specs):
+        # 요청의 어댑터 목록 -> 정렬된 (이름, 가중치) 튜플 (스케줄링/중복 요청 키로 사용)
+        if not specs:
+            return ()
+        if self.unsupported:
+            raise HTTPException(status_code=400, detail=f"LoRA를 사용할 수 없습니다: {self.unsupported}")
+        if len(specs) > LORA_MAX_PER_REQUEST:
+            raise HTTPException(status_code=400, detail=f"LoRA는 요청당 최대 {LORA_MAX_PER_REQUEST}개입니다.")
+        key = {}
+        for spec in specs:
+            name = spec.name[:-len(".safetensors")] if spec.name.endswith(".safetensors") else spec.name
+            if not _NAME.fullmatch(name) or name.startswith("."):
+                raise HTTPException(status_code=400, detail=f"잘못된 LoRA 이름: {spec.name}")
+            if name in key:
+                raise HTTPException(status_code=400, detail=f"중복된 LoRA: {name}")
+            if not os.path.isfile(self.path(name)):
+                raise HTTPException(status_code=404, detail=f"LoRA '{name}'를 찾을 수 없습니다.")
+            key[name] = round(spec.weight, 3)
+        return tuple(sorted(key.items()))
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.safetensors")
+
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [
+            {"name": filename[:-len(".safetensors")], "path": os.path.join(self.directory, filename)}
+            for filename in sorted(os.listdir(self.directory))
+            if filename.endswith(".safetensors")
+        ]
+
+    def _tensors(self, name):
+        # 어댑터 텐서 (CPU, LRU)
+        from safetensors.torch import load_file
+
+        with self._cache_lock:
+            entry = self.tensors.get(name)
+            if entry is not None:
+                self.tensors.move_to_end(name)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            state = load_file(self.path(name), device="cpu")
+            size = sum(tensor.numel() * tensor.element_size() for tensor in state.values())
+            self.tensors[name] = (state, size)
+            self.cached_bytes += size
+            # 방금 읽은 어댑터는 예산보다 커도 유지
+            while self.cached_bytes > self.cache_bytes and len(self.tensors) > 1:
+                _, (_, evicted) = self.tensors.popitem(last=False)
+                self.cached_bytes -= evicted
+            return state
+
+    def prepare(self, key):
+        # 입장 전에 디스크에서 미리 읽어 둠 (조합 전환 중에는 메모리에서만 읽도록)
+        for name, _ in key:
+            self._tensors(name)
+
+    def _load(self, name):
+        if name in self.loaded:
+            self.loaded.move_to_end(name)
+            return
+        # load_lora_weights 가 키를 꺼내 쓰므로 얕은 복사본 전달
+        self.pipe.load_lora_weights(dict(self._tensors(name)), adapter_name=name)
+        self.loaded[name] = True
+
+    def _evict(self, keep):
+        for name in list(self.loaded):
+            if len(self.loaded) <= self.max_loaded:
+                break
+            if name not in keep:
+                self.pipe.delete_adapters(name)
+                del self.loaded[name]
+
+    def _activate(self, key):
+        # 실행 중인 요청이 없을 때만 호출
+        started = time.perf_counter()
+        # 전환 중 실패하면 상태를 알 수 없으므로 다음 요청에서 다시 전환
+        self.active = None
+        if self.fused:
+            self.pipe.unfuse_lora()
+            self.fused = False
+        names = [name for name, _ in key]
+        if key:
+            for name in names:
+                self._load(name)
+            self._evict(names)
+            if self.disabled:
+                self.pipe.enable_lora()
+                self.disabled = False
+            self.pipe.set_adapters(names, adapter_weights=[weight for _, weight in key])
+            if self.fuse:
+                self.pipe.fuse_lora(adapter_names=names)
+                self.fused = True
+        elif self.loaded and not self.disabled:
+            self.pipe.disable_lora()
+            self.disabled = True
+        if self.pipe.device.type == "cuda":
+            torch.cuda.synchronize()
+        self.active = key
+        self.switches += 1
+        self.last_switch_ms = (time.perf_counter() - started) * 1000
+        self.switch_ms += self.last_switch_ms
+
+    @contextlib.asynccontextmanager
+    async def use(self, key):
+        # 같은 조합끼리만 동시에 실행, 다른 조합은 실행 중인 요청이 끝난 뒤 전환
+        # 전환을 기다리는 요청이 있으면 같은 조합의 새 요청도 뒤에서 기다림 (전환이 계속 밀리지 않도록)
+        async with self._changed:
+            counted = False
+            try:
+                while self.users and (self.active != key or self.waiting > int(counted)):
+                    if not counted and self.active != key:
+                        self.waiting += 1
+                        counted = True
+                    await self._changed.wait()
+            finally:
+                if counted:
+                    self.waiting -= 1
+            if self.active != key:
+                await asyncio.to_thread(self._activate, key)
+            self.users += 1
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self.users -= 1
+                self._changed.notify_all()
+
+    def stats(self):
+        return {
+            "active": [{"name": name, "weight": weight} for name, weight in self.active or ()],
+            "fused": self.fused,
+            "loaded": list(self.loaded),
+            "cached": list(self.tensors),
+            "cached_mb": round(self.cached_bytes / MB, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "switches": self.switches,
+            "last_switch_ms": round(self.last_switch_ms, 2) if self.last_switch_ms is not None else None,
+            "avg_switch_ms": round(self.switch_ms / self.switches, 2) if self.switches else None,
+            "unsupported": self.unsupported,
+        }
@@ -0,0 +1,380 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+
+import torch
+from fastapi import HTTPException
+
+# 해상도 기반 메모리 입장 제어 (diffusers 서버용)
+# - 요청의 최대 메모리 = latent + max(UNet 단계 활성값/어텐션, VAE 디코드) 를 해상도/배치/CFG/어텐션 방식으로 추정
+# - CUDA 에서는 시작 시 512x512 1스텝 실행으로 실제 최대 사용량을 측정해 계수 보정 (파일에 저장해 재사용)
+# - 남은 예산에 들어가면 바로 실행, 아니면 대기열에서 기다리고, 예산 전체로도 안 되면 거절(422)
+# - 기본 설정으로 안 들어갈 때만 요청 단위로 VAE 타일링 / 어텐션 슬라이싱을 켬
+
+# 예산 (MB, 없으면 장치 여유 메모리 * MEMORY_FRACTION)
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_FRACTION = float(os.getenv("MEMORY_FRACTION", "0.9"))
+# 추정값에 더하는 여유 비율
+MEMORY_MARGIN = float(os.getenv("MEMORY_MARGIN", "0.1"))
+# 보정 결과 저장 경로 (빈 값이면 저장하지 않음)
+MEMORY_CALIBRATION = os.getenv("MEMORY_CALIBRATION", "memory_calibration.json")
+# 동시에 실행할 요청 수 / 대기열 길이 / 대기 시간 (초)
+MEMORY_MAX_CONCURRENT = int(os.getenv("MEMORY_MAX_CONCURRENT", "1"))
+MEMORY_MAX_QUEUE = int(os.getenv("MEMORY_MAX_QUEUE", "16"))
+MEMORY_QUEUE_TIMEOUT = float(os.getenv("MEMORY_QUEUE_TIMEOUT", "120"))
+# 현재 LoRA 조합과 같은 요청이 다른 조합의 먼저 온 요청을 앞질러 실행할 수 있는 최대 횟수 (조합 전환을 묶기 위함)
+MEMORY_ADAPTER_BYPASS = int(os.getenv("MEMORY_ADAPTER_BYPASS", "4"))
+
+# 보정 전 기본 계수 (SD 1.x fp16 기준 대략값)
+# UNet: latent 토큰 하나당 동시에 살아있는 활성값 수, VAE: 출력 픽셀 하나당 활성값 수
+UNET_ACTIVATIONS = 50000
+VAE_ACTIVATIONS = 2500
+CALIBRATION_SIZE = 512
+
+# 속도 손해가 적은 순서: (attention_slice, vae_tiling)
+CANDIDATES = [
+    (None, False),
+    (None, True),
+    ("auto", False),
+    ("auto", True),
+    ("max", False),
+    ("max", True),
+]
+
+MB = 1024 * 1024
+
+
+def device_budget(device):
+    # 가중치 로드 후 남은 메모리 기준 예산 (바이트)
+    if MEMORY_BUDGET_MB:
+        return MEMORY_BUDGET_MB * MB
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return int(free * MEMORY_FRACTION)
+    if device == "mps" and hasattr(torch.mps, "recommended_max_memory"):
+        available = torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory()
+        return int(max(available, 0) * MEMORY_FRACTION)
+    try:
+        import psutil
+        available = psutil.virtual_memory().available
+    except ImportError:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return int(available * MEMORY_FRACTION)
+
+
+def _attention_mode(module, device):
+    # 어텐션 점수 행렬을 통째로 만드는지 여부
+    processors = {type(p).__name__ for p in getattr(module, "attn_processors", {}).values()}
+    if any("XFormers" in name for name in processors):
+        return "efficient"
+    if processors and all(name == "AttnProcessor2_0" for name in processors):
+        # SDPA: CUDA/CPU 는 flash/memory-efficient 커널, MPS 는 점수 행렬을 만듦
+        return "efficient" if device in ("cuda", "cpu") else "full"
+    return "full"
+
+
+class MemoryPlan:
+    def __init__(self, width, height, batch_size, attention_slice, vae_tiling, estimate, exclusive=False,
+                 adapters=()):
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+        self.attention_slice = attention_slice
+        self.vae_tiling = vae_tiling
+        self.estimate = estimate
+        self.exclusive = exclusive
+        self.adapters = adapters
+
+    @property
+    def options(self):
+        return (self.attention_slice, self.vae_tiling)
+
+    def to_dict(self):
+        return {
+            "width": self.width,
+            "height": self.height,
+            "batch_size": self.batch_size,
+            "attention_slice": self.attention_slice,
+            "vae_tiling": self.vae_tiling,
+            "estimate_mb": round(self.estimate / MB, 1),
+            "adapters": [name for name, _ in self.adapters],
+        }
+
+
+class MemoryModel:
+    def __init__(self, pipe, device, name=""):
+        self.pipe = pipe
+        self.device = device
+        self.name = name
+        self.element_size = torch.tensor([], dtype=pipe.unet.dtype).element_size()
+        head_dim = pipe.unet.config.attention_head_dim
+        self.heads = max(head_dim) if isinstance(head_dim, (list, tuple)) else int(head_dim)
+        self.unet_attention = _attention_mode(pipe.unet, device)
+        self.vae_attention = _attention_mode(pipe.vae, device)
+        self.tile_size = getattr(pipe.vae, "tile_sample_min_size", CALIBRATION_SIZE)
+        self.unet_scale = 1.0
+        self.vae_scale = 1.0
+        self.calibrated = False
+
+    def _attention(self, tokens, batch, heads, mode, attention_slice=None):
+        # 점수 + softmax 결과
+        if attention_slice == "max":
+            return tokens * tokens * self.element_size * 2
+        if attention_slice == "auto":
+            return max(heads // 2, 1) * tokens * tokens * self.element_size * 2
+        if mode == "efficient":
+            return 0
+        return batch * heads * tokens * tokens * self.element_size * 2
+
+    def _vae(self, width, height, batch_size, vae_tiling):
+        e = self.element_size
+        if vae_tiling and max(width, height) > self.tile_size:
+            size = self.tile_size
+            # 타일 출력을 모아서 합치는 버퍼
+            output = batch_size * 3 * width * height * e * 2
+            return (batch_size * size * size * VAE_ACTIVATIONS * e
+                    + self._attention((size // 8) ** 2, batch_size, 1, self.vae_attention) + output)
+        tokens = (width // 8) * (height // 8)
+        return (batch_size * width * height * VAE_ACTIVATIONS * e
+                + self._attention(tokens, batch_size, 1, self.vae_attention))
+
+    def components(self, width, height, batch_size=1, guidance=True, attention_slice=None, vae_tiling=False):
+        tokens = (width // 8) * (height // 8)
+        # CFG 는 조건/무조건 두 배치를 한 번에 실행
+        unet_batch = batch_size * (2 if guidance else 1)
+        mode = "full" if attention_slice else self.unet_attention
+        unet = (unet_batch * tokens * UNET_ACTIVATIONS * self.element_size
+                + self._attention(tokens, unet_batch, self.heads, mode, attention_slice))
+        # latent, 노이즈 예측, 스케줄러 중간값 (fp32)
+        latents = batch_size * 4 * tokens * 4 * 3
+        return {
+            "latents": latents,
+            "unet": int(unet * self.unet_scale),
+            "vae": int(self._vae(width, height, batch_size, vae_tiling) * self.vae_scale),
+        }
+
+    def estimate(self, width, height, batch_size=1, guidance=True, attention_slice=None, vae_tiling=False):
+        parts = self.components(width, height, batch_size, guidance, attention_slice, vae_tiling)
+        peak = parts["latents"] + max(parts["unet"], parts["vae"])
+        return int(peak * (1 + MEMORY_MARGIN))
+
+    def _calibration_key(self):
+        gpu = torch.cuda.get_device_name(0) if self.device == "cuda" else self.device
+        return f"{self.name}|{gpu}|{self.pipe.unet.dtype}|{self.unet_attention}"
+
+    def load_calibration(self, path=MEMORY_CALIBRATION):
+        if not path or not os.path.exists(path):
+            return False
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f).get(self._calibration_key())
+        if entry is None:
+            return False
+        self.unet_scale = entry["unet_scale"]
+        self.vae_scale = entry["vae_scale"]
+        self.calibrated = True
+        return True
+
+    def calibrate(self, path=MEMORY_CALIBRATION):
+        # CUDA 최대 사용량 측정으로 계수 보정 (MPS/CPU 는 최대값 통계가 없어 기본 계수 사용)
+        if self.device != "cuda" or self.load_calibration(path):
+            return
+        print("메모리 모델 보정 중...")
+        size = CALIBRATION_SIZE
+        self.unet_scale = self.vae_scale = 1.0
+        with torch.inference_mode():
+            torch.cuda.synchronize()
+            base = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+            latents = self.pipe("calibration", width=size, height=size, num_inference_steps=1,
+                                output_type="latent").images
+            torch.cuda.synchronize()
+            unet_peak = torch.cuda.max_memory_allocated() - base
+
+            base = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+            self.pipe.vae.decode(latents / self.pipe.vae.config.scaling_factor, return_dict=False)
+            torch.cuda.synchronize()
+            vae_peak = torch.cuda.max_memory_allocated() - base
+        del latents
+        torch.cuda.empty_cache()
+
+        parts = self.components(size, size)
+        # 측정 오차가 커도 기본 계수에서 너무 벗어나지 않도록 제한
+        self.unet_scale = min(max(unet_peak / max(parts["unet"], 1), 0.25), 4.0)
+        self.vae_scale = min(max(vae_peak / max(parts["vae"], 1), 0.25), 4.0)
+        self.calibrated = True
+        print(f"메모리 모델 보정 완료: UNet {unet_peak / MB:.0f}MB (x{self.unet_scale:.2f}), "
+              f"VAE {vae_peak / MB:.0f}MB (x{self.vae_scale:.2f})")
+
+        if path:
+            data = {}
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            data[self._calibration_key()] = {"unet_scale": self.unet_scale, "vae_scale": self.vae_scale}
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+
+    def to_dict(self):
+        return {
+            "element_size": self.element_size,
+            "unet_attention": self.unet_attention,
+            "vae_attention": self.vae_attention,
+            "unet_scale": round(self.unet_scale, 3),
+            "vae_scale": round(self.vae_scale, 3),
+            "calibrated": self.calibrated,
+        }
+
+
+class MemoryScheduler:
+    # 예산 안에서만 동시 실행, 실행 중인 요청들은 같은 파이프라인 설정(슬라이싱/타일링)과 LoRA 조합을 공유
+    def __init__(self, model, budget, max_concurrent=MEMORY_MAX_CONCURRENT, max_queue=MEMORY_MAX_QUEUE,
+                 queue_timeout=MEMORY_QUEUE_TIMEOUT):
+        self.model = model
+        self.pipe = model.pipe
+        self.budget = budget
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = []
+        self.waiters = []
+        self.applied = None
+        # 마지막으로 실행한 LoRA 조합 / 앞질러 실행한 횟수
+        self.adapters = ()
+        self.bypassed = 0
+        self.adapter_switches = 0
+        self.admitted = 0
+        self.fallbacks = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._changed = asyncio.Condition()
+        self._apply((None, False))
+
+    @property
+    def used(self):
+        return sum(plan.estimate for plan in self.active)
+
+    def _apply(self, options):
+        # 공유 파이프라인 설정 변경 (실행 중인 요청이 없을 때만 호출)
+        if options == self.applied:
+            return
+        attention_slice, vae_tiling = options
+        if attention_slice:
+            self.pipe.enable_attention_slicing(attention_slice)
+        else:
+            self.pipe.disable_attention_slicing()
+        if vae_tiling:
+            self.pipe.enable_vae_tiling()
+        else:
+            self.pipe.disable_vae_tiling()
+        self.applied = options
+
+    def _plan(self, width, height, batch_size, guidance, exclusive, limit, candidates=CANDIDATES, adapters=()):
+        for attention_slice, vae_tiling in candidates:
+            estimate = self.model.estimate(width, height, batch_size, guidance, attention_slice, vae_tiling)
+            if estimate <= limit:
+                return MemoryPlan(width, height, batch_size, attention_slice, vae_tiling, estimate, exclusive,
+                                  adapters)
+        return None
+
+    def _eligible(self, request):
+        # 먼저 온 요청부터, 단 현재 LoRA 조합과 같은 요청은 조합 전환을 미루기 위해 몇 번까지 앞질러 실행
+        if not self.waiters or self.waiters[0] is request:
+            return True
+        return (request["adapters"] == self.adapters != self.waiters[0]["adapters"]
+                and self.bypassed < MEMORY_ADAPTER_BYPASS)
+
+    def _try_admit(self, request):
+        if self.active:
+            if (request["exclusive"] or self.active[0].exclusive or len(self.active) >= self.max_concurrent
+                    or request["adapters"] != self.active[0].adapters):
+                return None
+            # 실행 중인 요청과 같은 설정으로만 합류
+            return self._plan(**request, limit=self.budget - self.used, candidates=[self.applied])
+        return self._plan(**request, limit=self.budget)
+
+    def check(self, width, height, batch_size=1, guidance=True):
+        # 예산 전체로도 실행할 수 없는 요청은 바로 거절
+        if self._plan(width, height, batch_size, guidance, False, self.budget) is None:
+            self.rejected += 1
+            lightest = self.model.estimate(width, height, batch_size, guidance, "max", True)
+            raise HTTPException(
+                status_code=422,
+                detail=f"메모리 부족: {width}x{height} x{batch_size} 요청은 약 {lightest / MB:.0f}MB 가 필요합니다 "
+                       f"(예산 {self.budget / MB:.0f}MB).",
+            )
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, width, height, batch_size=1, guidance=True, exclusive=False, adapters=()):
+        # exclusive: 요청 단위로 공유 모듈을 패치하는 경우(토큰 병합 등) 단독 실행
+        # adapters: LoRA 조합 키 (같은 조합끼리만 동시에 실행하고, 연속 실행되도록 묶음)
+        self.check(width, height, batch_size, guidance)
+        request = {"width": width, "height": height, "batch_size": batch_size, "guidance": guidance,
+                   "exclusive": exclusive, "adapters": adapters}
+        plan = await self._acquire(request)
+        try:
+            yield plan
+        finally:
+            async with self._changed:
+                self.active.remove(plan)
+                self._changed.notify_all()
+
+    async def _acquire(self, request):
+        async with self._changed:
+            plan = self._try_admit(request) if self._eligible(request) else None
+            bypassing = plan is not None and bool(self.waiters)
+            if plan is None:
+                if len(self.waiters) >= self.max_queue:
+                    self.rejected += 1
+                    raise HTTPException(status_code=429, detail="메모리 대기열이 가득 찼습니다.",
+                                        headers={"Retry-After": str(max(int(self.queue_timeout // 4), 1))})
+                # 먼저 온 요청부터 (큰 요청이 계속 밀리지 않도록)
+                self.waiters.append(request)
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while True:
+                        if self._eligible(request):
+                            plan = self._try_admit(request)
+                            if plan is not None:
+                                bypassing = self.waiters[0] is not request
+                                break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise HTTPException(status_code=503, detail="메모리 대기 시간이 초과되었습니다.")
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    self.waiters.remove(request)
+                    self._changed.notify_all()
+
+            self.bypassed = self.bypassed + 1 if bypassing else 0
+            if not self.active:
+                self._apply(plan.options)
+                if plan.adapters != self.adapters:
+                    self.adapter_switches += 1
+                    self.adapters = plan.adapters
+            self.active.append(plan)
+            self.admitted += 1
+            if plan.options != (None, False):
+                self.fallbacks += 1
+                print(f"메모리 절약 설정 적용: {plan.to_dict()}")
+            return plan
+
+    def stats(self):
+        return {
+            "budget_mb": round(self.budget / MB, 1),
+            "used_mb": round(self.used / MB, 1),
+            "active": [plan.to_dict() for plan in self.active],
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "fallbacks": self.fallbacks,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "adapter_switches": self.adapter_switches,
+            "model": self.model.to_dict(),
+        }
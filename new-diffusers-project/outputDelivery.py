@@ -0,0 +1,174 @@
+import asyncio
+import os
+import struct
+import time
+
+# 최종 이미지 메모리 전달 (SaveImage -> SaveImageWebsocket)
+# - 디스크 저장 + /history + /view 조회 + 브라우저의 /api/image 요청 대신
+#   ComfyUI 가 웹소켓 바이너리 채널로 보낸 PNG 를 프록시가 받아 바로 클라이언트에 전달
+# - 받은 이미지는 백그라운드에서 출력 디렉터리(OUTPUT_DIR)와 이미지 캐시에 저장 (OUTPUT_PERSIST=0 이면 저장하지 않고 URL 없이 전달만)
+#   캐시 키는 ComfyUI 의 output 이미지와 같은 형식이라 /api/image 는 ComfyUI 를 거치지 않고 캐시에서 응답
+#   캐시에서 밀려나도 ComfyUI 에는 없는 파일이므로 출력 디렉터리에서 다시 읽음
+# - 같은 프롬프트에 합류한 요청도 같은 프레임을 받으므로 같은 URL 로 응답 (저장은 키별로 한 번, 모두 그 저장을 기다림)
+# - SaveImageWebsocket 은 IS_CHANGED 가 항상 달라 ComfyUI 캐시에 걸려도 매번 이미지를 보냄
+
+# disk | websocket (웹소켓 prompt 메시지의 delivery 로 요청별 지정)
+OUTPUT_DELIVERY = os.getenv("OUTPUT_DELIVERY", "disk")
+OUTPUT_PERSIST = os.getenv("OUTPUT_PERSIST", "1") != "0"
+# 프록시가 직접 받은/만든 출력 이미지 저장 위치 (캐시 크기 제한으로 삭제되지 않음)
+OUTPUT_DIR = os.getenv("OUTPUT_DIR", "outputs")
+
+DELIVERY_MODES = ("disk", "websocket")
+WEBSOCKET_OUTPUT = "SaveImageWebsocket"
+
+# ComfyUI 바이너리 메시지 헤더: [event type (4 bytes)] [image format (4 bytes)] [image]
+PREVIEW_IMAGE = 1
+FORMATS = {1: ("jpg", "image/jpeg"), 2: ("png", "image/png")}
+MEDIA_TYPES = {extension: media_type for extension, media_type in FORMATS.values()}
+
+
+def websocket_outputs(graph):
+    # SaveImage 노드를 같은 입력의 SaveImageWebsocket 으로 교체 (바뀌는 노드만 복사)
+    result = {}
+    for node_id, node in graph.items():
+        if node["class_type"] == "SaveImage":
+            node = {**node, "class_type": WEBSOCKET_OUTPUT, "inputs": {"images": node["inputs"]["images"]}}
+        result[node_id] = node
+    return result
+
+
+def websocket_nodes(node_types):
+    return {node_id for node_id, class_type in (node_types or {}).items() if class_type == WEBSOCKET_OUTPUT}
+
+
+def save_output(filename, data):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    path = os.path.join(OUTPUT_DIR, filename)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def output_path(filename):
+    # 출력 디렉터리의 파일 경로, 없거나 경로가 들어간 이름이면 None
+    if not filename or filename.startswith(".") or "\\" in filename or os.path.basename(filename) != filename:
+        return None
+    path = os.path.join(OUTPUT_DIR, filename)
+    return path if os.path.isfile(path) else None
+
+
+def output_media_type(filename):
+    return MEDIA_TYPES.get(filename.rsplit(".", 1)[-1].lower(), "image/png")
+
+
+async def store(cache, key, image, media_type):
+    await asyncio.to_thread(save_output, key[0], image)
+    # 캐시 상태는 이벤트 루프에서만 변경 (파일 쓰기만 스레드)
+    await cache.put_bytes_async(key, image, media_type)
+
+
+class DeliveredImages:
+    # 프롬프트 하나의 웹소켓 출력 이미지 (노드별 순서대로 받음)
+    def __init__(self, prompt_id, cache, backend_name, persist=OUTPUT_PERSIST, stats=None):
+        self.prompt_id = prompt_id
+        self.cache = cache
+        self.backend_name = backend_name
+        self.persist = persist
+        self.stats = stats
+        self.images = []
+        self.tasks = []
+
+    def add(self, node_id, data):
+        # 반환: (이미지 정보, 이미지 바이트), 이미지가 아닌 바이너리 메시지면 None
+        if len(data) < 8:
+            return None
+        event_type, image_format = struct.unpack(">II", data[:8])
+        if event_type != PREVIEW_IMAGE or image_format not in FORMATS:
+            return None
+        extension, media_type = FORMATS[image_format]
+        index = sum(1 for image in self.images if image["node"] == node_id)
+        info = {
+            "node": node_id,
+            "index": index,
+            "filename": f"ws_{self.prompt_id}_{node_id}_{index:05}.{extension}",
+            "subfolder": "",
+            "type": "output",
+            "media_type": media_type,
+        }
+        image = data[8:]
+        self.images.append(info)
+        if self.stats is not None:
+            self.stats.images += 1
+            self.stats.bytes += len(image)
+        if self.persist:
+            # /api/image 의 캐시 키와 같은 형식 (prompt_id 포함)
+            key = (info["filename"], "", "output", self.backend_name, self.prompt_id)
+            if self.stats is not None:
+                self.tasks.append(self.stats.store(self.cache, key, image, media_type))
+            else:
+                self.tasks.append(asyncio.ensure_future(store(self.cache, key, image, media_type)))
+        return info, image
+
+    async def wait(self):
+        # 저장 완료 대기 (결과 URL 을 보내기 전, 저장 실패한 이미지는 기록에서 제외)
+        results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        for info, result in zip(self.images, results):
+            if isinstance(result, Exception):
+                print(f"이미지 저장 오류: {info['filename']}, {str(result)}")
+                info["failed"] = True
+                if self.stats is not None:
+                    self.stats.failed += 1
+
+    def outputs(self):
+        # 히스토리 형식 노드별 출력 (저장한 이미지만)
+        outputs = {}
+        if not self.persist:
+            return outputs
+        for info in self.images:
+            if not info.get("failed"):
+                outputs.setdefault(info["node"], {"images": []})["images"].append(
+                    {"filename": info["filename"], "subfolder": "", "type": "output"}
+                )
+        return outputs
+
+
+class DeliveryStats:
+    def __init__(self):
+        self.prompts = 0
+        self.images = 0
+        self.bytes = 0
+        self.persisted = 0
+        self.failed = 0
+        self.persist_ms = 0.0
+        # 키 -> 저장 중인 태스크 (합류한 요청이 같은 파일을 동시에 쓰지 않도록)
+        self.storing = {}
+
+    def capture(self, prompt_id, cache, backend_name):
+        self.prompts += 1
+        return DeliveredImages(prompt_id, cache, backend_name, stats=self)
+
+    def store(self, cache, key, image, media_type):
+        task = self.storing.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._store(cache, key, image, media_type))
+            self.storing[key] = task
+            task.add_done_callback(lambda _: self.storing.pop(key, None))
+        return task
+
+    async def _store(self, cache, key, image, media_type):
+        started = time.perf_counter()
+        await store(cache, key, image, media_type)
+        self.persisted += 1
+        self.persist_ms += (time.perf_counter() - started) * 1000
+
+    def stats(self):
+        return {
+            "default": OUTPUT_DELIVERY,
+            "persist": OUTPUT_PERSIST,
+            "prompts": self.prompts,
+            "images": self.images,
+            "mb": round(self.bytes / (1024 * 1024), 1),
+            "persisted": self.persisted,
+            "failed": self.failed,
+            "avg_persist_ms": round(self.persist_ms / self.persisted, 2) if self.persisted else None,
+        }
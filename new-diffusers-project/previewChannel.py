@@ -0,0 +1,122 @@
+import asyncio
+import json
+import struct
+import time
+from io import BytesIO
+
+# 클라이언트별 샘플링 미리보기 채널
+# - 최신 프레임만 유지 (전송 전에 새 프레임이 오면 이전 프레임은 버림)
+# - 최대 프레임 속도 제한
+# - 클라이언트가 요청한 크기로 축소 후 JPEG 재인코딩
+# - 연결의 전송 대기 메시지가 많으면 (느린 클라이언트) 프레임을 버림
+# 최종 이미지는 이 채널을 거치지 않고 항상 전송
+
+# ComfyUI 바이너리 메시지 헤더: [event type (4 bytes)] [image format (4 bytes)] [image]
+PREVIEW_IMAGE = 1
+FORMAT_JPEG = 1
+FORMAT_PNG = 2
+
+
+def resize_preview(data, size, quality=80):
+    if len(data) < 8:
+        return data
+    event_type, _ = struct.unpack(">II", data[:8])
+    if event_type != PREVIEW_IMAGE:
+        return data
+    from PIL import Image
+    with Image.open(BytesIO(data[8:])) as image:
+        if max(image.size) <= size:
+            return data
+        image.thumbnail((size, size))
+        buffered = BytesIO()
+        image.convert("RGB").save(buffered, format="JPEG", quality=quality)
+    return struct.pack(">II", PREVIEW_IMAGE, FORMAT_JPEG) + buffered.getvalue()
+
+
+class PreviewChannel:
+    def __init__(self, manager, client_id, max_fps=4.0, size=0, max_pending=4, quality=80):
+        self.manager = manager
+        self.client_id = client_id
+        self.enabled = True
+        self.max_fps = max_fps
+        self.size = size
+        self.max_pending = max_pending
+        self.quality = quality
+        self.sent = 0
+        self.dropped = 0
+        # (bytes, meta) - 아직 전송하지 않은 최신 프레임
+        self._latest = None
+        self._ready = asyncio.Event()
+        self._last_sent = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._latest = None
+
+    def configure(self, enabled=None, max_fps=None, size=None):
+        if enabled is not None:
+            self.enabled = bool(enabled)
+            if not self.enabled:
+                self._latest = None
+        if max_fps is not None:
+            self.max_fps = max(float(max_fps), 0.1)
+        if size is not None:
+            self.size = max(int(size), 0)
+        return self.settings()
+
+    def settings(self):
+        return {"enabled": self.enabled, "max_fps": self.max_fps, "size": self.size}
+
+    def offer(self, data, meta):
+        if not self.enabled:
+            return
+        if self._latest is not None:
+            self.dropped += 1
+        self._latest = (data, meta)
+        self._ready.set()
+
+    def discard(self, prompt_id):
+        # 최종 결과가 나온 프롬프트의 오래된 미리보기는 보내지 않음
+        if self._latest is not None and self._latest[1].get("prompt_id") == prompt_id:
+            self._latest = None
+            self.dropped += 1
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+
+            # 최대 프레임 속도 (기다리는 동안 들어온 프레임이 최신 프레임이 됨)
+            delay = self._last_sent + 1.0 / self.max_fps - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            frame, self._latest = self._latest, None
+            if frame is None:
+                continue
+            if self.manager.pending(self.client_id) >= self.max_pending:
+                self.dropped += 1
+                continue
+
+            data, meta = frame
+            try:
+                if self.size:
+                    data = await asyncio.to_thread(resize_preview, data, self.size, self.quality)
+            except Exception as e:
+                print(f"미리보기 변환 오류: {str(e)}")
+                continue
+            await self.manager.send_bytes(self.client_id, data)
+            await self.manager.send_message(self.client_id, json.dumps(meta))
+            self._last_sent = time.monotonic()
+            self.sent += 1
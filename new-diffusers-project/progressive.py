@@ -0,0 +1,103 @@
+import base64
+import math
+import os
+from io import BytesIO
+
+import torch
+import torch.nn.functional as F
+
+# 초안 -> 정제 (progressive) 생성
+# 1) 초안: 작은 latent (기본 가로/세로 1/2) 에서 적은 스텝으로 생성하고 바로 디코드해서 먼저 전송
+# 2) 정제: 초안 latent 를 목표 크기로 보간(latent upscale)한 뒤 img2img 로 뒤쪽 일부 스텝만 다시 디노이즈
+#    (처음부터 다시 생성하지 않고 초안 구도를 그대로 사용)
+# 상대 비용 ≈ scale^2 * (초안 스텝 / 전체 스텝) + strength  (전체 해상도 1회 실행 = 1)
+# SD 1.x (4채널 latent) 와 Flux (16채널, 2x2 패킹 latent) 지원
+
+DRAFT_SCALE = float(os.getenv("PROGRESSIVE_DRAFT_SCALE", "0.5"))
+# 전체 스텝 대비 초안 스텝 비율
+DRAFT_STEPS = float(os.getenv("PROGRESSIVE_DRAFT_STEPS", "0.6"))
+REFINE_STRENGTH = float(os.getenv("PROGRESSIVE_STRENGTH", "0.5"))
+
+
+def encode_png(image):
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+class ProgressiveGenerator:
+    def __init__(self, pipe, refiner):
+        # refiner: 같은 컴포넌트로 만든 img2img 파이프라인 (가중치 공유)
+        self.pipe = pipe
+        self.refiner = refiner
+        self.flux = hasattr(pipe, "_unpack_latents")
+        self.vae_scale_factor = pipe.vae_scale_factor
+        # Flux 는 latent 를 2x2 로 패킹하므로 16 픽셀 단위
+        self.multiple = self.vae_scale_factor * (2 if self.flux else 1)
+
+    def plan(self, width, height, steps, scale=None, draft_steps=None, strength=None):
+        scale = DRAFT_SCALE if scale is None else min(max(scale, 0.25), 1.0)
+        strength = REFINE_STRENGTH if strength is None else min(max(strength, 0.05), 1.0)
+        if draft_steps is None:
+            draft_steps = max(math.ceil(steps * DRAFT_STEPS), min(steps, 4))
+        # img2img 는 int(steps * strength) 스텝만 실행 (최소 1스텝)
+        strength = max(strength, 1.0 / steps)
+        m = self.multiple
+        draft_width = max(m, int(width * scale) // m * m)
+        draft_height = max(m, int(height * scale) // m * m)
+        refine_steps = int(steps * strength)
+        cost = (draft_width * draft_height) / (width * height) * draft_steps / steps + refine_steps / steps
+        return {
+            "width": width,
+            "height": height,
+            "draft_width": draft_width,
+            "draft_height": draft_height,
+            "steps": steps,
+            "draft_steps": draft_steps,
+            "strength": strength,
+            "refine_steps": refine_steps,
+            "relative_cost": round(cost, 3),
+        }
+
+    def draft(self, run_pipe, plan, generator, **kwargs):
+        # 반환: (latent, 초안 PIL 이미지)
+        latents = run_pipe(
+            width=plan["draft_width"],
+            height=plan["draft_height"],
+            num_inference_steps=plan["draft_steps"],
+            generator=generator,
+            output_type="latent",
+            **kwargs,
+        ).images
+        return latents, self.decode(latents, plan["draft_width"], plan["draft_height"])
+
+    def refine(self, run_refiner, latents, plan, generator, **kwargs):
+        if self.flux:
+            kwargs.update(width=plan["width"], height=plan["height"])
+        return run_refiner(
+            image=self.upscale(latents, plan),
+            strength=plan["strength"],
+            num_inference_steps=plan["steps"],
+            generator=generator,
+            **kwargs,
+        ).images[0]
+
+    def _unpacked(self, latents, width, height):
+        if self.flux:
+            return self.pipe._unpack_latents(latents, height, width, self.vae_scale_factor)
+        return latents
+
+    def upscale(self, latents, plan):
+        # img2img 는 채널 수가 latent 와 같으면 VAE 인코딩 없이 그대로 시작 latent 로 사용
+        latents = self._unpacked(latents, plan["draft_width"], plan["draft_height"])
+        size = (plan["height"] // self.vae_scale_factor, plan["width"] // self.vae_scale_factor)
+        return F.interpolate(latents, size=size, mode="bilinear", align_corners=False)
+
+    def decode(self, latents, width, height):
+        vae = self.pipe.vae
+        with torch.inference_mode():
+            latents = self._unpacked(latents, width, height) / vae.config.scaling_factor
+            if self.flux:
+                latents = latents + vae.config.shift_factor
+            image = vae.decode(latents.to(vae.dtype), return_dict=False)[0]
+        return self.pipe.image_processor.postprocess(image, output_type="pil")[0]
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+import websockets
+
+from comfyClient import ws_url_for
+from workflowOptimizer import optimize
+from workflowTemplates import TemplateStore
+
+# ComfyUI 프록시 계층 자체 오버헤드 벤치마크 (stubComfy.py 대역 서버와 함께 사용, GPU 불필요)
+# 1) python stubComfy.py --port 8188 --step-time 0.01
+# 2) COMFY_SERVERS=http://127.0.0.1:8188 python compyExample.py   (또는 testCompyuiAPI.py)
+# 3) python proxyBenchmark.py latency --runs 50
+#    python proxyBenchmark.py clients --max-clients 2000
+#    python proxyBenchmark.py fanout --clients 50
+#    python proxyBenchmark.py latency --api simple --workflow 20250331WF   (testCompyuiAPI.py /generate)
+
+PROXY_URL = "http://127.0.0.1:8000"
+STUB_URL = "http://127.0.0.1:8188"
+WORKFLOW = "default"
+PROMPT = "1 girl, from head to toe, medieval fantasy, gray background"
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(values):
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "mean_ms": round(statistics.mean(values) * 1000, 2),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+
+async def direct_roundtrip(client, stub_url, workflow):
+    # 기준값: 대역 서버에 직접 제출하고 완료 이벤트 후 히스토리 조회
+    client_id = uuid.uuid4().hex
+    started = time.perf_counter()
+    async with websockets.connect(f"{ws_url_for(stub_url)}?clientId={client_id}", max_size=None) as ws:
+        res = await client.post(f"{stub_url}/prompt", json={"prompt": workflow, "client_id": client_id})
+        res.raise_for_status()
+        prompt_id = res.json()["prompt_id"]
+        async for out in ws:
+            if isinstance(out, str):
+                message = json.loads(out)
+                data = message.get("data") or {}
+                if message["type"] == "executing" and data.get("node") is None and data.get("prompt_id") == prompt_id:
+                    break
+        await client.get(f"{stub_url}/history/{prompt_id}")
+    return time.perf_counter() - started
+
+
+async def proxy_roundtrip(proxy_url, workflow_name, seed):
+    # 프록시 웹소켓으로 프롬프트 제출 후 result 메시지까지
+    client_id = uuid.uuid4().hex
+    started = time.perf_counter()
+    async with websockets.connect(f"{ws_url_for(proxy_url)}/{client_id}", max_size=None) as ws:
+        await ws.send(json.dumps({"type": "prompt", "workflow_name": workflow_name, "prompt_text": PROMPT, "seed": seed}))
+        async for out in ws:
+            if isinstance(out, str):
+                message = json.loads(out)
+                if message["type"] in ("result", "error", "rejected", "connection_error"):
+                    if message["type"] != "result":
+                        raise RuntimeError(message.get("message"))
+                    break
+    return time.perf_counter() - started
+
+
+async def simple_roundtrip(client, proxy_url):
+    # testCompyuiAPI.py /generate (완료까지 대기하는 REST)
+    started = time.perf_counter()
+    res = await client.post(f"{proxy_url}/generate", json={"prompt": PROMPT}, timeout=120)
+    res.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def bench_latency(args):
+    # 프록시가 보내는 것과 같은 그래프를 대역 서버에 직접 제출
+    template = TemplateStore(args.workflow_dir).get(args.workflow)
+    direct, proxied = [], []
+    async with httpx.AsyncClient(timeout=60) as client:
+        for run in range(args.warmup + args.runs):
+            # 번갈아 실행하고 시드를 매번 바꿔서 두 경로의 대역 서버 캐시 상태(샘플러 재실행)를 맞춤
+            workflow = optimize(template.render(prompt=PROMPT, seed=2 * run + 1))
+            d = await direct_roundtrip(client, args.stub, workflow)
+            if args.api == "simple":
+                p = await simple_roundtrip(client, args.proxy)
+            else:
+                p = await proxy_roundtrip(args.proxy, args.workflow, 2 * run + 2)
+            if run >= args.warmup:
+                direct.append(d)
+                proxied.append(p)
+    overhead = [p - d for p, d in zip(proxied, direct)]
+    return {"direct": summarize(direct), "proxy": summarize(proxied), "overhead": summarize(overhead)}
+
+
+async def bench_clients(args):
+    # 동시 웹소켓 연결 수를 늘리면서 연결 상태 메시지를 받지 못하는 지점 확인
+    sockets = []
+    connect_times = []
+    failures = 0
+    try:
+        while len(sockets) < args.max_clients:
+            batch = []
+            for _ in range(min(args.step, args.max_clients - len(sockets))):
+                batch.append(_open_client(args.proxy))
+            results = await asyncio.gather(*batch, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    failures += 1
+                else:
+                    ws, elapsed = result
+                    sockets.append(ws)
+                    connect_times.append(elapsed)
+            print(f"연결 {len(sockets)}개, 실패 {failures}개")
+            if failures:
+                break
+    finally:
+        await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+    return {"max_connected": len(sockets), "failures": failures, "connect": summarize(connect_times)}
+
+
+async def _open_client(proxy_url):
+    started = time.perf_counter()
+    ws = await websockets.connect(f"{ws_url_for(proxy_url)}/{uuid.uuid4().hex}", max_size=None, open_timeout=10)
+    message = json.loads(await asyncio.wait_for(ws.recv(), 10))
+    if message.get("status") != "connected":
+        await ws.close()
+        raise RuntimeError(message.get("message"))
+    return ws, time.perf_counter() - started
+
+
+async def bench_fanout(args):
+    # 여러 클라이언트가 동시에 제출하고 받은 이벤트 수 / 시간
+    counts = []
+
+    async def run_client(index):
+        client_id = uuid.uuid4().hex
+        received = 0
+        async with websockets.connect(f"{ws_url_for(args.proxy)}/{client_id}", max_size=None) as ws:
+            await ws.recv()
+            await ws.send(json.dumps({"type": "prompt", "workflow_name": args.workflow, "prompt_text": PROMPT, "seed": index + 1}))
+            async for out in ws:
+                received += 1
+                if isinstance(out, str) and json.loads(out)["type"] in ("result", "error", "rejected"):
+                    break
+        counts.append(received)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    total = sum(counts)
+    return {
+        "clients": args.clients,
+        "events": total,
+        "seconds": round(elapsed, 2),
+        "events_per_second": round(total / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyUI 프록시 오버헤드 벤치마크")
+    parser.add_argument("--proxy", default=PROXY_URL)
+    parser.add_argument("--stub", default=STUB_URL)
+    parser.add_argument("--workflow", default=WORKFLOW)
+    parser.add_argument("--workflow-dir", default="workflowJSON")
+    parser.add_argument("--out", help="결과 JSON 저장 경로")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    latency = sub.add_parser("latency", help="요청당 추가 지연 (직접 호출 대비)")
+    latency.add_argument("--runs", type=int, default=20)
+    latency.add_argument("--warmup", type=int, default=2)
+    latency.add_argument("--api", choices=["compy", "simple"], default="compy",
+                         help="compy: compyExample.py 웹소켓, simple: testCompyuiAPI.py /generate")
+
+    clients = sub.add_parser("clients", help="최대 동시 웹소켓 클라이언트 수")
+    clients.add_argument("--max-clients", type=int, default=1000)
+    clients.add_argument("--step", type=int, default=100)
+
+    fanout = sub.add_parser("fanout", help="이벤트 분배 처리량")
+    fanout.add_argument("--clients", type=int, default=20)
+
+    args = parser.parse_args()
+    bench = {"latency": bench_latency, "clients": bench_clients, "fanout": bench_fanout}[args.command]
+    result = asyncio.run(bench(args))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
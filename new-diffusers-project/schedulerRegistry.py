@@ -0,0 +1,127 @@
+import copy
+import threading
+
+from diffusers import (
+    DDIMScheduler,
+    DEISMultistepScheduler,
+    DPMSolverMultistepScheduler,
+    DPMSolverSinglestepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    HeunDiscreteScheduler,
+    KDPM2AncestralDiscreteScheduler,
+    KDPM2DiscreteScheduler,
+    LCMScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+    UniPCMultistepScheduler,
+)
+
+# A1111 샘플러 이름 -> (diffusers 스케줄러, 추가 설정, 권장 스텝 수)
+SAMPLERS = {
+    "Euler a": (EulerAncestralDiscreteScheduler, {}, 20),
+    "Euler": (EulerDiscreteScheduler, {}, 20),
+    "LMS": (LMSDiscreteScheduler, {}, 25),
+    "LMS Karras": (LMSDiscreteScheduler, {"use_karras_sigmas": True}, 20),
+    "Heun": (HeunDiscreteScheduler, {}, 12),
+    "DPM2": (KDPM2DiscreteScheduler, {}, 12),
+    "DPM2 a": (KDPM2AncestralDiscreteScheduler, {}, 15),
+    "DPM++ 2M": (DPMSolverMultistepScheduler, {}, 12),
+    "DPM++ 2M Karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}, 10),
+    "DPM++ 2M SDE": (DPMSolverMultistepScheduler, {"algorithm_type": "sde-dpmsolver++"}, 15),
+    "DPM++ 2M SDE Karras": (DPMSolverMultistepScheduler, {"algorithm_type": "sde-dpmsolver++", "use_karras_sigmas": True}, 12),
+    "DPM++ SDE Karras": (DPMSolverSinglestepScheduler, {"use_karras_sigmas": True}, 12),
+    "DEIS": (DEISMultistepScheduler, {}, 12),
+    "UniPC": (UniPCMultistepScheduler, {}, 10),
+    "DDIM": (DDIMScheduler, {}, 20),
+    "PLMS": (PNDMScheduler, {"skip_prk_steps": True}, 25),
+    # LCM은 LCM 증류 모델/LoRA 가 있어야 4~8 스텝에서 품질이 나옴
+    "LCM": (LCMScheduler, {}, 4),
+}
+
+# 소문자/변형 이름 허용
+ALIASES = {
+    "k_euler_a": "Euler a",
+    "k_euler": "Euler",
+    "k_lms": "LMS",
+    "k_heun": "Heun",
+    "k_dpm_2": "DPM2",
+    "k_dpm_2_a": "DPM2 a",
+    "dpmpp_2m": "DPM++ 2M",
+    "dpmpp_2m_karras": "DPM++ 2M Karras",
+    "dpmpp_2m_sde": "DPM++ 2M SDE",
+    "dpmpp_2m_sde_karras": "DPM++ 2M SDE Karras",
+    "dpmpp_sde_karras": "DPM++ SDE Karras",
+    "deis": "DEIS",
+    "unipc": "UniPC",
+    "ddim": "DDIM",
+    "plms": "PLMS",
+    "lcm": "LCM",
+}
+
+
+def resolve_name(name):
+    if name in SAMPLERS:
+        return name
+    lowered = name.strip().lower()
+    if lowered in ALIASES:
+        return ALIASES[lowered]
+    for sampler in SAMPLERS:
+        if sampler.lower() == lowered:
+            return sampler
+    return None
+
+
+class SchedulerRegistry:
+    def __init__(self, pipe):
+        # 파이프라인 기본 스케줄러 설정을 기준으로 각 샘플러를 한 번만 생성
+        self.base_config = dict(pipe.scheduler.config)
+        self._prototypes = {}
+        self._lock = threading.Lock()
+
+    def _prototype(self, name):
+        with self._lock:
+            if name not in self._prototypes:
+                scheduler_cls, options, _ = SAMPLERS[name]
+                self._prototypes[name] = scheduler_cls.from_config(self.base_config, **options)
+            return self._prototypes[name]
+
+    def get(self, name):
+        # 스케줄러는 set_timesteps/step_index 상태를 가지므로 요청마다 복사본 사용
+        resolved = resolve_name(name)
+        if resolved is None:
+            raise KeyError(name)
+        return copy.deepcopy(self._prototype(resolved))
+
+    def recommended_steps(self, name):
+        resolved = resolve_name(name)
+        if resolved is None:
+            raise KeyError(name)
+        return SAMPLERS[resolved][2]
+
+    def warmup(self):
+        for name in SAMPLERS:
+            try:
+                self._prototype(name)
+            except Exception as e:
+                print(f"스케줄러 생성 실패 ({name}): {e}")
+
+    def list_samplers(self):
+        # A1111 /sdapi/v1/samplers 응답 형식
+        samplers = []
+        for name, (scheduler_cls, options, steps) in SAMPLERS.items():
+            samplers.append({
+                "name": name,
+                "aliases": [alias for alias, target in ALIASES.items() if target == name],
+                "options": {k: str(v) for k, v in options.items()},
+                "scheduler": scheduler_cls.__name__,
+                "recommended_steps": steps,
+            })
+        return samplers
+
+
+def pipeline_with_scheduler(pipe, scheduler):
+    # 공유 파이프라인을 바꾸지 않도록 얕은 복사본에 스케줄러만 교체 (가중치는 공유)
+    view = copy.copy(pipe)
+    view.scheduler = scheduler
+    return view
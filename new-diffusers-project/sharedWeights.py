@@ -0,0 +1,346 @@
+import argparse
+import importlib
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+import warnings
+
+import torch
+
+# 한 호스트의 여러 워커 프로세스가 모델 가중치 한 벌을 공유 (Flux transformer / T5 text_encoder_2)
+# - export (로더 프로세스): 컴포넌트 가중치를 공유 메모리(/dev/shm 등)에 safetensors 로 한 번만 저장 + manifest.json
+# - attach (워커): 빈(meta) 모듈을 만들고 파일을 읽기 전용 mmap 해서 텐서를 복사 없이 연결
+#   -> 페이지 캐시를 모든 워커가 공유하고, 워커마다 늘어나는 메모리는 활성값과 작은 컴포넌트뿐
+# - report: 워커 N개를 띄워 프로세스별 RSS / PSS / 전용 메모리 측정
+# - verify: 원래 방식(from_single_file / from_pretrained)으로 로드한 가중치, 생성 결과와 비트 단위 비교
+# 공유되는 것은 CPU 메모리의 가중치. GPU 로 옮기면 프로세스마다 VRAM 사본이 생기고,
+# IPEX/inductor 가중치 pre-pack 도 사본을 만들기 때문에 공유 컴포넌트에는 적용하지 않음
+
+# 공유 가중치 폴더 (설정되면 Flux 서버가 직접 로드 대신 attach)
+SHARED_WEIGHTS = os.getenv("SHARED_WEIGHTS", "")
+SHARED_COMPONENTS = [name for name in os.getenv("SHARED_COMPONENTS", "transformer,text_encoder_2").split(",") if name]
+MANIFEST = "manifest.json"
+
+# safetensors dtype 이름
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+DTYPE_NAMES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+MB = 1024 * 1024
+
+
+def _config_of(module):
+    config = module.config
+    if hasattr(config, "to_dict"):
+        # transformers PretrainedConfig
+        return config.to_dict()
+    # diffusers FrozenDict
+    return dict(config)
+
+
+def _class_path(module):
+    return f"{type(module).__module__}.{type(module).__name__}"
+
+
+def export_component(module, name, directory):
+    # 같은 저장소를 가리키는 텐서(묶인 임베딩 등)는 한 번만 저장하고 별칭으로 기록
+    from safetensors.torch import save_file
+
+    state = module.state_dict()
+    tensors = {}
+    aliases = {}
+    seen = {}
+    for key, tensor in state.items():
+        ptr = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if tensor.numel() and ptr in seen:
+            aliases[key] = seen[ptr]
+            continue
+        seen[ptr] = key
+        tensors[key] = tensor.detach().to("cpu").contiguous()
+
+    filename = f"{name}.safetensors"
+    path = os.path.join(directory, filename)
+    save_file(tensors, path + ".tmp", metadata={"component": name})
+    os.replace(path + ".tmp", path)
+
+    dtypes = {str(t.dtype) for t in tensors.values() if t.is_floating_point()}
+    return {
+        "file": filename,
+        "class": _class_path(module),
+        "config": _config_of(module),
+        "aliases": aliases,
+        "dtype": dtypes.pop() if len(dtypes) == 1 else None,
+        "bytes": os.path.getsize(path),
+    }
+
+
+def export(components, directory):
+    # components: {이름: 모듈}
+    os.makedirs(directory, exist_ok=True)
+    manifest = {"created": time.time(), "components": {}}
+    for name, module in components.items():
+        started = time.perf_counter()
+        manifest["components"][name] = export_component(module, name, directory)
+        print(f"공유 가중치 저장: {name} ({manifest['components'][name]['bytes'] / MB:.0f}MB, "
+              f"{time.perf_counter() - started:.1f}초)")
+    # manifest 는 마지막에 써서 워커가 저장 중인 파일에 붙지 않도록 함
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+    return manifest
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"공유 가중치가 없습니다: {path} (먼저 python sharedWeights.py export --dir {directory} 실행)"
+        )
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def map_tensors(path, copy=False):
+    # safetensors 헤더를 직접 읽고 데이터 영역을 mmap 뷰로 반환 (copy=True 면 일반 로드처럼 복사)
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = 8 + header_size
+    tensors = {}
+    with warnings.catch_warnings():
+        # 읽기 전용 버퍼 경고 (추론에서는 가중치에 쓰지 않음)
+        warnings.simplefilter("ignore", UserWarning)
+        for key, info in header.items():
+            if key == "__metadata__":
+                continue
+            dtype = DTYPES[info["dtype"]]
+            begin, end = info["data_offsets"]
+            count = (end - begin) // torch.tensor([], dtype=dtype).element_size()
+            if count == 0:
+                tensors[key] = torch.empty(info["shape"], dtype=dtype)
+                continue
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=start + begin).reshape(info["shape"])
+            tensors[key] = tensor.clone() if copy else tensor
+    return tensors
+
+
+def _empty_module(class_path, config):
+    from accelerate import init_empty_weights
+
+    module_name, class_name = class_path.rsplit(".", 1)
+    cls = getattr(importlib.import_module(module_name), class_name)
+    with init_empty_weights():
+        config_class = getattr(cls, "config_class", None)
+        if config_class is not None:
+            # transformers 모델
+            return cls(config_class.from_dict(config))
+        return cls.from_config(config)
+
+
+def attach(directory, name, dtype=None, copy=False):
+    # 공유 가중치로 컴포넌트 생성 (copy=True 는 비교용 일반 로드)
+    entry = read_manifest(directory)["components"][name]
+    if dtype is not None and entry["dtype"] not in (None, str(dtype)):
+        # 변환하면 워커마다 사본이 생겨 공유 의미가 없으므로 변환하지 않고 다시 내보내도록 안내
+        # (CUDA 워커는 float16, CPU 워커는 float32)
+        raise ValueError(
+            f"공유 가중치 dtype 불일치: {name} 은 {entry['dtype']}, 워커는 {dtype}. "
+            f"export --dtype {str(dtype).replace('torch.', '')} 로 다시 내보내세요."
+        )
+    tensors = map_tensors(os.path.join(directory, entry["file"]), copy=copy)
+    for alias, target in entry["aliases"].items():
+        tensors[alias] = tensors[target]
+    module = _empty_module(entry["class"], entry["config"])
+    module.load_state_dict(tensors, strict=True, assign=True)
+    module.eval()
+    module.requires_grad_(False)
+    return module
+
+
+def memory_usage(pid="self"):
+    # 프로세스 메모리 (MB): rss, pss(공유 페이지를 나눠 계산), private(이 프로세스만 쓰는 페이지), shared
+    path = f"/proc/{pid}/smaps_rollup"
+    if os.path.exists(path):
+        values = {}
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    values[parts[0][:-1]] = int(parts[1]) * 1024
+        return {
+            "rss_mb": round(values.get("Rss", 0) / MB, 1),
+            "pss_mb": round(values.get("Pss", 0) / MB, 1),
+            "private_mb": round((values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)) / MB, 1),
+            "shared_mb": round((values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0)) / MB, 1),
+        }
+    try:
+        import psutil
+        info = psutil.Process(None if pid == "self" else int(pid)).memory_full_info()
+        return {
+            "rss_mb": round(info.rss / MB, 1),
+            "pss_mb": round(getattr(info, "pss", 0) / MB, 1),
+            "private_mb": round(getattr(info, "uss", 0) / MB, 1),
+            "shared_mb": round(getattr(info, "shared", 0) / MB, 1),
+        }
+    except (ImportError, AttributeError):
+        return {}
+
+
+# 원래 서버와 같은 방식의 일반 로드 (export / verify 용)
+def load_component(name, repo, single_file=None, dtype=torch.float32):
+    if name == "transformer":
+        from diffusers import FluxTransformer2DModel
+        if single_file:
+            return FluxTransformer2DModel.from_single_file(single_file, torch_dtype=dtype)
+        return FluxTransformer2DModel.from_pretrained(repo, subfolder=name, torch_dtype=dtype)
+    if name == "text_encoder_2":
+        from transformers import T5EncoderModel
+        return T5EncoderModel.from_pretrained(repo, subfolder=name, torch_dtype=dtype)
+    if name == "text_encoder":
+        from transformers import CLIPTextModel
+        return CLIPTextModel.from_pretrained(repo, subfolder=name, torch_dtype=dtype)
+    if name == "vae":
+        from diffusers import AutoencoderKL
+        return AutoencoderKL.from_pretrained(repo, subfolder=name, torch_dtype=dtype)
+    raise ValueError(f"지원하지 않는 컴포넌트: {name}")
+
+
+def _worker(directory, components, copy, results, release):
+    started = time.perf_counter()
+    modules = [attach(directory, name, copy=copy) for name in components]
+    # 모든 페이지를 한 번 읽어서 실제 사용 상태로 만듦
+    with torch.inference_mode():
+        for module in modules:
+            for tensor in module.state_dict().values():
+                if tensor.numel():
+                    tensor.float().sum()
+    results.put({"pid": os.getpid(), "load_seconds": round(time.perf_counter() - started, 2), **memory_usage()})
+    # 모든 워커가 측정할 때까지 유지 (공유 페이지 PSS 가 워커 수로 나뉘도록)
+    release.wait()
+
+
+def report(directory, workers, components, copy=False):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    release = context.Event()
+    processes = [
+        context.Process(target=_worker, args=(directory, components, copy, results, release))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    samples = [results.get() for _ in processes]
+    # 전부 붙은 상태에서 다시 측정
+    for sample in samples:
+        sample.update(memory_usage(sample["pid"]))
+    release.set()
+    for process in processes:
+        process.join()
+
+    manifest = read_manifest(directory)
+    weights_mb = sum(manifest["components"][name]["bytes"] for name in components) / MB
+    return {
+        "mode": "private" if copy else "shared",
+        "workers": workers,
+        "weights_mb": round(weights_mb, 1),
+        "per_worker": samples,
+        # 워커 하나를 더 띄울 때 늘어나는 메모리
+        "extra_worker_private_mb": round(sum(s["private_mb"] for s in samples) / len(samples), 1),
+        "total_pss_mb": round(sum(s["pss_mb"] for s in samples), 1),
+    }
+
+
+def _compare(reference, shared):
+    mismatches = []
+    ref_state = reference.state_dict()
+    shared_state = shared.state_dict()
+    for key in sorted(set(ref_state) | set(shared_state)):
+        a, b = ref_state.get(key), shared_state.get(key)
+        if a is None or b is None or a.dtype != b.dtype or a.shape != b.shape or not torch.equal(a.cpu(), b):
+            mismatches.append(key)
+    return len(ref_state), mismatches
+
+
+def verify(directory, repo, single_file, components, dtype, generate=False):
+    result = {"components": {}, "identical": True}
+    private = {}
+    for name in components:
+        reference = load_component(name, repo, single_file if name == "transformer" else None, dtype)
+        shared = attach(directory, name, dtype)
+        total, mismatches = _compare(reference, shared)
+        result["components"][name] = {"tensors": total, "mismatches": mismatches[:20]}
+        result["identical"] &= not mismatches
+        private[name] = reference
+        del shared
+
+    if generate:
+        # 같은 시드로 1스텝 생성한 latent 비교 (CPU)
+        from diffusers import FluxPipeline
+        pipe = FluxPipeline.from_pretrained(repo, torch_dtype=dtype, **private)
+        kwargs = {"width": 256, "height": 256, "num_inference_steps": 1, "guidance_scale": 0.0, "output_type": "latent"}
+        with torch.inference_mode():
+            reference = pipe("verify", generator=torch.Generator("cpu").manual_seed(0), **kwargs).images
+            for name in components:
+                setattr(pipe, name, attach(directory, name, dtype))
+            shared = pipe("verify", generator=torch.Generator("cpu").manual_seed(0), **kwargs).images
+        result["output_identical"] = bool(torch.equal(reference, shared))
+        result["identical"] &= result["output_identical"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="워커 프로세스 간 모델 가중치 공유")
+    parser.add_argument("--dir", default=SHARED_WEIGHTS or "/dev/shm/flux-weights")
+    parser.add_argument("--components", default=",".join(SHARED_COMPONENTS))
+    parser.add_argument("--out", help="결과 JSON 저장 경로")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("export", "verify"):
+        p = sub.add_parser(command, help="공유 가중치 저장" if command == "export" else "일반 로드와 비트 단위 비교")
+        p.add_argument("--repo", default="black-forest-labs/FLUX.1-schnell")
+        p.add_argument("--single-file", help="transformer 단일 파일 (서버의 local_model)")
+        p.add_argument("--dtype", choices=list(DTYPE_NAMES), default="float32")
+        if command == "verify":
+            p.add_argument("--generate", action="store_true", help="1스텝 생성 결과도 비교")
+
+    rep = sub.add_parser("report", help="워커별 메모리 사용량")
+    rep.add_argument("--workers", type=int, default=2)
+    rep.add_argument("--private", action="store_true", help="비교용: 워커마다 복사본 로드")
+
+    args = parser.parse_args()
+    components = [name for name in args.components.split(",") if name]
+    if args.command == "export":
+        dtype = DTYPE_NAMES[args.dtype]
+        modules = {
+            name: load_component(name, args.repo, args.single_file if name == "transformer" else None, dtype)
+            for name in components
+        }
+        result = export(modules, args.dir)
+    elif args.command == "verify":
+        result = verify(args.dir, args.repo, args.single_file, components, DTYPE_NAMES[args.dtype], args.generate)
+    else:
+        result = report(args.dir, args.workers, components, copy=args.private)
+
+    print(json.dumps(result, indent=2, ensure_ascii=False, default=str))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False, default=str)
+
+
+if __name__ == "__main__":
+    main()
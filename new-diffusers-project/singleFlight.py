@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+import json
+import time
+
+# 같은 요청이 동시에 들어오면 한 번만 실행하고 결과를 공유 (single-flight)
+# - 키: 정규화한 요청 파라미터 해시 (시드가 고정/명시된 요청만 같은 결과가 나오므로 호출 측에서 판단)
+# - 같은 키의 작업이 대기/실행 중이면 새 작업을 만들지 않고 그 결과를 기다림
+# - hold=True 면 작업(제출)이 끝난 뒤에도 release() 전까지 유지 (ComfyUI 프롬프트는 제출 후 실행 완료까지)
+# - 기다리던 요청이 끊겨도 작업은 취소하지 않음 (같은 결과를 기다리는 다른 요청이 있을 수 있음)
+
+
+def request_key(*parts):
+    data = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def normalize_prompt(text):
+    # 공백 차이는 토크나이저에서 사라지므로 키에서도 무시
+    return " ".join((text or "").split())
+
+
+class SingleFlight:
+    def __init__(self, hold_timeout=600.0):
+        # hold 항목이 release 되지 않을 때(완료 이벤트 유실 등) 자동 만료 시간 (초)
+        self.hold_timeout = hold_timeout
+        self.flights = {}
+        self.started = 0
+        self.merged = 0
+
+    def holding(self, key):
+        entry = self.flights.get(key)
+        if entry is None:
+            return False
+        if entry["expires"] is not None and time.monotonic() > entry["expires"]:
+            del self.flights[key]
+            return False
+        return True
+
+    async def run(self, key, factory, hold=False):
+        # 반환: (결과, 다른 요청의 작업에 합쳐졌는지)
+        merged = self.holding(key)
+        if merged:
+            self.merged += 1
+            task = self.flights[key]["task"]
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(factory())
+            entry = {"task": task, "expires": None}
+            self.flights[key] = entry
+            task.add_done_callback(lambda t: self._done(key, entry, hold))
+        return await asyncio.shield(task), merged
+
+    def _done(self, key, entry, hold):
+        task = entry["task"]
+        # 기다리는 요청이 없어도 예외를 확인한 것으로 처리
+        failed = task.cancelled() or task.exception() is not None
+        if self.flights.get(key) is not entry:
+            return
+        if hold and not failed:
+            entry["expires"] = time.monotonic() + self.hold_timeout
+        else:
+            del self.flights[key]
+
+    def release(self, key):
+        self.flights.pop(key, None)
+
+    def stats(self):
+        total = self.started + self.merged
+        return {
+            "inflight": len(self.flights),
+            "started": self.started,
+            "merged": self.merged,
+            "merge_rate": round(self.merged / total, 3) if total else None,
+        }
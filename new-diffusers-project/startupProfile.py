@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# 콜드 스타트 (프로세스 시작 -> 서버 준비) 단축 / 측정
+# - 단계별(임포트, 컴포넌트 로드, 디바이스 이동, 최적화/워밍업) 시간을 기록하고 준비 시점에 보고
+# - 서로 독립인 컴포넌트(transformer 단일 파일, text_encoder_2, 나머지 파이프라인)는 스레드 풀에서 동시에 로드
+#   (safetensors 읽기/역직렬화와 CUDA 복사는 GIL 을 놓으므로 디스크 I/O 와 역직렬화가 겹침)
+# - 가중치 파일을 백그라운드에서 미리 읽어 torch/diffusers 임포트 시간과 디스크 읽기를 겹침
+
+# 동시 로드 스레드 수 (1 이면 기존처럼 순차 로드, 비교용)
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", "3"))
+# 가중치 파일 미리 읽기 (메모리가 파일보다 작으면 STARTUP_PREFETCH=0 으로 끔)
+PREFETCH = os.getenv("STARTUP_PREFETCH", "1") != "0"
+PREFETCH_CHUNK = 16 * 1024 * 1024
+
+
+def process_start_time():
+    # 프로세스 시작 시각 (psutil -> /proc -> 이 모듈 임포트 시각)
+    try:
+        import psutil
+        return psutil.Process().create_time()
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/stat") as f:
+            # 22번째 필드: 부팅 후 시작 시각 (clock tick), 프로세스 이름에 공백이 있을 수 있어 ')' 뒤부터
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, StopIteration, AttributeError):
+        return time.time()
+
+
+class StartupProfile:
+    def __init__(self):
+        self.started = process_start_time()
+        self.ready_at = None
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append({
+                    "name": name,
+                    "start": start,
+                    "end": time.time(),
+                    "thread": threading.current_thread().name,
+                })
+
+    def parallel(self, tasks, workers=None):
+        # tasks: {이름: 함수} -> {이름: 결과} (하나라도 실패하면 나머지가 끝난 뒤 예외)
+        def run(name, fn):
+            with self.phase(name):
+                return fn()
+
+        workers = workers or LOAD_WORKERS
+        with self.phase("parallel load"):
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="load") as executor:
+                futures = {name: executor.submit(run, name, fn) for name, fn in tasks.items()}
+                return {name: future.result() for name, future in futures.items()}
+
+    def prefetch(self, *paths):
+        # 가중치 파일을 백그라운드에서 읽어 페이지 캐시에 올림 (이후 로드는 디스크 대신 메모리에서 읽음)
+        paths = [path for path in paths if path and os.path.isfile(path)]
+        if not PREFETCH or not paths:
+            return None
+
+        def read():
+            buffer = bytearray(PREFETCH_CHUNK)
+            for path in paths:
+                with self.phase(f"prefetch {os.path.basename(path)}"):
+                    try:
+                        with open(path, "rb", buffering=0) as f:
+                            while f.readinto(buffer):
+                                pass
+                    except OSError as e:
+                        print(f"가중치 미리 읽기 오류: {str(e)}")
+
+        thread = threading.Thread(target=read, name="prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    def ready(self):
+        # 서버가 요청을 받을 수 있게 된 시점 (FastAPI startup 이벤트)
+        self.ready_at = time.time()
+        print(self.report())
+
+    def to_dict(self):
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase["start"])
+        return {
+            "process_to_ready": round(self.ready_at - self.started, 3) if self.ready_at else None,
+            "phases": [
+                {
+                    "name": phase["name"],
+                    "offset": round(phase["start"] - self.started, 3),
+                    "duration": round(phase["end"] - phase["start"], 3),
+                    "thread": phase["thread"],
+                }
+                for phase in phases
+            ],
+        }
+
+    def report(self):
+        data = self.to_dict()
+        lines = ["시작 프로파일 (초, 프로세스 시작 기준)"]
+        for phase in data["phases"]:
+            lines.append(f"  {phase['offset']:8.2f} +{phase['duration']:7.2f}  {phase['name']:<28} [{phase['thread']}]")
+        # 동시 로드 단계의 합 대비 실제 경과 시간 (겹친 정도)
+        loads = [phase for phase in data["phases"] if phase["thread"].startswith("load")]
+        wall = next((phase["duration"] for phase in data["phases"] if phase["name"] == "parallel load"), None)
+        if loads and wall:
+            total = sum(phase["duration"] for phase in loads)
+            lines.append(f"  동시 로드: 합계 {total:.2f}초 -> 경과 {wall:.2f}초 (x{total / wall:.2f})")
+        if data["process_to_ready"] is not None:
+            lines.append(f"  프로세스 시작 -> 준비: {data['process_to_ready']:.2f}초")
+        return "\n".join(lines)
@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response
+
+from workflowOptimizer import OUTPUT_NODES, signatures, topological_order
+
+# GPU 없이 프록시를 테스트/벤치마크하기 위한 ComfyUI 대역 서버
+# /prompt, /history, /view, /queue, /system_stats, /ws (status, execution_start, execution_cached,
+# executing, progress, executed, execution_success/error, 바이너리 미리보기) 구현
+# 직전 프롬프트와 입력 시그니처가 같은 노드는 execution_cached 로 건너뜀 (ComfyUI 기본 캐시와 같은 동작)
+# 사용 예: python stubComfy.py --port 8188 --step-time 0.01 --error-rate 0.05
+
+app = FastAPI()
+
+CONFIG = {
+    # HTTP 응답 지연 (초)
+    "latency": float(os.getenv("STUB_LATENCY", "0")),
+    # 샘플러 스텝 수(워크플로우 값이 없을 때)와 스텝당 시간, 일반 노드 실행 시간
+    "steps": int(os.getenv("STUB_STEPS", "20")),
+    "step_time": float(os.getenv("STUB_STEP_TIME", "0.05")),
+    "node_time": float(os.getenv("STUB_NODE_TIME", "0.01")),
+    # 실패 주입 비율: /prompt 500 응답, 실행 중 execution_error, 웹소켓 강제 종료(메시지당)
+    "fail_rate": float(os.getenv("STUB_FAIL_RATE", "0")),
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", "0")),
+    "ws_drop_rate": float(os.getenv("STUB_WS_DROP_RATE", "0")),
+    # 스텝마다 바이너리 미리보기 전송
+    "previews": os.getenv("STUB_PREVIEWS", "1") != "0",
+    "preview_size": int(os.getenv("STUB_PREVIEW_SIZE", "64")),
+}
+
+SAMPLER_NODES = {"KSampler", "KSamplerAdvanced", "SamplerCustomAdvanced"}
+LATENT_NODES = {"EmptyLatentImage", "EmptySD3LatentImage"}
+
+# 바이너리 메시지 헤더: [event type] [image format]
+PREVIEW_IMAGE = 1
+FORMAT_PNG = 2
+
+
+def make_png(width, height, seed=0):
+    # 의존성 없이 단색 PNG 생성
+    rng = random.Random(seed)
+    pixel = bytes(rng.randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + pixel * width for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+class StubState:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.pending = []
+        self.running = None
+        self.history = {}
+        self.images = {}
+        self.sockets = {}
+        self.number = 0
+        self.last_signatures = {}
+        self.counters = {"prompts": 0, "failed_submissions": 0, "errors": 0, "messages": 0, "dropped_sockets": 0}
+        self._worker = None
+
+    def queue_remaining(self):
+        return len(self.pending) + (1 if self.running else 0)
+
+    async def send(self, client_id, message=None, data=None):
+        websocket = self.sockets.get(client_id)
+        if websocket is None:
+            return
+        if CONFIG["ws_drop_rate"] and random.random() < CONFIG["ws_drop_rate"]:
+            self.counters["dropped_sockets"] += 1
+            self.sockets.pop(client_id, None)
+            await websocket.close(1011)
+            return
+        try:
+            if data is not None:
+                await websocket.send_bytes(data)
+            else:
+                await websocket.send_json(message)
+            self.counters["messages"] += 1
+        except Exception:
+            self.sockets.pop(client_id, None)
+
+    async def broadcast_status(self):
+        message = {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}}}
+        for client_id in list(self.sockets):
+            await self.send(client_id, message)
+
+
+state = StubState()
+
+
+@app.on_event("startup")
+async def startup():
+    state._worker = asyncio.create_task(worker())
+
+
+@app.middleware("http")
+async def inject_latency(request: Request, call_next):
+    if CONFIG["latency"]:
+        await asyncio.sleep(CONFIG["latency"])
+    return await call_next(request)
+
+
+@app.post("/prompt")
+async def queue_prompt(request: Request):
+    body = await request.json()
+    prompt = body.get("prompt")
+    if not isinstance(prompt, dict) or not prompt:
+        raise HTTPException(status_code=400, detail={"error": "invalid prompt", "node_errors": {}})
+    if CONFIG["fail_rate"] and random.random() < CONFIG["fail_rate"]:
+        state.counters["failed_submissions"] += 1
+        raise HTTPException(status_code=500, detail="injected failure")
+    try:
+        topological_order(prompt)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail={"error": str(e), "node_errors": {}})
+
+    prompt_id = str(uuid.uuid4())
+    state.number += 1
+    item = [state.number, prompt_id, prompt, {"client_id": body.get("client_id")}, []]
+    state.pending.append(item)
+    await state.queue.put(item)
+    state.counters["prompts"] += 1
+    await state.broadcast_status()
+    return {"prompt_id": prompt_id, "number": state.number, "node_errors": {}}
+
+
+@app.get("/history")
+async def get_all_history():
+    return state.history
+
+
+@app.get("/history/{prompt_id}")
+async def get_history(prompt_id: str):
+    if prompt_id in state.history:
+        return {prompt_id: state.history[prompt_id]}
+    return {}
+
+
+@app.get("/queue")
+async def get_queue():
+    return {
+        "queue_running": [state.running] if state.running else [],
+        "queue_pending": list(state.pending),
+    }
+
+
+@app.get("/system_stats")
+async def system_stats():
+    return {
+        "system": {"os": "stub", "python_version": "", "embedded_python": False},
+        "devices": [{"name": "stub", "type": "cpu", "vram_total": 0, "vram_free": 0}],
+        "stub": {**state.counters, "queue_remaining": state.queue_remaining()},
+    }
+
+
+@app.get("/view")
+async def view(filename: str, subfolder: str = "", type: str = "output"):
+    data = state.images.get((filename, subfolder, type))
+    if data is None:
+        raise HTTPException(status_code=404, detail="not found")
+    return Response(content=data, media_type="image/png")
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    client_id = websocket.query_params.get("clientId") or uuid.uuid4().hex
+    state.sockets[client_id] = websocket
+    await state.send(client_id, {
+        "type": "status",
+        "data": {"status": {"exec_info": {"queue_remaining": state.queue_remaining()}}, "sid": client_id},
+    })
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if state.sockets.get(client_id) is websocket:
+            del state.sockets[client_id]
+
+
+async def worker():
+    while True:
+        item = await state.queue.get()
+        state.pending.remove(item)
+        state.running = item
+        try:
+            await execute(item)
+        except Exception as e:
+            print(f"스텁 실행 오류: {str(e)}")
+        finally:
+            state.running = None
+            await state.broadcast_status()
+
+
+async def execute(item):
+    number, prompt_id, prompt, extra, _ = item
+    client_id = extra.get("client_id")
+    messages = []
+
+    async def emit(message_type, data):
+        data = {**data, "prompt_id": prompt_id}
+        if message_type.startswith("execution_"):
+            data["timestamp"] = int(time.time() * 1000)
+            messages.append([message_type, data])
+        await state.send(client_id, {"type": message_type, "data": data})
+
+    await emit("execution_start", {})
+    sigs = signatures(prompt)
+    order = topological_order(prompt)
+    cached = [
+        node_id for node_id in order
+        if prompt[node_id]["class_type"] not in OUTPUT_NODES and state.last_signatures.get(node_id) == sigs[node_id]
+    ]
+    await emit("execution_cached", {"nodes": cached})
+    state.last_signatures = sigs
+
+    batch_size = 1
+    for node in prompt.values():
+        if node["class_type"] in LATENT_NODES:
+            batch_size = node["inputs"].get("batch_size", 1)
+
+    failing_node = None
+    if CONFIG["error_rate"] and random.random() < CONFIG["error_rate"]:
+        failing_node = random.choice(order)
+
+    outputs = {}
+    status = "success"
+    for node_id in order:
+        if node_id in cached:
+            continue
+        node = prompt[node_id]
+        await emit("executing", {"node": node_id, "display_node": node_id})
+
+        if node_id == failing_node:
+            state.counters["errors"] += 1
+            status = "error"
+            # 실패한 노드 이후 캐시는 무효
+            state.last_signatures = {}
+            await emit("execution_error", {
+                "node_id": node_id,
+                "node_type": node["class_type"],
+                "exception_message": "injected error",
+                "exception_type": "RuntimeError",
+            })
+            break
+
+        if node["class_type"] in SAMPLER_NODES:
+            steps = node["inputs"].get("steps")
+            steps = steps if isinstance(steps, int) else CONFIG["steps"]
+            for step in range(1, steps + 1):
+                await asyncio.sleep(CONFIG["step_time"])
+                await emit("progress", {"value": step, "max": steps, "node": node_id})
+                if CONFIG["previews"]:
+                    size = CONFIG["preview_size"]
+                    preview = make_png(size, size, seed=step)
+                    await state.send(client_id, data=struct.pack(">II", PREVIEW_IMAGE, FORMAT_PNG) + preview)
+        else:
+            await asyncio.sleep(CONFIG["node_time"])
+
+        if node["class_type"] in OUTPUT_NODES:
+            folder_type = "output" if node["class_type"] == "SaveImage" else "temp"
+            images = []
+            for index in range(batch_size):
+                image = make_png(64, 64, seed=number * 100 + index)
+                if node["class_type"] == "SaveImageWebsocket":
+                    await state.send(client_id, data=struct.pack(">II", PREVIEW_IMAGE, FORMAT_PNG) + image)
+                    continue
+                filename = f"stub_{number:05}_{node_id}_{index}.png"
+                state.images[(filename, "", folder_type)] = image
+                images.append({"filename": filename, "subfolder": "", "type": folder_type})
+            if images:
+                outputs[node_id] = {"images": images}
+                await emit("executed", {"node": node_id, "display_node": node_id, "output": {"images": images}})
+
+    if status == "success":
+        await emit("executing", {"node": None})
+        await emit("execution_success", {})
+    else:
+        await emit("executing", {"node": None})
+
+    state.history[prompt_id] = {
+        "prompt": item,
+        "outputs": outputs,
+        "status": {"status_str": status, "completed": status == "success", "messages": messages},
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="ComfyUI 대역 서버")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    for name, value in CONFIG.items():
+        option = "--" + name.replace("_", "-")
+        if isinstance(value, bool):
+            parser.add_argument(option, type=lambda v: v not in ("0", "false", "no"), default=value)
+        else:
+            parser.add_argument(option, type=type(value), default=value)
+    args = parser.parse_args()
+    CONFIG.update({name: getattr(args, name) for name in CONFIG})
+    print(f"ComfyUI 대역 서버 실행 - http://{args.host}:{args.port} {CONFIG}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
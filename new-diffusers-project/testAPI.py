@@ -1,8 +1,21 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from typing import List, Optional
 import torch
-from diffusers import StableDiffusionPipeline
+from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+from cpuOptimize import profile_enabled, optimize_pipeline, cpu_autocast, warmup
+from tokenMerge import token_merging, ratio_for
+from schedulerRegistry import SchedulerRegistry, pipeline_with_scheduler
+from memoryBudget import MemoryModel, MemoryScheduler, device_budget
+from progressive import ProgressiveGenerator, encode_png
+from singleFlight import SingleFlight, normalize_prompt, request_key
+from loraCache import LoraManager, LoraSpec
+from adaptiveSteps import AdaptiveSteps
+import asyncio
+import json
+import time
 import base64
 from io import BytesIO
 
@@ -39,49 +52,213 @@ pipe = StableDiffusionPipeline.from_pretrained(
 )
 
 pipe = pipe.to(device)
-# 모델 성능 최적화
-pipe.enable_attention_slicing()
-pipe.enable_vae_tiling()
+# 어텐션 슬라이싱 / VAE 타일링은 메모리 예산에 맞춰 요청 단위로 적용 (memoryBudget.py)
+
+# CPU 추론 최적화 (GPU 없는 노드)
+cpu_profile = None
+if profile_enabled(device):
+    cpu_profile = optimize_pipeline(pipe)
+    warmup(pipe, cpu_profile, width=512, height=512)
 
 # 메모리 최적화 (GPU 메모리가 제한적인 경우)
 if device == "cuda" and torch.cuda.get_device_properties(0).total_memory < 8 * 1024 * 1024 * 1024:  # 8GB 미만
     pipe.enable_sequential_cpu_offload()
 
+# 샘플러별 스케줄러 (파이프라인 설정 기준으로 미리 생성)
+schedulers = SchedulerRegistry(pipe)
+schedulers.warmup()
+
+# 해상도별 메모리 추정 (CUDA 는 1회 측정으로 보정) 및 예산 기반 입장 제어
+memory_model = MemoryModel(pipe, device, model_id)
+memory_model.calibrate()
+memory = MemoryScheduler(memory_model, device_budget(device))
+print(f"메모리 예산: {memory.budget / 1024 / 1024:.0f}MB")
+
+# 초안 -> 정제 생성용 img2img (같은 컴포넌트 공유)
+refiner = StableDiffusionImg2ImgPipeline(**pipe.components)
+progressive = ProgressiveGenerator(pipe, refiner)
+
+# 요청별 LoRA (LORA_DIR), 활성 조합은 UNet 에 fuse 해 두고 조합이 바뀔 때만 전환
+# CPU 최적화 백엔드는 가중치를 미리 변환해 두므로 LoRA 를 적용할 수 없음
+loras = LoraManager(pipe, unsupported=(
+    f"CPU 최적화 백엔드({cpu_profile.backend})에서는 지원하지 않습니다."
+    if cpu_profile and cpu_profile.backend != "eager" else None
+))
+
+# 시드가 고정이라 같은 파라미터면 같은 이미지 -> 동시에 들어온 같은 요청은 한 번만 생성
+dedupe = SingleFlight()
+
 class TextToImageRequest(BaseModel):
     prompt: str
     negative_prompt: str = ""
     width: int = 512
     height: int = 512
-    steps: int = 20  
+    # 없으면 샘플러 권장 스텝 수 사용
+    steps: Optional[int] = None
     cfg_scale: float = 7.0 
     sampler_name: str = "Euler a"
+    # 토큰 병합 비율 (0~0.9), 없으면 해상도 구간 기본값
+    tome_ratio: Optional[float] = None
+    # 초안(작은 해상도) -> 정제 결과를 한 연결로 스트리밍 (application/x-ndjson, 한 줄에 하나씩)
+    progressive: bool = False
+    # 초안 해상도 비율 / 초안 스텝 수 / 정제 강도 (없으면 progressive.py 기본값)
+    draft_scale: Optional[float] = None
+    draft_steps: Optional[int] = None
+    refine_strength: Optional[float] = None
+    # LoRA 어댑터 목록 [{"name": "파일 이름(확장자 제외)", "weight": 1.0}]
+    loras: List[LoraSpec] = []
+    # 예측 이미지(x0)가 더 변하지 않으면 남은 스텝 생략 (progressive 에는 적용하지 않음)
+    adaptive_steps: bool = False
+    # 스텝 간 x0 상대 변화량 기준 (없으면 ADAPTIVE_THRESHOLD)
+    adaptive_threshold: Optional[float] = None
 
 
 # 이미지 생성 엔드포인트
 @app.post("/sdapi/v1/txt2img")
 async def generate_image(request: TextToImageRequest):
+    # 요청별 스케줄러 선택 (공유 파이프라인은 변경하지 않음)
+    try:
+        scheduler = schedulers.get(request.sampler_name)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"지원하지 않는 샘플러: {request.sampler_name}")
+    if request.steps is not None and request.steps < 1:
+        raise HTTPException(status_code=422, detail=f"steps 는 1 이상이어야 합니다: {request.steps}")
+    steps = schedulers.recommended_steps(request.sampler_name) if request.steps is None else request.steps
+    run_pipe = pipeline_with_scheduler(pipe, scheduler)
+    tome_ratio = ratio_for(request.width, request.height, request.tome_ratio)
+
+    # LoRA 조합 확인 후 텐서를 미리 읽어 둠 (실행 순서가 되었을 때는 전환만)
+    adapters = loras.key(request.loras)
     try:
-        # 이미지 생성
-        image = pipe(
+        await asyncio.to_thread(loras.prepare, adapters)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"LoRA 로드 실패: {str(e)}")
+
+    if request.progressive:
+        memory.check(request.width, request.height, guidance=request.cfg_scale > 1)
+        return StreamingResponse(progressive_stream(request, scheduler, steps, tome_ratio, adapters),
+                                 media_type="application/x-ndjson")
+
+    # 같은 파라미터로 대기/실행 중인 요청이 있으면 새로 생성하지 않고 그 결과를 공유
+    key = request_key("txt2img", normalize_prompt(request.prompt), normalize_prompt(request.negative_prompt),
+                      request.width, request.height, steps, request.cfg_scale, request.sampler_name, tome_ratio,
+                      adapters, request.adaptive_steps, request.adaptive_threshold)
+    result, _ = await dedupe.run(key, lambda: txt2img(request, run_pipe, steps, tome_ratio, adapters))
+    return result
+
+
+async def txt2img(request, run_pipe, steps, tome_ratio, adapters):
+    # 메모리 예산 확인 (부족하면 대기, 예산을 넘는 해상도는 422)
+    # 토큰 병합은 공유 UNet 을 패치하므로 단독 실행, 같은 LoRA 조합끼리 묶어서 실행
+    async with memory.reserve(request.width, request.height, guidance=request.cfg_scale > 1,
+                              exclusive=bool(tome_ratio), adapters=adapters), loras.use(adapters):
+        try:
+            # 이미지 생성 (이벤트 루프를 막지 않도록 스레드에서 실행)
+            image, adaptive = await asyncio.to_thread(generate, run_pipe, request, steps, tome_ratio)
+
+            # base64 인코딩된 문자열로 변환
+            buffered = BytesIO()
+            image.save(buffered, format="PNG")
+            img_str = base64.b64encode(buffered.getvalue()).decode()
+
+            result = {"images": [img_str]}
+            if adaptive:
+                result["adaptive"] = adaptive
+            return result
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+def generate(run_pipe, request, steps, tome_ratio):
+    # run_pipe 의 스케줄러는 요청 전용 복사본이라 step 을 감싸도 다른 요청에 영향 없음
+    adaptive = AdaptiveSteps(run_pipe.scheduler, request.adaptive_threshold) if request.adaptive_steps else None
+    with cpu_autocast(cpu_profile), token_merging(pipe.unet, tome_ratio):
+        image = run_pipe(
             prompt=request.prompt,
             negative_prompt=request.negative_prompt,
             width=request.width,
             height=request.height,
-            num_inference_steps=request.steps, 
+            num_inference_steps=steps,
             guidance_scale=request.cfg_scale,
             # CUDA 디바이스에서는 CUDA 생성기 사용
-            generator = torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0)
+            generator=torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0),
+            **(adaptive.kwargs() if adaptive else {})
         ).images[0]
+    return image, adaptive.result() if adaptive else None
 
-        # base64 인코딩된 문자열로 변환
-        buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
 
-        return {"images": [img_str]}
+# 초안 -> 정제 스트리밍: {"stage": "draft"} 줄 다음 {"stage": "final"} 줄 (오류는 {"stage": "error"})
+async def progressive_stream(request, scheduler, steps, tome_ratio, adapters=()):
+    plan = progressive.plan(request.width, request.height, steps, request.draft_scale, request.draft_steps,
+                            request.refine_strength)
+    started = time.perf_counter()
+    try:
+        async with memory.reserve(request.width, request.height, guidance=request.cfg_scale > 1,
+                                  exclusive=bool(tome_ratio), adapters=adapters), loras.use(adapters):
+            latents, draft = await asyncio.to_thread(
+                generate_draft, pipeline_with_scheduler(pipe, scheduler), request, plan, tome_ratio
+            )
+            yield json.dumps({
+                "stage": "draft",
+                "images": [encode_png(draft)],
+                "width": plan["draft_width"],
+                "height": plan["draft_height"],
+                "elapsed": round(time.perf_counter() - started, 3),
+            }) + "\n"
 
+            image = await asyncio.to_thread(
+                generate_refine, pipeline_with_scheduler(refiner, scheduler), request, latents, plan, tome_ratio
+            )
+            yield json.dumps({
+                "stage": "final",
+                "images": [encode_png(image)],
+                "width": plan["width"],
+                "height": plan["height"],
+                "elapsed": round(time.perf_counter() - started, 3),
+                "plan": plan,
+            }) + "\n"
+    except HTTPException as e:
+        yield json.dumps({"stage": "error", "status_code": e.status_code, "detail": e.detail}, ensure_ascii=False) + "\n"
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        yield json.dumps({"stage": "error", "status_code": 500, "detail": str(e)}, ensure_ascii=False) + "\n"
+
+
+def generate_draft(run_pipe, request, plan, tome_ratio):
+    with cpu_autocast(cpu_profile), token_merging(pipe.unet, tome_ratio):
+        return progressive.draft(
+            run_pipe,
+            plan,
+            torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0),
+            prompt=request.prompt,
+            negative_prompt=request.negative_prompt,
+            guidance_scale=request.cfg_scale,
+        )
+
+
+def generate_refine(run_refiner, request, latents, plan, tome_ratio):
+    with cpu_autocast(cpu_profile), token_merging(pipe.unet, tome_ratio):
+        return progressive.refine(
+            run_refiner,
+            latents,
+            plan,
+            torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0),
+            prompt=request.prompt,
+            negative_prompt=request.negative_prompt,
+            guidance_scale=request.cfg_scale,
+        )
+
+
+# 사용 가능한 샘플러 목록
+@app.get("/sdapi/v1/samplers")
+async def get_samplers():
+    return schedulers.list_samplers()
+
+
+# 사용 가능한 LoRA 목록
+@app.get("/sdapi/v1/loras")
+async def get_loras():
+    return loras.list()
 
 
 # 서버 상태 확인
@@ -91,7 +268,10 @@ async def health_check():
         "status": "healthy", 
         "model": model_id, 
         "device": device,
-        "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A"
+        "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A",
+        "memory": memory.stats(),
+        "dedupe": dedupe.stats(),
+        "lora": loras.stats()
     }
 
 if __name__ == "__main__":
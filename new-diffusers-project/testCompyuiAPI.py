@@ -1,29 +1,46 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-import requests
-import json
-import os
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import time
+import random
 import uuid
 import traceback
+import urllib.parse
+
+from comfyClient import ComfyClient, output_images
+from workflowTemplates import TemplateStore
 
 
 app = FastAPI()
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:5173"], 
+    allow_origins=["http://localhost:5173"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 COMFY_URL = "http://localhost:8188"
+# 생성 대기 최대 시간 (초)
+GENERATE_TIMEOUT = 60
+
+# 워크플로우는 한 번만 로드하고 요청마다 변경되는 노드만 복사
+templates = TemplateStore("./workflowJSON")
+DEFAULT_WORKFLOW = "20250331WF"
+
+# keep-alive 커넥션 풀을 공유하는 비동기 클라이언트
+comfy = ComfyClient(COMFY_URL)
+
+
+@app.on_event("startup")
+async def startup():
+    await comfy.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await comfy.close()
 
-with open("./workflowJSON/20250331WF.json", "r") as f:
-    default_workflow = json.load(f)
 
 class TextToImageRequest(BaseModel):
     prompt: str
@@ -32,118 +49,41 @@ class TextToImageRequest(BaseModel):
 @app.post("/generate")
 async def generate_image(req: TextToImageRequest):
     try:
-        workflow = default_workflow.copy()
-        
-        # 프롬프트 설정
-        if "6" in workflow:  # 노드 ID 6 (CLIPTextEncode)
-            workflow["6"]["inputs"]["text"] = req.prompt
-            print(f"프롬프트 설정: {req.prompt}")
-        
-        if "7" in workflow:  # 노드 ID 7 (CLIPTextEncode - negative)
-            workflow["7"]["inputs"]["text"] = req.negative_prompt
-            print(f"네거티브 프롬프트 설정: {req.negative_prompt}")
-        
-        # 랜덤 시드 생성
-        import random
-        random_seed = random.randint(1, 2**32 - 1)
-        if "3" in workflow:  # 노드 ID 3 (KSampler)
-            workflow["3"]["inputs"]["seed"] = random_seed
-            print(f"랜덤 시드 설정: {random_seed}")
-        
+        # 프롬프트/네거티브/랜덤 시드 적용
+        seed = random.randint(1, 2**32 - 1)
+        workflow = templates.get(DEFAULT_WORKFLOW).render(
+            prompt=req.prompt,
+            negative=req.negative_prompt,
+            seed=seed,
+        )
+        print(f"프롬프트 설정: {req.prompt}, 랜덤 시드 설정: {seed}")
+
         client_id = str(uuid.uuid4())
         print(f"클라이언트 ID: {client_id}")
-        
-        # ComfyUI 요청 보내기
-        print("ComfyUI 서버에 요청 전송 중...")
-        res = requests.post(
-            f"{COMFY_URL}/prompt",
-            json={"prompt": workflow, "client_id": client_id}
-        )
 
-        if res.status_code != 200:
-            print(f"ComfyUI 서버 응답 오류: {res.status_code}, {res.text}")
-            raise HTTPException(status_code=500, detail=f"ComfyUI 서버 오류: {res.text}")
-
-        prompt_id = res.json().get("prompt_id")
-        if not prompt_id:
-            print("prompt_id를 받지 못했습니다.")
-            raise HTTPException(status_code=500, detail="ComfyUI 서버에서 prompt_id를 받지 못했습니다.")
-            
-        print(f"Prompt ID: {prompt_id}")
-
-        # 결과 대기
-        output_images = []
-        seed = None
-
-        max_attempts = 60  # 시간 증가 (60초)
-        attempts = 0
-
-        print("이미지 생성 결과 대기 중...")
-        while attempts < max_attempts:
-            try:
-                history_resp = requests.get(f"{COMFY_URL}/history/{client_id}")
-                if history_resp.status_code == 200:
-                    history = history_resp.json()
-                    
-                    if prompt_id in history:
-                        print(f"히스토리에서 prompt_id {prompt_id} 찾음")
-                        
-                        # 오류 확인
-                        if "error" in history[prompt_id]:
-                            error_msg = history[prompt_id]["error"]
-                            print(f"ComfyUI 처리 오류: {error_msg}")
-                            raise HTTPException(status_code=500, detail=f"ComfyUI 처리 오류: {error_msg}")
-                        
-                        # 출력 확인
-                        if "outputs" in history[prompt_id]:
-                            outputs = history[prompt_id]["outputs"]
-                            print(f"출력 노드 ID: {list(outputs.keys())}")
-
-                            for node_id, node_output in outputs.items():
-                                if "images" in node_output:
-                                    for img in node_output["images"]:
-                                        output_images.append(img["filename"])
-                                        print(f"이미지 파일 발견: {img['filename']}")
-                            
-                            # 시드 값 확인
-                            if "3" in workflow:
-                                seed = workflow["3"]["inputs"]["seed"]
-                                print(f"사용된 시드 값: {seed}")
-                            
-                            if output_images:
-                                print("이미지 생성 완료!")
-                                break
-            except Exception as e:
-                print(f"히스토리 확인 중 오류: {str(e)}")
-                print(traceback.format_exc())
-                # 여기서는 예외를 발생시키지 않고 계속 시도합니다
-            
-            attempts += 1
-            print(f"대기 중... 시도 {attempts}/{max_attempts}")
-            time.sleep(1)
-
-        if not output_images:
-            print("이미지를 찾을 수 없음 (시간초과)")
+        # ComfyUI 요청 후 웹소켓 이벤트로 완료 대기 (이벤트 루프를 막지 않음)
+        prompt_id, entry = await comfy.run_prompt(workflow, client_id, timeout=GENERATE_TIMEOUT)
+        print(f"Prompt ID: {prompt_id} 완료")
+
+        images = output_images(entry)
+        if not images:
+            print("이미지를 찾을 수 없음")
             raise HTTPException(status_code=500, detail="이미지 생성 실패 또는 시간초과")
-        
-        image_url = f"{COMFY_URL}/view?filename={output_images[0]}"
+
+        image = images[0]
+        query = urllib.parse.urlencode({
+            "filename": image["filename"],
+            "subfolder": image.get("subfolder", ""),
+            "type": image.get("type", "output"),
+        })
+        image_url = f"{COMFY_URL}/view?{query}"
         print(f"반환 이미지 URL: {image_url}")
-        
-        # 이미지 URL 유효성 확인
-        try:
-            img_check = requests.head(image_url)
-            if img_check.status_code != 200:
-                print(f"이미지 URL 확인 실패: {img_check.status_code}")
-                raise HTTPException(status_code=500, detail="생성된 이미지를 확인할 수 없습니다")
-        except Exception as e:
-            print(f"이미지 URL 확인 중 오류: {str(e)}")
-            # 계속 진행 (URL이 유효하지만 HEAD 요청이 지원되지 않을 수 있음)
-        
+
         return {
             "image_url": image_url,
             "seed": seed
         }
-        
+
     except HTTPException:
         # 이미 처리된 HTTP 예외는 그대로 전달
         raise
@@ -161,4 +101,4 @@ async def health_check():
 if __name__ == "__main__":
     import uvicorn
     print("FastAPI 서버 시작 중 - http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
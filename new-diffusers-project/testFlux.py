@@ -1,18 +1,47 @@
+from startupProfile import StartupProfile
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import torch
-from diffusers import FluxTransformer2DModel, FluxPipeline
-from transformers import T5EncoderModel, CLIPTextModel
-from optimum.quanto import freeze, qfloat8, quantize
+from typing import List, Optional
 
+import asyncio
 import base64
 from io import BytesIO
+import json
 import os
+import time
 from dotenv import load_dotenv
-from huggingface_hub import login
 import logging
 
+# 프로세스 시작 -> 서버 준비까지 단계별 시간 (준비 시점에 출력, /health 의 startup)
+startup = StartupProfile()
+
+# 사용 모델
+model_repo = "black-forest-labs/FLUX.1-schnell"
+# black-forest-labs/FLUX.1-schnell
+# black-forest-labs/FLUX.1-dev
+# Comfy-Org/flux1-schnell
+
+local_model = "C:/models/flux/flux1-schnell-fp8.safetensors"
+
+# C:/models/flux/flux1-schnell-fp8.safetensors
+# C:/models/flux/flux1-schnell-Q4_0.gguf
+
+# 공유 가중치를 쓰지 않으면 아래 무거운 임포트 동안 transformer 파일을 미리 읽어 둠
+if not os.getenv("SHARED_WEIGHTS"):
+    startup.prefetch(local_model)
+
+# 무거운 모듈은 실제로 쓰는 것만 (T5EncoderModel/quanto 는 직접 로드할 때만 로더 안에서 임포트)
+with startup.phase("import torch"):
+    import torch
+with startup.phase("import diffusers"):
+    from diffusers import FluxPipeline, FluxImg2ImgPipeline
+    from cpuOptimize import profile_enabled, optimize_pipeline, cpu_autocast, warmup
+    from sharedWeights import SHARED_WEIGHTS, SHARED_COMPONENTS, attach, memory_usage
+    from progressive import ProgressiveGenerator, encode_png
+    from loraCache import LORA_FUSE, LoraManager, LoraSpec
+
 
 # 로깅 설정
 logging.basicConfig(level=logging.ERROR)
@@ -21,13 +50,11 @@ logging.basicConfig(level=logging.ERROR)
 app = FastAPI()
 load_dotenv()
 
+# login() 은 토큰 확인 네트워크 요청 때문에 시작이 느려지므로 다운로드 요청에 토큰을 직접 전달
 hf_token = os.getenv("HUGGINGFACE_TOKEN")
 
-if hf_token:
-    login(token=hf_token)
-    print(" 로그인 성공!")
-else:
-    print("로그인 에러")
+if not hf_token:
+    print("HUGGINGFACE_TOKEN 없음 (공개 모델만 다운로드 가능)")
 
 # CORS 설정
 app.add_middleware(
@@ -38,18 +65,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 사용 모델
-model_repo = "black-forest-labs/FLUX.1-schnell"
-# black-forest-labs/FLUX.1-schnell
-# black-forest-labs/FLUX.1-dev
-# Comfy-Org/flux1-schnell
-
-local_model = "C:/models/flux/flux1-schnell-fp8.safetensors"
-
-# C:/models/flux/flux1-schnell-fp8.safetensors
-# C:/models/flux/flux1-schnell-Q4_0.gguf
-
-
 
 # CUDA(NVIDIA GPU) 사용 가능 여부 확인
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -63,21 +78,54 @@ if device == "cuda":
 dtype = torch.float16 if device == "cuda" else torch.float32
 
 
-
-# 단일 파일에서 transformer 모델 로드
-transformer = FluxTransformer2DModel.from_single_file(
-    local_model,
-    torch_dtype=dtype
-    )
-# quantize(transformer, weights=qfloat8)
-freeze(transformer)
-
-text_encoder_2 = T5EncoderModel.from_pretrained(
-    model_repo, 
-    subfolder="text_encoder_2",
-    torch_dtype=dtype
-    )
-freeze(text_encoder_2)
+# 서로 독립인 컴포넌트 로더 (스레드 풀에서 동시에 실행)
+def load_transformer():
+    if SHARED_WEIGHTS:
+        # 로더 프로세스가 공유 메모리에 저장해 둔 가중치에 복사 없이 연결 (python sharedWeights.py export)
+        return attach(SHARED_WEIGHTS, "transformer", dtype)
+    from diffusers import FluxTransformer2DModel
+    from optimum.quanto import freeze
+    # 단일 파일에서 transformer 모델 로드
+    transformer = FluxTransformer2DModel.from_single_file(
+        local_model,
+        torch_dtype=dtype
+        )
+    # quantize(transformer, weights=qfloat8)
+    freeze(transformer)
+    return transformer
+
+
+def load_text_encoder_2():
+    if SHARED_WEIGHTS:
+        return attach(SHARED_WEIGHTS, "text_encoder_2", dtype)
+    from transformers import T5EncoderModel
+    from optimum.quanto import freeze
+    text_encoder_2 = T5EncoderModel.from_pretrained(
+        model_repo, 
+        subfolder="text_encoder_2",
+        torch_dtype=dtype,
+        token=hf_token
+        )
+    freeze(text_encoder_2)
+    return text_encoder_2
+
+
+def load_pipeline():
+    # 나머지 컴포넌트 (CLIP 텍스트 인코더, VAE, 토크나이저, 스케줄러)
+    return FluxPipeline.from_pretrained(
+        model_repo, 
+        transformer=None,
+        text_encoder_2=None,
+        torch_dtype=dtype,
+        token=hf_token
+        )
+
+
+components = startup.parallel({
+    "transformer": load_transformer,
+    "text_encoder_2": load_text_encoder_2,
+    "pipeline": load_pipeline,
+})
 
 
 # if transformer is None:
@@ -108,20 +156,33 @@ freeze(text_encoder_2)
 #     raise ValueError("Text Encoder 2 model failed to load.")
 
 # 파이프라인 생성
-pipe = FluxPipeline.from_pretrained(
-    model_repo, 
-    transformer=None,
-    text_encoder_2=None,
-    torch_dtype=dtype,
-    token=hf_token
-    )
-
-pipe = pipe.to(device)
-
-pipe.transformer = transformer
-pipe.text_encoder_2 = text_encoder_2
-
-pipe.enable_model_cpu_offload()
+pipe = components["pipeline"]
+
+with startup.phase("pipeline to device"):
+    pipe = pipe.to(device)
+
+pipe.transformer = components["transformer"]
+pipe.text_encoder_2 = components["text_encoder_2"]
+
+# CPU 추론 최적화 (GPU 없는 노드), GPU에서는 CPU 오프로딩
+cpu_profile = None
+with startup.phase("optimize / warmup"):
+    if profile_enabled(device):
+        cpu_profile = optimize_pipeline(pipe, skip=SHARED_COMPONENTS if SHARED_WEIGHTS else ())
+        warmup(pipe, cpu_profile, width=512, height=512, guidance_scale=0.0)
+    else:
+        pipe.enable_model_cpu_offload()
+
+# 초안 -> 정제 생성용 img2img (같은 컴포넌트 공유)
+refiner = FluxImg2ImgPipeline(**pipe.components)
+progressive = ProgressiveGenerator(pipe, refiner)
+
+# 요청별 LoRA (LORA_DIR), 활성 조합은 transformer 에 fuse 해 두고 조합이 바뀔 때만 전환
+# 공유 가중치(읽기 전용 mmap)에는 fuse 할 수 없으므로 어댑터 레이어로 실행
+loras = LoraManager(pipe, fuse=LORA_FUSE and not SHARED_WEIGHTS, unsupported=(
+    f"CPU 최적화 백엔드({cpu_profile.backend})에서는 지원하지 않습니다."
+    if cpu_profile and cpu_profile.backend != "eager" else None
+))
 
 # # 디바이스 설정
 # if device == "cuda":
@@ -143,23 +204,45 @@ class TextToImageRequest(BaseModel):
     height: int = 512
     num_inference_steps: int = 4  
     guidance_scale: float = 0.0
+    # 초안(작은 해상도) -> 정제 결과를 한 연결로 스트리밍 (application/x-ndjson, 요청의 크기/스텝 사용)
+    progressive: bool = False
+    draft_scale: Optional[float] = None
+    draft_steps: Optional[int] = None
+    refine_strength: Optional[float] = None
+    # LoRA 어댑터 목록 [{"name": "파일 이름(확장자 제외)", "weight": 1.0}]
+    loras: List[LoraSpec] = []
+
+@app.on_event("startup")
+async def on_startup():
+    startup.ready()
 
 # 이미지 생성 엔드포인트
 @app.post("/sdapi/v1/txt2img")
 async def generate_image(request: TextToImageRequest):
+    # LoRA 조합 확인 후 텐서를 미리 읽어 둠 (실행 순서가 되었을 때는 전환만)
+    adapters = loras.key(request.loras)
+    try:
+        await asyncio.to_thread(loras.prepare, adapters)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"LoRA 로드 실패: {str(e)}")
+
+    if request.progressive:
+        return StreamingResponse(progressive_stream(request, adapters), media_type="application/x-ndjson")
     try:
         print(f"Generating image with prompt: {request.prompt}")
-        # 이미지 생성
-        image = pipe(
-            request.prompt,
-            # negative_prompt=request.negative_prompt,
-            width=512,
-            height=512,
-            num_inference_steps=4, 
-            guidance_scale=0.0,
-            output_type="pil",
-            generator=torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0)
-        ).images[0]
+        # 이미지 생성 (같은 LoRA 조합끼리만 동시에 실행)
+        async with loras.use(adapters):
+            with cpu_autocast(cpu_profile):
+                image = pipe(
+                    request.prompt,
+                    # negative_prompt=request.negative_prompt,
+                    width=512,
+                    height=512,
+                    num_inference_steps=4, 
+                    guidance_scale=0.0,
+                    output_type="pil",
+                    generator=torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0)
+                ).images[0]
 
         # base64 인코딩된 문자열로 변환
         buffered = BytesIO()
@@ -172,6 +255,66 @@ async def generate_image(request: TextToImageRequest):
         logging.error(f"Image generation failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 초안 -> 정제 스트리밍: {"stage": "draft"} 줄 다음 {"stage": "final"} 줄 (오류는 {"stage": "error"})
+async def progressive_stream(request, adapters=()):
+    plan = progressive.plan(request.width, request.height, request.num_inference_steps, request.draft_scale,
+                            request.draft_steps, request.refine_strength)
+    started = time.perf_counter()
+    try:
+        # 초안과 정제 사이에 다른 LoRA 조합으로 바뀌지 않도록 끝까지 유지
+        async with loras.use(adapters):
+            latents, draft = await asyncio.to_thread(generate_draft, request, plan)
+            yield json.dumps({
+                "stage": "draft",
+                "images": [encode_png(draft)],
+                "width": plan["draft_width"],
+                "height": plan["draft_height"],
+                "elapsed": round(time.perf_counter() - started, 3),
+            }) + "\n"
+
+            image = await asyncio.to_thread(generate_refine, request, latents, plan)
+            yield json.dumps({
+                "stage": "final",
+                "images": [encode_png(image)],
+                "width": plan["width"],
+                "height": plan["height"],
+                "elapsed": round(time.perf_counter() - started, 3),
+                "plan": plan,
+            }) + "\n"
+    except Exception as e:
+        logging.error(f"Image generation failed: {e}")
+        yield json.dumps({"stage": "error", "status_code": 500, "detail": str(e)}, ensure_ascii=False) + "\n"
+
+
+def generate_draft(request, plan):
+    with cpu_autocast(cpu_profile):
+        return progressive.draft(
+            pipe,
+            plan,
+            torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0),
+            prompt=request.prompt,
+            guidance_scale=request.guidance_scale,
+        )
+
+
+def generate_refine(request, latents, plan):
+    with cpu_autocast(cpu_profile):
+        return progressive.refine(
+            refiner,
+            latents,
+            plan,
+            torch.Generator("cuda" if device == "cuda" else "cpu").manual_seed(0),
+            prompt=request.prompt,
+            guidance_scale=request.guidance_scale,
+        )
+
+
+# 사용 가능한 LoRA 목록
+@app.get("/sdapi/v1/loras")
+async def get_loras():
+    return loras.list()
+
+
 # 서버 상태 확인
 @app.get("/health")
 async def health_check():
@@ -179,7 +322,11 @@ async def health_check():
         "status": "healthy", 
         "model": "Comfy-Org/flux1-schnell", 
         "device": device,
-        "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A"
+        "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A",
+        "shared_weights": SHARED_WEIGHTS or None,
+        "process_memory": memory_usage(),
+        "startup": startup.to_dict(),
+        "lora": loras.stats()
     }
 
 if __name__ == "__main__":
@@ -1,18 +1,24 @@
+from startupProfile import StartupProfile
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import torch
-from diffusers import FluxTransformer2DModel, FluxPipeline, GGUFQuantizationConfig
-from transformers import T5EncoderModel, CLIPTextModel
-from optimum.quanto import freeze, qfloat8, quantize
 
 import base64
 from io import BytesIO
 import os
 from dotenv import load_dotenv
-from huggingface_hub import login
 import logging
 
+# 프로세스 시작 -> 서버 준비까지 단계별 시간 (준비 시점에 출력, /health 의 startup)
+startup = StartupProfile()
+
+# 무거운 모듈은 실제로 쓰는 것만
+with startup.phase("import torch"):
+    import torch
+with startup.phase("import diffusers"):
+    from diffusers import FluxTransformer2DModel, FluxPipeline, GGUFQuantizationConfig
+    from cpuOptimize import CPUProfile, profile_enabled, configure_threads
+
 
 # 로깅 설정
 logging.basicConfig(level=logging.ERROR)
@@ -65,21 +71,32 @@ if device == "cuda":
 
 
 # 단일 파일에서 transformer 모델 로드
-transformer = FluxTransformer2DModel.from_single_file(
-    guff_path,
-    quantization_config =GGUFQuantizationConfig(compute_dtype=torch.bfloat16),
-    torch_dtype=torch.bfloat16
-    )
+def load_transformer():
+    return FluxTransformer2DModel.from_single_file(
+        guff_path,
+        quantization_config =GGUFQuantizationConfig(compute_dtype=torch.bfloat16),
+        torch_dtype=torch.bfloat16
+        )
+
 
+# 파이프라인 생성 (transformer 와 동시에 로드한 뒤 연결)
+def load_pipeline():
+    return FluxPipeline.from_pretrained(
+        model_repo, 
+        transformer=None,
+        torch_dtype=torch.bfloat16,
+        )
 
-# 파이프라인 생성
-pipe = FluxPipeline.from_pretrained(
-    model_repo, 
-    transformer=transformer,
-    torch_dtype=torch.bfloat16,
-    )
 
-pipe.enable_model_cpu_offload()
+components = startup.parallel({"transformer": load_transformer, "pipeline": load_pipeline})
+pipe = components["pipeline"]
+pipe.transformer = components["transformer"]
+
+# GGUF 가중치는 이미 bfloat16 연산이라 CPU에서는 스레드 설정만 적용
+if profile_enabled(device):
+    configure_threads(CPUProfile())
+else:
+    pipe.enable_model_cpu_offload()
 
 class TextToImageRequest(BaseModel):
     prompt: str
@@ -89,6 +106,10 @@ class TextToImageRequest(BaseModel):
     num_inference_steps: int = 4  
     guidance_scale: float = 0.0
 
+@app.on_event("startup")
+async def on_startup():
+    startup.ready()
+
 # 이미지 생성 엔드포인트
 @app.post("/sdapi/v1/txt2img")
 async def generate_image(request: TextToImageRequest):
@@ -124,7 +145,8 @@ async def health_check():
         "status": "healthy", 
         "model": "Comfy-Org/flux1-schnell", 
         "device": device,
-        "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A"
+        "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A",
+        "startup": startup.to_dict()
     }
 
 if __name__ == "__main__":
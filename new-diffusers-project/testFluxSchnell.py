@@ -1,18 +1,39 @@
+from startupProfile import StartupProfile
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import torch
-from diffusers import FluxTransformer2DModel, FluxPipeline
-from transformers import T5EncoderModel, CLIPTextModel
-from optimum.quanto import freeze, qfloat8, quantize
+from typing import Optional
+import copy
 import base64
 from io import BytesIO
 import os
 from dotenv import load_dotenv
-from huggingface_hub import login
 # 로그 추적용
 import logging
 import traceback
+
+# 프로세스 시작 -> 서버 준비까지 단계별 시간 (준비 시점에 출력, /health 의 startup)
+startup = StartupProfile()
+
+# 사용 모델
+model_repo = "black-forest-labs/FLUX.1-schnell"
+local_model = "C:/models/flux/flux1-schnell-fp8.safetensors"
+
+# 공유 가중치를 쓰지 않으면 아래 무거운 임포트 동안 transformer 파일을 미리 읽어 둠
+if not os.getenv("SHARED_WEIGHTS"):
+    startup.prefetch(local_model)
+
+# 무거운 모듈은 실제로 쓰는 것만 (T5EncoderModel 은 직접 로드할 때만 로더 안에서 임포트)
+with startup.phase("import torch"):
+    import torch
+with startup.phase("import diffusers"):
+    from diffusers import FluxPipeline
+    from optimum.quanto import freeze
+    from cpuOptimize import profile_enabled, optimize_pipeline, cpu_autocast, warmup
+    from sharedWeights import SHARED_WEIGHTS, SHARED_COMPONENTS, attach, memory_usage
+    from schedulerRegistry import pipeline_with_scheduler
+    from adaptiveSteps import AdaptiveSteps
+
 # 로깅 설정
 logging.basicConfig(level=logging.INFO)
 
@@ -29,10 +50,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 사용 모델
-model_repo = "black-forest-labs/FLUX.1-schnell"
-local_model = "C:/models/flux/flux1-schnell-fp8.safetensors"
-
 # CUDA(NVIDIA GPU) 사용 가능 여부 확인
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"using device: {device}")
@@ -52,45 +69,66 @@ try:
         torch.cuda.empty_cache()
         print("CUDA 캐시 비움")
     
-    print("transformer 모델 불러오기")
-    transformer = FluxTransformer2DModel.from_single_file(
-        local_model,
-        torch_dtype=dtype
-    )
-    print("transformer 모델 호출 성공")
-    
-    print("transformer GPU로 이동")
-    transformer = transformer.to(device)
-    print(f"transformer 디바이스: {next(transformer.parameters()).device}")
-    
-    print("transformer freeze 적용")
-    freeze(transformer)
-    print("transformer freeze 완료")
-    
-    print("text_encoder_2 로딩")
-    text_encoder_2 = T5EncoderModel.from_pretrained(
-        model_repo,
-        subfolder="text_encoder_2",
-        torch_dtype=dtype
-    )
-    print("text_encoder_2 로딩 완료")
+    # 서로 독립인 컴포넌트 로더 (스레드 풀에서 동시에 실행, 각각 로드 -> GPU 이동 -> freeze)
+    def load_transformer():
+        print("transformer 모델 불러오기")
+        if SHARED_WEIGHTS:
+            # 로더 프로세스가 공유 메모리에 저장해 둔 가중치에 복사 없이 연결 (python sharedWeights.py export)
+            transformer = attach(SHARED_WEIGHTS, "transformer", dtype)
+        else:
+            from diffusers import FluxTransformer2DModel
+            transformer = FluxTransformer2DModel.from_single_file(
+                local_model,
+                torch_dtype=dtype
+            )
+        print("transformer 모델 호출 성공")
+        
+        transformer = transformer.to(device)
+        print(f"transformer 디바이스: {next(transformer.parameters()).device}")
+        
+        freeze(transformer)
+        print("transformer freeze 완료")
+        return transformer
     
-    print("text_encoder_2 GPU로 이동")
-    text_encoder_2 = text_encoder_2.to(device)
-    print(f"text_encoder_2 디바이스: {next(text_encoder_2.parameters()).device}")
+    def load_text_encoder_2():
+        print("text_encoder_2 로딩")
+        if SHARED_WEIGHTS:
+            text_encoder_2 = attach(SHARED_WEIGHTS, "text_encoder_2", dtype)
+        else:
+            from transformers import T5EncoderModel
+            text_encoder_2 = T5EncoderModel.from_pretrained(
+                model_repo,
+                subfolder="text_encoder_2",
+                torch_dtype=dtype
+            )
+        print("text_encoder_2 로딩 완료")
+        
+        text_encoder_2 = text_encoder_2.to(device)
+        print(f"text_encoder_2 디바이스: {next(text_encoder_2.parameters()).device}")
+        
+        freeze(text_encoder_2)
+        print("text_encoder_2 freeze 완료")
+        return text_encoder_2
     
-    print("text_encoder_2 freeze 적용")
-    freeze(text_encoder_2)
-    print("text_encoder_2 freeze 완료")
+    def load_pipeline():
+        print("파이프라인 생성")
+        pipe = FluxPipeline.from_pretrained(
+            model_repo,
+            transformer=None,
+            text_encoder_2=None,
+            torch_dtype=dtype
+        )
+        print("파이프라인 로딩 완료")
+        return pipe
     
-    print("파이프라인 생성")
-    pipe = FluxPipeline.from_pretrained(
-        model_repo,
-        transformer=None,
-        text_encoder_2=None,
-        torch_dtype=dtype
-    )
-    print("파이프라인 로딩 완료")
+    components = startup.parallel({
+        "transformer": load_transformer,
+        "text_encoder_2": load_text_encoder_2,
+        "pipeline": load_pipeline,
+    })
+    transformer = components["transformer"]
+    text_encoder_2 = components["text_encoder_2"]
+    pipe = components["pipeline"]
     
     # 모든 서브 모델을 명시적으로 GPU로 이동
     print("파이프라인 컴포넌트를 GPU로 이동 중...")
@@ -102,7 +140,8 @@ try:
             pipe.named_components[name] = module.to(device)
     
     # 파이프라인 자체를 GPU로 이동
-    pipe = pipe.to(device)
+    with startup.phase("pipeline to device"):
+        pipe = pipe.to(device)
     
     print("모델 할당")
     pipe.transformer = transformer
@@ -123,6 +162,13 @@ try:
     print("메모리 최적화")
     pipe.enable_attention_slicing(1)
     print("메모리 최적화 완료")
+
+    # CPU 추론 최적화 (GPU 없는 노드)
+    cpu_profile = None
+    if profile_enabled(device):
+        with startup.phase("optimize / warmup"):
+            cpu_profile = optimize_pipeline(pipe, skip=SHARED_COMPONENTS if SHARED_WEIGHTS else ())
+            warmup(pipe, cpu_profile, width=512, height=512, guidance_scale=2.5)
     
 except Exception as e:
     print(f"모델 호출 에러: {e}")
@@ -136,6 +182,14 @@ class TextToImageRequest(BaseModel):
     height: int = 512
     num_inference_steps: int = 15
     guidance_scale: float = 2.5
+    # 예측 이미지(x0)가 더 변하지 않으면 남은 스텝 생략
+    adaptive_steps: bool = False
+    # 스텝 간 x0 상대 변화량 기준 (없으면 ADAPTIVE_THRESHOLD)
+    adaptive_threshold: Optional[float] = None
+
+@app.on_event("startup")
+async def on_startup():
+    startup.ready()
 
 # 이미지 생성 엔드포인트
 @app.post("/sdapi/v1/txt2img")
@@ -159,23 +213,35 @@ async def generate_image(request: TextToImageRequest):
                 except StopIteration:
                     pass
                 
+        # 적응형 스텝은 스케줄러 step 을 감싸므로 요청 전용 스케줄러 복사본으로 실행
+        run_pipe = pipe
+        adaptive = None
+        if request.adaptive_steps:
+            run_pipe = pipeline_with_scheduler(pipe, copy.deepcopy(pipe.scheduler))
+            adaptive = AdaptiveSteps(run_pipe.scheduler, request.adaptive_threshold)
+        
         # 이미지 생성 
-        image = pipe(
-            request.prompt,
-            negative_prompt=request.negative_prompt,
-            width=request.width,
-            height=request.height,
-            num_inference_steps=15,
-            guidance_scale=2.5,
-            output_type="pil",
-            generator=torch.Generator(device).manual_seed(0)
-        ).images[0]
+        with cpu_autocast(cpu_profile):
+            image = run_pipe(
+                request.prompt,
+                negative_prompt=request.negative_prompt,
+                width=request.width,
+                height=request.height,
+                num_inference_steps=15,
+                guidance_scale=2.5,
+                output_type="pil",
+                generator=torch.Generator(device).manual_seed(0),
+                **(adaptive.kwargs() if adaptive else {})
+            ).images[0]
         
         # base64 인코딩된 문자열로 변환
         buffered = BytesIO()
         image.save(buffered, format="PNG")
         img_str = base64.b64encode(buffered.getvalue()).decode()
         print("이미지 생성 완료")
+        if adaptive:
+            print(f"적응형 스텝: {adaptive.result()['steps']}/{adaptive.result()['total_steps']}")
+            return {"images": [img_str], "adaptive": adaptive.result()}
         return {"images": [img_str]}
     except Exception as e:
         error_msg = f"이미지 생성 실패: {str(e)}"
@@ -206,7 +272,10 @@ async def health_check():
         "model": model_repo,
         "device": device,
         "gpu_info": torch.cuda.get_device_name(0) if device == "cuda" else "N/A",
-        "component_devices": component_devices
+        "component_devices": component_devices,
+        "shared_weights": SHARED_WEIGHTS or None,
+        "process_memory": memory_usage(),
+        "startup": startup.to_dict()
     }
 
 if __name__ == "__main__":
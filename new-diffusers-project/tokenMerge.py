@@ -0,0 +1,227 @@
+import math
+import os
+import contextlib
+import torch
+
+# Stable Diffusion UNet self-attention 용 토큰 병합 (ToMe)
+# 유사한 토큰을 attn1 앞에서 병합하고 뒤에서 다시 복원해서 어텐션 토큰 수를 줄인다.
+# 패치는 attn1.forward 인스턴스 속성만 바꾸므로 런타임에 켜고 끌 수 있다.
+
+# 해상도(픽셀 수) 구간별 병합 비율 (기본 꺼짐)
+# TOME_BUCKETS=default 또는 TOME_BUCKETS="262144:0.3,589824:0.5" 로 켤 수 있음
+DEFAULT_BUCKETS = [(512 * 512, 0.3), (768 * 768, 0.5)]
+MAX_RATIO = 0.9
+
+
+def _load_buckets():
+    spec = os.getenv("TOME_BUCKETS")
+    if not spec:
+        return []
+    if spec == "default":
+        return DEFAULT_BUCKETS
+    buckets = []
+    for part in spec.split(","):
+        pixels, ratio = part.split(":")
+        buckets.append((int(pixels), float(ratio)))
+    return sorted(buckets)
+
+
+BUCKETS = _load_buckets()
+
+
+def ratio_for(width, height, requested=None):
+    # 요청에 비율이 있으면 우선, 없으면 해상도 구간 기본값
+    if requested is not None:
+        return min(max(float(requested), 0.0), MAX_RATIO)
+    ratio = 0.0
+    for pixels, bucket_ratio in BUCKETS:
+        if width * height >= pixels:
+            ratio = bucket_ratio
+    return ratio
+
+
+def _gather(x, dim, index):
+    # MPS에서는 마지막 차원이 1인 gather가 잘못 동작해서 우회
+    if x.device.type == "mps" and x.shape[-1] == 1:
+        return torch.gather(x.unsqueeze(-1), dim - 1 if dim < 0 else dim, index.unsqueeze(-1)).squeeze(-1)
+    return torch.gather(x, dim, index)
+
+
+def _do_nothing(x):
+    return x
+
+
+def bipartite_soft_matching_2d(metric, w, h, sx, sy, r, generator=None):
+    # 토큰을 dst(각 sx*sy 윈도우에서 1개)와 src로 나누고
+    # 가장 유사한 src r개를 대응하는 dst에 평균 병합
+    B, N, _ = metric.shape
+    if r <= 0:
+        return _do_nothing, _do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+
+        if generator is not None:
+            rand_idx = torch.randint(sy * sx, size=(hsy, wsx, 1), generator=generator).to(metric.device)
+        else:
+            rand_idx = torch.zeros(hsy, wsx, 1, device=metric.device, dtype=torch.int64)
+
+        # 윈도우마다 dst 위치를 -1로 표시
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx))
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+
+        # 윈도우로 나누어 떨어지지 않는 가장자리는 모두 src
+        if (hsy * sy) < h or (wsx * sx) < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[:(hsy * sy), :(wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        # argsort 하면 dst(-1)가 앞으로 온다
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]
+        b_idx = rand_idx[:, :num_dst, :]
+
+        def split(x):
+            C = x.shape[-1]
+            src = _gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = _gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = _gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x, mode="mean"):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = _gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = _gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        _, _, c = unm.shape
+
+        src = _gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        # 병합 전 위치로 되돌리기
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=_gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=_gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx).expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+def _compute_merge(x, info):
+    original_h, original_w = info["size"]
+    original_tokens = original_h * original_w
+    downsample = int(math.ceil(math.sqrt(original_tokens // x.shape[1])))
+
+    # 고해상도 블록에서만 병합 (토큰 수가 많은 곳에서 효과가 큼)
+    if downsample > info["max_downsample"]:
+        return _do_nothing, _do_nothing
+
+    w = int(math.ceil(original_w / downsample))
+    h = int(math.ceil(original_h / downsample))
+    r = int(x.shape[1] * info["ratio"])
+    if w * h != x.shape[1]:
+        return _do_nothing, _do_nothing
+    return bipartite_soft_matching_2d(x, w, h, info["sx"], info["sy"], r, generator=info["generator"])
+
+
+def _make_attn_forward(attn, info):
+    original_forward = attn.forward
+
+    def forward(hidden_states, encoder_hidden_states=None, *args, **kwargs):
+        # self-attention(attn1)에만 적용
+        if encoder_hidden_states is not None or info["ratio"] <= 0 or info["size"] is None:
+            return original_forward(hidden_states, encoder_hidden_states, *args, **kwargs)
+        merge, unmerge = _compute_merge(hidden_states, info)
+        return unmerge(original_forward(merge(hidden_states), None, *args, **kwargs))
+
+    return forward
+
+
+def _unet_pre_hook(info):
+    def hook(module, args, kwargs):
+        sample = args[0] if args else kwargs.get("sample")
+        info["size"] = tuple(sample.shape[2:])
+    return hook
+
+
+def apply_patch(unet, ratio=0.5, max_downsample=1, sx=2, sy=2, seed=0):
+    # 이미 패치된 경우 비율만 갱신
+    info = getattr(unet, "_tome_info", None)
+    if info is not None:
+        info["ratio"] = ratio
+        return info
+
+    info = {
+        "ratio": ratio,
+        "max_downsample": max_downsample,
+        "sx": sx,
+        "sy": sy,
+        "size": None,
+        "generator": torch.Generator("cpu").manual_seed(seed),
+        "hooks": [],
+        "attns": [],
+    }
+    info["hooks"].append(unet.register_forward_pre_hook(_unet_pre_hook(info), with_kwargs=True))
+
+    for name, module in unet.named_modules():
+        # BasicTransformerBlock 의 attn1 (self-attention)
+        if name.endswith("attn1") and module.__class__.__name__ == "Attention":
+            module.forward = _make_attn_forward(module, info)
+            info["attns"].append(module)
+
+    unet._tome_info = info
+    return info
+
+
+def remove_patch(unet):
+    info = getattr(unet, "_tome_info", None)
+    if info is None:
+        return
+    for hook in info["hooks"]:
+        hook.remove()
+    for attn in info["attns"]:
+        # 인스턴스 속성을 지우면 클래스의 원래 forward로 돌아감
+        del attn.forward
+    del unet._tome_info
+
+
+def is_patched(unet):
+    return getattr(unet, "_tome_info", None) is not None
+
+
+@contextlib.contextmanager
+def token_merging(unet, ratio):
+    # 요청 단위 적용: 비율이 0이면 패치하지 않고, 끝나면 원래 상태로 복원
+    if unet is None or not ratio:
+        yield
+        return
+    was_patched = is_patched(unet)
+    previous = unet._tome_info["ratio"] if was_patched else None
+    apply_patch(unet, ratio=ratio)
+    try:
+        yield
+    finally:
+        if was_patched:
+            unet._tome_info["ratio"] = previous
+        else:
+            remove_patch(unet)
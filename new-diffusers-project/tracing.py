@@ -0,0 +1,285 @@
+import contextvars
+import html
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# 요청 단위 스팬 추적
+# - HTTP/웹소켓 진입점에서 트레이스 시작, ComfyUI 호출/이미지 조회/노드 실행을 자식 스팬으로 기록
+# - 샘플링 (샘플링되지 않은 요청은 NOOP 스팬이라 비용이 거의 없음), X-Trace: 1 헤더 등으로 강제 가능
+# - 완료된 트레이스는 메모리 링 버퍼 + (선택) JSONL 파일로 내보냄
+
+# 트레이스당 최대 스팬 수 (이후 스팬은 버리고 개수만 기록)
+MAX_SPANS = 2000
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    sampled = True
+
+    def __init__(self, tracer, trace, name, parent_id=None, attrs=None, start=None):
+        self.tracer = tracer
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = dict(attrs or {})
+        self.start = start or time.time()
+        self.end_time = None
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def child(self, name, start=None, **attrs):
+        span = Span(self.tracer, self.trace, name, self.span_id, attrs, start)
+        self.trace.add(span)
+        return span
+
+    def end(self, error=None, end=None):
+        if self.end_time is not None:
+            return
+        self.end_time = end or time.time()
+        if error is not None:
+            self.error = str(error) or type(error).__name__
+        if self is self.trace.root:
+            self.tracer._export(self.trace)
+
+    @property
+    def duration(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start
+
+    def to_dict(self):
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 2) if self.duration is not None else None,
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class NoopSpan:
+    # 샘플링되지 않은 요청용
+    sampled = False
+    trace = None
+
+    def set(self, **attrs):
+        pass
+
+    def child(self, name, start=None, **attrs):
+        return self
+
+    def end(self, error=None, end=None):
+        pass
+
+
+NOOP = NoopSpan()
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.root = None
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append(span)
+
+    def summary(self):
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "start": root.start,
+            "duration_ms": round(root.duration * 1000, 2) if root.duration is not None else None,
+            "spans": len(self.spans),
+            "error": root.error or next((s.error for s in self.spans if s.error), None),
+            "attrs": root.attrs,
+        }
+
+    def to_dict(self):
+        return {**self.summary(), "dropped_spans": self.dropped, "spans": [s.to_dict() for s in self.spans]}
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.1, ring_size=200, path=None):
+        self.sample_rate = sample_rate
+        self.path = path
+        self.ring = deque(maxlen=ring_size)
+        self.started = 0
+        self.sampled = 0
+        self._file_lock = threading.Lock()
+
+    def start(self, name, force=False, **attrs):
+        # 새 트레이스의 루트 스팬 (샘플링되지 않으면 NOOP)
+        self.started += 1
+        if not force and random.random() >= self.sample_rate:
+            return NOOP
+        self.sampled += 1
+        trace = Trace()
+        span = Span(self, trace, name, attrs=attrs)
+        trace.root = span
+        trace.add(span)
+        return span
+
+    @contextmanager
+    def use(self, span):
+        # 이 블록(과 여기서 만든 태스크)의 현재 스팬으로 설정
+        token = _current.set(span)
+        try:
+            yield span
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = _current.get()
+        if parent is None or not parent.sampled:
+            yield NOOP
+            return
+        span = parent.child(name, **attrs)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(error=e)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+    def current(self):
+        return _current.get() or NOOP
+
+    def _export(self, trace):
+        self.ring.append(trace)
+        if self.path:
+            try:
+                with self._file_lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(trace.to_dict(), ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                print(f"트레이스 저장 오류: {str(e)}")
+
+    def traces(self, limit=50, name=None, min_duration_ms=None, errors_only=False):
+        result = []
+        for trace in reversed(self.ring):
+            summary = trace.summary()
+            if name and name not in summary["name"]:
+                continue
+            if min_duration_ms is not None and (summary["duration_ms"] or 0) < min_duration_ms:
+                continue
+            if errors_only and not summary["error"]:
+                continue
+            result.append(summary)
+            if len(result) >= limit:
+                break
+        return result
+
+    def get(self, trace_id):
+        for trace in self.ring:
+            if trace.trace_id == trace_id:
+                return trace
+        return None
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "started": self.started,
+            "sampled": self.sampled,
+            "buffered": len(self.ring),
+            "path": self.path,
+        }
+
+
+class NodeTimeline:
+    # ComfyUI 웹소켓 이벤트로 대기열/노드 실행 스팬 생성
+    # execution_start 전까지 queue_wait, executing 노드가 바뀔 때마다 노드 스팬, execution_cached 노드는 cached=True
+    def __init__(self, parent, prompt_id, node_types=None):
+        self.parent = parent
+        self.node_types = node_types or {}
+        self.queue_span = parent.child("comfy.queue_wait", prompt_id=prompt_id)
+        self.execute_span = None
+        self.node_span = None
+
+    def on_message(self, message):
+        if not self.parent.sampled:
+            return
+        message_type = message.get("type")
+        data = message.get("data") or {}
+        if message_type == "execution_start":
+            self.queue_span.end()
+            self.execute_span = self.parent.child("comfy.execute")
+        elif message_type == "execution_cached":
+            parent = self._execute_parent()
+            for node in data.get("nodes") or []:
+                parent.child(f"node {node}", node=node, class_type=self.node_types.get(node), cached=True).end()
+        elif message_type == "executing":
+            if self.node_span is not None:
+                self.node_span.end()
+                self.node_span = None
+            node = data.get("node")
+            if node is None:
+                self.close()
+            else:
+                self.node_span = self._execute_parent().child(
+                    f"node {node}", node=node, class_type=self.node_types.get(node), cached=False
+                )
+        elif message_type == "execution_error":
+            self.close(error=data.get("exception_message") or "execution_error")
+
+    def _execute_parent(self):
+        if self.execute_span is None:
+            # execution_start 를 놓친 경우
+            self.queue_span.end()
+            self.execute_span = self.parent.child("comfy.execute")
+        return self.execute_span
+
+    def close(self, error=None):
+        if self.node_span is not None:
+            self.node_span.end(error=error)
+            self.node_span = None
+        self.queue_span.end()
+        if self.execute_span is not None:
+            self.execute_span.end(error=error)
+
+
+def render_html(trace):
+    # 간단한 워터폴 뷰
+    root = trace.root
+    total = max((root.duration or 0), 1e-6)
+    depth = {root.span_id: 0}
+    rows = []
+    for span in sorted(trace.spans, key=lambda s: s.start):
+        level = depth.get(span.parent_id, -1) + 1 if span is not root else 0
+        depth[span.span_id] = level
+        offset = (span.start - root.start) / total * 100
+        width = max((span.duration or 0) / total * 100, 0.3)
+        color = "#e66" if span.error else ("#9c9" if span.attrs.get("cached") else "#69c")
+        duration = f"{span.duration * 1000:.1f} ms" if span.duration is not None else "-"
+        attrs = html.escape(json.dumps(span.attrs, ensure_ascii=False, default=str))
+        rows.append(
+            f'<tr><td style="padding-left:{level * 14}px">{html.escape(span.name)}</td><td>{duration}</td>'
+            f'<td style="width:50%"><div style="margin-left:{offset:.2f}%;width:{width:.2f}%;background:{color};height:10px"></div></td>'
+            f'<td><small>{attrs}{" " + html.escape(span.error) if span.error else ""}</small></td></tr>'
+        )
+    return (
+        f"<html><head><meta charset='utf-8'><title>{html.escape(root.name)}</title></head><body>"
+        f"<h3>{html.escape(root.name)} - {trace.trace_id}</h3>"
+        f"<table style='width:100%;font-family:monospace;font-size:12px'>{''.join(rows)}</table></body></html>"
+    )
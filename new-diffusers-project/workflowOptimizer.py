@@ -0,0 +1,175 @@
+import hashlib
+import json
+import re
+
+from workflowTemplates import is_link
+
+# ComfyUI 노드 출력 캐시 적중을 높이기 위한 워크플로우 정리
+# - 요청한 출력 노드에서 도달할 수 없는 노드 제거 (예: 배경 제거가 필요 없을 때 RMBG/PreviewImage)
+# - 입력 정규화 (프롬프트 공백/줄바꿈) 후 같은 입력의 중복 노드 병합
+# - 배치 제출 시 연속한 프롬프트가 같은 상위 노드를 최대한 공유하도록 순서 정렬
+# - execution_cached 이벤트로 캐시 적중률 집계
+# 템플릿과 공유하는 노드는 수정하지 않고 바뀌는 노드만 복사
+
+OUTPUT_NODES = {"SaveImage", "PreviewImage", "SaveImageWebsocket"}
+# 입력이 같아도 매번 다시 실행되거나 부작용이 있는 노드는 병합하지 않음
+NO_MERGE_NODES = OUTPUT_NODES | {"LoadImage"}
+TEXT_NODES = {"CLIPTextEncode"}
+
+
+def output_nodes(graph, requested=None):
+    # requested: 노드 id 또는 class_type 목록 (없으면 모든 출력 노드)
+    if not requested:
+        return [node_id for node_id, node in graph.items() if node["class_type"] in OUTPUT_NODES]
+    requested = set(requested)
+    return [
+        node_id for node_id, node in graph.items()
+        if node_id in requested or node["class_type"] in requested
+    ]
+
+
+def prune(graph, requested=None):
+    # 출력 노드에서 상위로 도달 가능한 노드만 유지
+    outputs = output_nodes(graph, requested)
+    if not outputs:
+        raise ValueError(f"요청한 출력 노드가 워크플로우에 없습니다: {', '.join(requested or [])}")
+    keep = set()
+    stack = list(outputs)
+    while stack:
+        node_id = stack.pop()
+        if node_id in keep or node_id not in graph:
+            continue
+        keep.add(node_id)
+        for value in graph[node_id]["inputs"].values():
+            if is_link(value):
+                stack.append(value[0])
+    return {node_id: node for node_id, node in graph.items() if node_id in keep}
+
+
+def normalize_text(text):
+    # 줄 끝 공백, 줄바꿈 형식, 연속 빈 줄, 앞뒤 공백 차이로 인코딩 캐시가 깨지지 않도록 정리
+    lines = [line.rstrip() for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def topological_order(graph):
+    order = []
+    state = {}
+
+    def visit(node_id):
+        if state.get(node_id) == 2:
+            return
+        if state.get(node_id) == 1:
+            raise ValueError(f"워크플로우에 순환 연결이 있습니다: 노드 #{node_id}")
+        state[node_id] = 1
+        for value in graph[node_id]["inputs"].values():
+            if is_link(value) and value[0] in graph:
+                visit(value[0])
+        state[node_id] = 2
+        order.append(node_id)
+
+    for node_id in graph:
+        visit(node_id)
+    return order
+
+
+def canonicalize(graph):
+    # 텍스트 입력 정규화 + 같은 class_type/입력의 중복 노드 병합 (링크는 남은 노드로 연결)
+    result = {}
+    remap = {}
+    seen = {}
+    for node_id in topological_order(graph):
+        node = graph[node_id]
+        inputs = node["inputs"]
+        changed = {}
+        for name, value in inputs.items():
+            if is_link(value) and value[0] in remap:
+                changed[name] = [remap[value[0]], value[1]]
+            elif node["class_type"] in TEXT_NODES and isinstance(value, str):
+                text = normalize_text(value)
+                if text != value:
+                    changed[name] = text
+        if changed:
+            node = {**node, "inputs": {**inputs, **changed}}
+
+        if node["class_type"] not in NO_MERGE_NODES:
+            key = json.dumps([node["class_type"], node["inputs"]], sort_keys=True)
+            if key in seen:
+                remap[node_id] = seen[key]
+                continue
+            seen[key] = node_id
+        result[node_id] = node
+    # 원래 노드 순서 유지
+    return {node_id: result[node_id] for node_id in graph if node_id in result}
+
+
+def optimize(graph, requested=None):
+    return canonicalize(prune(graph, requested))
+
+
+def signatures(graph):
+    # 노드별 캐시 키 (class_type + 입력, 링크는 상위 노드 키로 대체) - ComfyUI 입력 시그니처와 같은 기준
+    result = {}
+    for node_id in topological_order(graph):
+        node = graph[node_id]
+        inputs = {}
+        for name, value in node["inputs"].items():
+            if is_link(value) and value[0] in result:
+                inputs[name] = [result[value[0]], value[1]]
+            else:
+                inputs[name] = value
+        data = json.dumps([node["class_type"], inputs], sort_keys=True, default=str)
+        result[node_id] = hashlib.sha1(data.encode("utf-8")).hexdigest()
+    return result
+
+
+def order_for_cache(workflows):
+    # 바로 앞 프롬프트와 공유하는 (출력 노드 제외) 노드 수가 가장 많은 것부터 (탐욕적 순서)
+    # ComfyUI 기본 캐시는 직전 프롬프트의 노드 출력만 유지
+    keys = []
+    for workflow in workflows:
+        keys.append({
+            sig for node_id, sig in signatures(workflow).items()
+            if workflow[node_id]["class_type"] not in OUTPUT_NODES
+        })
+    if len(workflows) <= 2:
+        return list(range(len(workflows)))
+    remaining = list(range(1, len(workflows)))
+    order = [0]
+    while remaining:
+        last = keys[order[-1]]
+        best = max(remaining, key=lambda i: (len(keys[i] & last), -i))
+        remaining.remove(best)
+        order.append(best)
+    return order
+
+
+class CacheStats:
+    # execution_cached (캐시 재사용 노드) / executing (실제 실행 노드) 이벤트 집계
+    def __init__(self):
+        self.cached_nodes = 0
+        self.executed_nodes = 0
+        self.prompts = 0
+        self.prompts_with_hits = 0
+
+    def on_message(self, message):
+        message_type = message.get("type")
+        data = message.get("data") or {}
+        if message_type == "execution_cached":
+            nodes = data.get("nodes") or []
+            self.cached_nodes += len(nodes)
+            self.prompts += 1
+            if nodes:
+                self.prompts_with_hits += 1
+        elif message_type == "executing" and data.get("node") is not None:
+            self.executed_nodes += 1
+
+    def stats(self):
+        total = self.cached_nodes + self.executed_nodes
+        return {
+            "cached_nodes": self.cached_nodes,
+            "executed_nodes": self.executed_nodes,
+            "hit_rate": round(self.cached_nodes / total, 3) if total else None,
+            "prompts": self.prompts,
+            "prompts_with_hits": self.prompts_with_hits,
+        }
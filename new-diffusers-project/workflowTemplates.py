@@ -0,0 +1,282 @@
+import json
+import os
+import threading
+import time
+
+# 워크플로우 템플릿 레이어
+# - workflowJSON/*.json 을 한 번만 읽어서 검증 후 메모리에 보관
+# - 이름 있는 파라미터 슬롯(prompt, negative, seed, width, height, batch) -> 노드 입력 매핑
+# - 요청별 그래프는 변경되는 노드만 복사 (나머지 노드는 템플릿과 공유하므로 수정 금지)
+# - 파일 변경 시 자동 재로드
+# - UI 내보내기 형식(nodes/links)은 로드 시 API 형식으로 변환
+
+# 재로드 확인 주기 (초)
+RELOAD_INTERVAL = 1.0
+
+# UI 형식 변환용 위젯 입력 순서 (ComfyUI /object_info 기준)
+# control_after_generate 는 UI 전용 위젯이라 API 형식에서는 버림
+WIDGET_INPUTS = {
+    "CheckpointLoaderSimple": ["ckpt_name"],
+    "CLIPTextEncode": ["text"],
+    "KSampler": ["seed", "control_after_generate", "steps", "cfg", "sampler_name", "scheduler", "denoise"],
+    "KSamplerAdvanced": ["add_noise", "noise_seed", "control_after_generate", "steps", "cfg", "sampler_name",
+                         "scheduler", "start_at_step", "end_at_step", "return_with_leftover_noise"],
+    "EmptyLatentImage": ["width", "height", "batch_size"],
+    "EmptySD3LatentImage": ["width", "height", "batch_size"],
+    "LatentUpscale": ["upscale_method", "width", "height", "crop"],
+    "VAEDecode": [],
+    "VAEEncode": [],
+    "VAELoader": ["vae_name"],
+    "LoraLoader": ["lora_name", "strength_model", "strength_clip"],
+    "CLIPSetLastLayer": ["stop_at_clip_layer"],
+    "SaveImage": ["filename_prefix"],
+    "PreviewImage": [],
+    "SaveImageWebsocket": [],
+    "RandomNoise": ["noise_seed", "control_after_generate"],
+    "KSamplerSelect": ["sampler_name"],
+    "BasicScheduler": ["scheduler", "steps", "denoise"],
+    "BasicGuider": [],
+    "FluxGuidance": ["guidance"],
+    "SamplerCustomAdvanced": [],
+}
+UI_ONLY_WIDGETS = {"control_after_generate"}
+# 실행되지 않는 UI 전용 노드
+UI_ONLY_NODES = {"Note", "MarkdownNote", "PrimitiveNode", "Reroute"}
+
+SAMPLER_NODES = {"KSampler", "KSamplerAdvanced", "SamplerCustomAdvanced"}
+LATENT_NODES = {"EmptyLatentImage", "EmptySD3LatentImage"}
+SEED_INPUTS = ("seed", "noise_seed")
+
+
+class WorkflowError(Exception):
+    pass
+
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+def ui_to_api(workflow):
+    # UI 내보내기 형식 -> API 형식
+    links = {}
+    for link_id, from_node, from_slot, to_node, to_slot, _type in (tuple(l[:6]) for l in workflow.get("links", [])):
+        links[link_id] = (str(from_node), from_slot)
+
+    nodes = {str(n["id"]): n for n in workflow["nodes"]}
+
+    def resolve(link_id):
+        # Reroute 노드는 건너뛰고 실제 출력 노드를 찾음
+        source = links.get(link_id)
+        while source is not None and nodes.get(source[0], {}).get("type") == "Reroute":
+            reroute_inputs = nodes[source[0]].get("inputs", [])
+            source = links.get(reroute_inputs[0].get("link")) if reroute_inputs else None
+        return [source[0], source[1]] if source else None
+
+    api = {}
+    for node_id, node in nodes.items():
+        node_type = node["type"]
+        # mode 2(mute), 4(bypass) 노드와 UI 전용 노드는 제외
+        if node_type in UI_ONLY_NODES or node.get("mode", 0) in (2, 4):
+            continue
+        if node_type not in WIDGET_INPUTS:
+            raise WorkflowError(f"UI 형식 변환을 지원하지 않는 노드: {node_type} (#{node_id})")
+
+        inputs = {}
+        linked_widgets = set()
+        for node_input in node.get("inputs", []):
+            if node_input.get("link") is None:
+                continue
+            source = resolve(node_input["link"])
+            if source is None:
+                continue
+            inputs[node_input["name"]] = source
+            if node_input.get("widget"):
+                linked_widgets.add(node_input["widget"]["name"])
+
+        values = node.get("widgets_values") or []
+        if isinstance(values, dict):
+            values = [values.get(name) for name in WIDGET_INPUTS[node_type]]
+        for name, value in zip(WIDGET_INPUTS[node_type], values):
+            if name in UI_ONLY_WIDGETS or name in linked_widgets:
+                continue
+            inputs[name] = value
+
+        api[node_id] = {
+            "inputs": inputs,
+            "class_type": node_type,
+            "_meta": {"title": node.get("title", node_type)},
+        }
+    return api
+
+
+def validate(graph):
+    if not isinstance(graph, dict) or not graph:
+        raise WorkflowError("빈 워크플로우")
+    for node_id, node in graph.items():
+        if "class_type" not in node or not isinstance(node.get("inputs"), dict):
+            raise WorkflowError(f"노드 #{node_id} 에 class_type/inputs 가 없습니다.")
+        for name, value in node["inputs"].items():
+            if is_link(value) and value[0] not in graph:
+                raise WorkflowError(f"노드 #{node_id}.{name} 가 존재하지 않는 노드 #{value[0]} 를 참조합니다.")
+
+
+def _find_upstream(graph, link, class_types, through=("conditioning", "guider")):
+    # 링크를 거슬러 올라가며 class_types 노드 검색 (FluxGuidance/BasicGuider 등 통과)
+    seen = set()
+    while is_link(link) and link[0] not in seen:
+        node_id = link[0]
+        seen.add(node_id)
+        node = graph[node_id]
+        if node["class_type"] in class_types:
+            return node_id
+        link = next((node["inputs"][name] for name in through if is_link(node["inputs"].get(name))), None)
+    return None
+
+
+def detect_slots(graph):
+    # 슬롯 이름 -> [(node_id, input_name), ...]
+    slots = {}
+
+    def add(slot, node_id, input_name):
+        target = (node_id, input_name)
+        if target not in slots.setdefault(slot, []):
+            slots[slot].append(target)
+
+    for node_id, node in graph.items():
+        class_type = node["class_type"]
+        inputs = node["inputs"]
+
+        if class_type in SAMPLER_NODES:
+            positive = inputs.get("positive") or inputs.get("guider")
+            encoder = _find_upstream(graph, positive, {"CLIPTextEncode"})
+            if encoder:
+                add("prompt", encoder, "text")
+            encoder = _find_upstream(graph, inputs.get("negative"), {"CLIPTextEncode"})
+            if encoder:
+                add("negative", encoder, "text")
+            for name in SEED_INPUTS:
+                if name in inputs and not is_link(inputs[name]):
+                    add("seed", node_id, name)
+
+        elif class_type == "RandomNoise":
+            add("seed", node_id, "noise_seed")
+
+        elif class_type in LATENT_NODES:
+            add("width", node_id, "width")
+            add("height", node_id, "height")
+            add("batch", node_id, "batch_size")
+
+    return slots
+
+
+class WorkflowTemplate:
+    def __init__(self, name, graph, slots, path=None, mtime=None):
+        self.name = name
+        self.graph = graph
+        self.slots = slots
+        self.path = path
+        self.mtime = mtime
+
+    def node_for(self, slot):
+        targets = self.slots.get(slot)
+        return targets[0][0] if targets else None
+
+    def current(self, slot):
+        targets = self.slots.get(slot)
+        if not targets:
+            return None
+        node_id, input_name = targets[0]
+        return self.graph[node_id]["inputs"].get(input_name)
+
+    def render(self, **params):
+        # 변경되는 노드만 복사 (copy-on-write), 값이 None 인 파라미터는 템플릿 값 유지
+        graph = dict(self.graph)
+        copied = set()
+        for slot, value in params.items():
+            if value is None:
+                continue
+            if slot not in self.slots:
+                raise WorkflowError(f"워크플로우 '{self.name}' 에 '{slot}' 슬롯이 없습니다.")
+            for node_id, input_name in self.slots[slot]:
+                if node_id not in copied:
+                    node = graph[node_id]
+                    graph[node_id] = {**node, "inputs": dict(node["inputs"])}
+                    copied.add(node_id)
+                graph[node_id]["inputs"][input_name] = value
+        return graph
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "nodes": len(self.graph),
+            "slots": {slot: [list(t) for t in targets] for slot, targets in self.slots.items()},
+            "mtime": self.mtime,
+        }
+
+
+def _load_slot_overrides(path):
+    # workflowJSON/{name}.slots.json 이 있으면 자동 감지 대신 사용
+    # 예: {"prompt": [["12", "text"]], "seed": [["37", "noise_seed"]]}
+    slots_path = path[:-len(".json")] + ".slots.json"
+    if not os.path.exists(slots_path):
+        return None
+    with open(slots_path, "r", encoding="utf-8") as f:
+        return {slot: [tuple(t) for t in targets] for slot, targets in json.load(f).items()}
+
+
+def load_template(name, path):
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    graph = ui_to_api(raw) if "nodes" in raw and "links" in raw else raw
+    validate(graph)
+    slots = _load_slot_overrides(path) or detect_slots(graph)
+    for slot, targets in slots.items():
+        for node_id, input_name in targets:
+            if node_id not in graph:
+                raise WorkflowError(f"슬롯 '{slot}' 의 노드 #{node_id} 가 없습니다.")
+    return WorkflowTemplate(name, graph, slots, path=path, mtime=os.path.getmtime(path))
+
+
+class TemplateStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.templates = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._last_scan = 0.0
+        self.reload()
+
+    def reload(self):
+        # 변경된 파일만 다시 읽음. 검증 실패 시 이전 버전 유지
+        with self._lock:
+            self._last_scan = time.monotonic()
+            seen = set()
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".json") or entry.name.endswith(".slots.json"):
+                    continue
+                name = entry.name[:-len(".json")]
+                seen.add(name)
+                mtime = entry.stat().st_mtime
+                current = self.templates.get(name)
+                if current is not None and current.mtime == mtime:
+                    continue
+                try:
+                    self.templates[name] = load_template(name, entry.path)
+                    self.errors.pop(name, None)
+                    print(f"워크플로우 로드: {name} (슬롯: {', '.join(self.templates[name].slots)})")
+                except (OSError, ValueError, KeyError, WorkflowError) as e:
+                    self.errors[name] = str(e)
+                    print(f"워크플로우 로드 오류 ({name}): {str(e)}")
+            for name in set(self.templates) - seen:
+                del self.templates[name]
+
+    def get(self, name):
+        if time.monotonic() - self._last_scan > RELOAD_INTERVAL:
+            self.reload()
+        template = self.templates.get(name)
+        if template is None:
+            raise KeyError(name)
+        return template
+
+    def names(self):
+        return sorted(self.templates)